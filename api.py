@@ -0,0 +1,519 @@
+"""
+Versioned JSON API for mobile clients, served by an ASGI server.
+
+    uvicorn --factory api:create_application --port 5000
+    gunicorn --preload -k uvicorn.workers.UvicornWorker "api:create_application()"
+
+Handlers are coroutines. Database work (the same lifecycle functions the
+HTML views use) runs on a bounded thread pool through `await db(...)`, so
+a worker keeps reading and writing other connections while SQLite blocks,
+and a slow client only costs a socket, not a thread. Only /api/ is served
+here; the HTML site stays on the Flask app under sync gunicorn workers
+(the "web" process in the Procfile, this is the "api" one), with the
+router sending /api/ to this server.
+
+Authentication: POST /api/v1/session with {"email", "password"} returns a
+token; send it as "Authorization: Bearer <token>". Tokens are signed with
+the Flask secret key and expire after TOKEN_MAX_AGE.
+
+    POST /api/v1/session
+    POST /api/v1/rides                          request and quote in one call (passenger)
+    GET  /api/v1/rides/<id>                     ride status and driver
+    POST /api/v1/rides/<id>/confirm             enter the waiting queue (passenger)
+    POST /api/v1/rides/<id>/cancel              passenger or assigned driver
+    GET  /api/v1/driver/requests                waiting rides (driver)
+    POST /api/v1/driver/rides/<id>/accept       also: reject, arrived, picked-up, complete
+
+Errors are {"error": message} with a 4xx status.
+
+Requests go through the same per-worker token buckets as the HTML routes
+(app.admit), keyed on the client address and the token's user: sign-in
+uses the "auth" policy, other POSTs the "write" policy. POST /rides,
+/rides/<id>/confirm and the driver actions accept an Idempotency-Key
+header; a retried key replays the stored response, marked with
+"Idempotent-Replayed: true".
+"""
+import asyncio
+import contextvars
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from werkzeug.security import check_password_hash
+
+import app as web
+from capture import params_shape
+
+API_PREFIX = "/api/v1"
+DB_THREADS = int(os.environ.get("API_DB_THREADS", 16))
+MAX_API_BODY = 64 * 1024
+TOKEN_MAX_AGE = 30 * 24 * 60 * 60
+
+db_pool = ThreadPoolExecutor(DB_THREADS, thread_name_prefix="api-db")
+flask_app = contextvars.ContextVar("flask_app")     # set per request by the application
+profiled_route = contextvars.ContextVar("profiled_route", default=None)   # set per profiled request
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def tokens():
+    return URLSafeTimedSerializer(flask_app.get().secret_key, salt="api-v1-token")
+
+
+async def db(fn, *args):
+    """
+    Run blocking database work on the pool without blocking the event loop,
+    inside the Flask app's context (the lifecycle functions read its
+    config). In a profiled request the pool thread is sampled while it runs fn.
+    """
+    app = flask_app.get()
+    route = profiled_route.get()
+
+    def run():
+        with app.app_context():
+            return fn(*args)
+
+    if route is None:
+        return await asyncio.get_running_loop().run_in_executor(db_pool, run)
+
+    def profiled():
+        web.profiler.begin(route, count=False)
+        try:
+            return run()
+        finally:
+            web.profiler.end()
+
+    return await asyncio.get_running_loop().run_in_executor(db_pool, profiled)
+
+
+async def read_body(receive, limit):
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ApiError("Client disconnected.", 400)
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            raise ApiError("Request body too large.", 413)
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def send_json(send, status, payload, headers=()):
+    body = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"cache-control", b"no-store"),
+            *((k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+# ---------------- request helpers ----------------
+
+class ApiRequest:
+    def __init__(self, scope, params):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query_string = scope.get("query_string", b"").decode("latin-1")
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        self.client = (scope.get("client") or ("", 0))[0]
+        self.body = b""
+        self.params = params
+        self.user = None
+        self.response_headers = []
+
+    def json(self):
+        if not self.body:
+            return {}
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            raise ApiError("Request body must be JSON.")
+        if not isinstance(data, dict):
+            raise ApiError("Request body must be a JSON object.")
+        return data
+
+    def authenticate(self, role):
+        auth = self.headers.get("authorization", "")
+        if not auth.startswith("Bearer "):
+            raise ApiError("Missing bearer token.", 401)
+        try:
+            self.user = tokens().loads(auth[len("Bearer "):], max_age=TOKEN_MAX_AGE)
+        except BadSignature:
+            raise ApiError("Invalid or expired token.", 401)
+        if role and self.user["role"] not in role:
+            raise ApiError(f"This endpoint is for {' / '.join(role)} accounts.", 403)
+        return self.user
+
+    def token_user(self):
+        """
+        The bearer token's {"user_id", "role"} without enforcing anything, or None.
+        """
+        auth = self.headers.get("authorization", "")
+        if not auth.startswith("Bearer "):
+            return None
+        try:
+            user = tokens().loads(auth[len("Bearer "):], max_age=TOKEN_MAX_AGE)
+        except BadSignature:
+            return None
+        return user if isinstance(user, dict) and "user_id" in user else None
+
+    def token_user_id(self):
+        user = self.token_user()
+        return user["user_id"] if user else None
+
+    def remote_addr(self):
+        """
+        Client address, honouring the same number of trusted proxy hops
+        (PROXY_X_FOR) as the ProxyFix in front of the Flask app.
+        """
+        trusted = flask_app.get().config.get("PROXY_X_FOR", 0)
+        forwarded = [a.strip() for a in self.headers.get("x-forwarded-for", "").split(",") if a.strip()]
+        if trusted and len(forwarded) >= trusted:
+            return forwarded[-trusted]
+        return self.client
+
+
+def ride_to_dict(ride):
+    keys = (
+        "id", "status", "pickup_address", "dropoff_address", "pickup_lat", "pickup_lng",
+        "dropoff_lat", "dropoff_lng", "notes", "allow_pool", "pool_id", "estimated_time_minutes",
+        "surge_multiplier", "final_distance_km", "final_fare", "created_at", "accepted_at",
+        "arrived_at", "picked_up_at", "completed_at",
+    )
+    present = ride.keys()
+    return {k: ride[k] for k in keys if k in present}
+
+
+async def current_driver(req):
+    driver = await db(web.load_driver, req.user["user_id"])
+    if driver is None:
+        raise ApiError("Driver profile not found.", 403)
+    return driver
+
+
+# ---------------- handlers ----------------
+
+def check_login(email, password):
+    conn = web.get_db()
+    try:
+        user = conn.execute("SELECT id, password_hash, role FROM users WHERE email = ?", (email,)).fetchone()
+    finally:
+        conn.close()
+    if user is None or not check_password_hash(user["password_hash"], password):
+        return None
+    return {"user_id": user["id"], "role": user["role"]}
+
+
+async def create_session(req):
+    data = req.json()
+    user = await db(check_login, str(data.get("email", "")).strip().lower(), str(data.get("password", "")))
+    if user is None:
+        raise ApiError("Invalid email or password.", 401)
+    return 201, {"token": tokens().dumps(user), "role": user["role"], "expires_in": TOKEN_MAX_AGE}
+
+
+async def request_ride(req):
+    """
+    Create and price a ride in one round trip (the HTML flow takes three).
+    """
+    req.authenticate(("passenger",))
+    data = req.json()
+    ride_id = await db(
+        web.create_ride,
+        req.user["user_id"],
+        str(data.get("pickup_address", "")).strip(),
+        str(data.get("dropoff_address", "")).strip(),
+        web.parse_coordinate(data.get("pickup_lat")),
+        web.parse_coordinate(data.get("pickup_lng")),
+        web.parse_coordinate(data.get("dropoff_lat")),
+        web.parse_coordinate(data.get("dropoff_lng")),
+        str(data.get("notes", "")).strip(),
+        bool(data.get("allow_pool")),
+    )
+    _, fare = await db(web.quote_ride, ride_id, req.user["user_id"])
+    # quote_ride returns the row it priced; the stored ride now carries the quote
+    ride, _ = await db(web.load_ride_details, ride_id, req.user["user_id"])
+    return 201, {"ride": ride_to_dict(ride), "quote": fare}
+
+
+def load_ride_for_driver(ride_id, driver_id):
+    conn = web.get_ride_db(ride_id)
+    try:
+        return conn.execute("SELECT * FROM rides WHERE id = ? AND driver_id = ?", (ride_id, driver_id)).fetchone()
+    finally:
+        conn.close()
+
+
+async def get_ride(req):
+    req.authenticate(("passenger", "driver"))
+    ride_id = int(req.params["ride_id"])
+    if req.user["role"] == "driver":
+        driver = await current_driver(req)
+        ride = await db(load_ride_for_driver, ride_id, driver["driver_id"])
+        if ride is None:
+            raise ApiError("Ride not found.", 404)
+        return 200, {"ride": ride_to_dict(ride)}
+
+    ride, driver = await db(web.load_ride_details, ride_id, req.user["user_id"])
+    return 200, {"ride": ride_to_dict(ride), "driver": dict(driver) if driver else None}
+
+
+async def confirm_ride(req):
+    req.authenticate(("passenger",))
+    ride_id = int(req.params["ride_id"])
+    await db(web.queue_ride, ride_id, req.user["user_id"])
+    ride, _ = await db(web.load_ride_details, ride_id, req.user["user_id"])
+    return 200, {"ride": ride_to_dict(ride)}
+
+
+async def cancel_ride(req):
+    req.authenticate(("passenger", "driver"))
+    ride_id = int(req.params["ride_id"])
+    if req.user["role"] == "driver":
+        await db(web.cancel_ride_as_driver, await current_driver(req), ride_id)
+    else:
+        await db(web.cancel_ride_as_passenger, ride_id, req.user["user_id"])
+    return 200, {"ride_id": ride_id, "status": "cancelled"}
+
+
+async def driver_requests(req):
+    req.authenticate(("driver",))
+    await current_driver(req)
+    rides = await db(
+        web.shard_map.fanout,
+        """
+        SELECT id, pickup_address, dropoff_address, pickup_lat, pickup_lng,
+               dropoff_lat, dropoff_lng, estimated_time_minutes, pool_id, created_at
+        FROM rides
+        WHERE status = 'waiting'
+        ORDER BY created_at ASC
+        """,
+        (),
+        lambda r: r["created_at"],
+    )
+    return 200, {"rides": [ride_to_dict(r) for r in rides]}
+
+
+async def driver_action(req):
+    req.authenticate(("driver",))
+    driver = await current_driver(req)
+    ride_id = int(req.params["ride_id"])
+    action = req.params["action"]
+    if action == "accept":
+        return 200, {"ride_ids": await db(web.accept_ride, driver, ride_id), "status": "accepted"}
+    if action == "reject":
+        await db(web.reject_ride, ride_id)
+        return 200, {"ride_id": ride_id, "status": "cancelled"}
+    if action == "arrived":
+        await db(web.mark_arrived, driver, ride_id)
+        return 200, {"ride_id": ride_id, "status": "accepted"}
+    if action == "picked-up":
+        await db(web.mark_picked_up, driver, ride_id)
+        return 200, {"ride_id": ride_id, "status": "picked_up"}
+    final_fare, final_distance_km = await db(web.complete_ride, driver, ride_id)
+    return 200, {"ride_id": ride_id, "status": "completed", "final_fare": final_fare, "final_distance_km": final_distance_km}
+
+
+def error_response(e):
+    """
+    (status, payload) for an exception a handler raised on purpose.
+    """
+    payload = {"error": str(e)}
+    if isinstance(e, web.RideActionError) and e.ride_id:
+        payload["ride_id"] = e.ride_id
+    return e.status, payload
+
+
+async def idempotent(req, handler):
+    """
+    Replay the stored response for a repeated Idempotency-Key, like the
+    HTML routes' @idempotent, sharing their store.
+    """
+    key = req.headers.get("idempotency-key", "").strip()
+    user_id = req.token_user_id()
+    if not key or user_id is None:
+        return await handler(req)
+
+    scope = f"api|{user_id}|{req.method} {req.path.rstrip('/')}|{key[:255]}"
+    key_hash = hashlib.sha256(scope.encode("utf-8")).digest()
+    reserved, previous = await db(web.reserve_idempotency_key, key_hash)
+    if not reserved:
+        if previous is None or previous["status_code"] is None:
+            raise ApiError("A request with this idempotency key is already in progress.", 409, retry_after=1)
+        req.response_headers.append(("Idempotent-Replayed", "true"))
+        return previous["status_code"], previous["body"]
+
+    try:
+        status, payload = await handler(req)
+    except (web.RideActionError, ApiError) as e:
+        status, payload = error_response(e)
+    except BaseException:
+        await db(web.forget_idempotency_key, key_hash)
+        raise
+    await db(web.store_idempotency_response, key_hash, status, None, "application/json", json.dumps(payload).encode("utf-8"))
+    return status, payload
+
+
+# (method, pattern, handler, admission policy, accepts Idempotency-Key)
+ROUTES = [
+    ("POST", r"/session", create_session, "auth", False),
+    ("POST", r"/rides", request_ride, "write", True),
+    ("GET", r"/rides/(?P<ride_id>\d+)", get_ride, "default", False),
+    ("POST", r"/rides/(?P<ride_id>\d+)/confirm", confirm_ride, "write", True),
+    ("POST", r"/rides/(?P<ride_id>\d+)/cancel", cancel_ride, "write", False),
+    ("GET", r"/driver/requests", driver_requests, "default", False),
+    ("POST", r"/driver/rides/(?P<ride_id>\d+)/(?P<action>accept|reject|arrived|picked-up|complete)", driver_action, "write", True),
+]
+ROUTES = [(method, re.compile(API_PREFIX + pattern + "$"), *rest) for method, pattern, *rest in ROUTES]
+
+
+def capture_rule(pattern):
+    """
+    A route pattern as a Flask-style rule for the traffic capture:
+    "(?P<ride_id>\\d+)" -> "<int:ride_id>".
+    """
+    rule = re.sub(r"\(\?P<(\w+)>\\d\+\)", r"<int:\1>", pattern.pattern.rstrip("$"))
+    return re.sub(r"\(\?P<(\w+)>[^)]*\)", r"<\1>", rule)
+
+
+def record_capture(req, endpoint, pattern, view_args, status, started):
+    """
+    Append the request to the traffic capture in the same format as
+    app.record_capture, so API traffic is replayed too.
+    """
+    capture = web.traffic_capture
+    user = req.token_user() or {}
+    try:
+        body = json.loads(req.body) if req.body else None
+    except ValueError:
+        body = None
+    capture.record({
+        "t": round(time.time(), 3),
+        "session": capture.pseudonym(user.get("user_id")),
+        "role": user.get("role"),
+        "method": req.method,
+        "endpoint": endpoint,
+        "rule": capture_rule(pattern),
+        "view_args": {k: int(v) if v.isdigit() else v for k, v in view_args.items()},
+        "args": params_shape(dict(urllib.parse.parse_qsl(req.query_string))),
+        "form": {},
+        "json": params_shape(body) if isinstance(body, dict) else None,
+        "status": status,
+        "action_error": False,
+        "api": True,
+        "ms": round((time.perf_counter() - started) * 1000, 3),
+    })
+
+
+def admit(req, policy_name):
+    """
+    Take a token from the client's (and the token user's) bucket, as
+    app.admission_control does for HTML routes. Returns the policy to
+    release afterwards, or None when admission control is off.
+    """
+    if not flask_app.get().config.get("ADMISSION_CONTROL_ENABLED"):
+        return None
+    identities = [f"ip:{req.remote_addr()}"]
+    user_id = req.token_user_id()
+    if user_id is not None:
+        identities.append(f"user:{user_id}")
+    rejected = web.admit(policy_name, identities)
+    if rejected:
+        status, message, retry_after = rejected
+        raise ApiError(message, status, retry_after=retry_after)
+    return policy_name
+
+
+async def handle_api(app, scope, receive, send):
+    started = time.perf_counter()
+    app_token = flask_app.set(app)
+    path = scope["path"].rstrip("/")
+    matched = [(method, pattern, m, *rest) for method, pattern, *rest in ROUTES if (m := pattern.match(path))]
+    req, headers, admitted, profiling = None, [], None, None
+    try:
+        if web.startup_report["pid"] is None:
+            await db(web.run_startup, app)
+        web.start_background_work()
+        if not matched:
+            raise ApiError("Not found.", 404)
+        for method, pattern, m, handler, policy_name, keyed in matched:
+            if method == scope["method"]:
+                break
+        else:
+            raise ApiError("Method not allowed.", 405)
+        req = ApiRequest(scope, m.groupdict())
+        headers = req.response_headers
+        endpoint = f"api.{handler.__name__}"
+        if web.profiler.enabled and web.profiler.wants(endpoint, req.headers.get(web.PROFILE_HEADER.lower())):
+            web.profiler.count(endpoint)
+            profiling = profiled_route.set(endpoint)
+        admitted = admit(req, policy_name)
+        req.body = await read_body(receive, MAX_API_BODY)
+        status, payload = await (idempotent(req, handler) if keyed else handler(req))
+    except (web.RideActionError, ApiError) as e:
+        status, payload = error_response(e)
+        if getattr(e, "retry_after", None):
+            headers = [*headers, ("Retry-After", str(max(1, math.ceil(e.retry_after))))]
+    except Exception as e:
+        print(f"[api] {scope['method']} {scope['path']} failed: {e!r}", file=sys.stderr)
+        status, payload = 500, {"error": "Internal server error."}
+    finally:
+        if admitted:
+            web.release_admission(admitted)
+        if profiling is not None:
+            profiled_route.reset(profiling)
+        flask_app.reset(app_token)
+    if req is not None and web.traffic_capture is not None:
+        record_capture(req, endpoint, pattern, m.groupdict(), status, started)
+    await send_json(send, status, payload, headers)
+
+
+# ---------------- ASGI entry point ----------------
+
+def create_application(config=None):
+    """
+    ASGI counterpart of app.create_app(): builds the Flask app whose config
+    and startup hooks the API shares (the hooks run once, in the master
+    under --preload) and returns an ASGI callable serving it.
+    """
+    app = web.create_app(config)
+
+    async def application(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+        if scope["path"] == "/api" or scope["path"].startswith("/api/"):
+            await handle_api(app, scope, receive, send)
+        else:
+            # The HTML site is the WSGI app's (see the Procfile)
+            await send_json(send, 404, {"error": "Not found."})
+
+    return application
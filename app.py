@@ -1,24 +1,107 @@
-from flask import Flask, render_template, request, redirect, session, url_for, flash, send_from_directory
+import time
+IMPORT_STARTED = time.perf_counter()    # for the startup report; keep above the other imports
+
+from flask import Flask, Blueprint, current_app, render_template, request, redirect, session, url_for, flash, send_from_directory, Response, stream_with_context, g
 import sqlite3
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
 import uuid
+import csv
+import functools
+import gc
+import hashlib
+import io
+import json
+import math
+import threading
+import zlib
 from werkzeug.utils import secure_filename
-
-app = Flask(__name__)
-app.secret_key = "CHANGE_ME"
+from werkzeug.http import unquote_etag
+from werkzeug.middleware.proxy_fix import ProxyFix
+from jinja2 import FileSystemBytecodeCache
+from gazetteer import get_gazetteer
+from routing import get_road_graph, straight_line_trip
+from zones import zone_of, hour_of_week
+from eta import eta_model
+from pricing import fare_breakdown
+from surge import surge_engine
+from candidates import candidate_store
+import settlement
+from shards import ShardMap, CoreWriteJournal
+from notifications import Dispatcher, channels_from_config, enqueue as enqueue_notification
+import traces
+from assets import AssetManifest
+from fragments import FragmentCacheExtension, data_version
+from capture import TrafficCapture, params_shape
+from profiler import SamplingProfiler
+from tiles import TileCache, TileError, valid_tile, DEFAULT_UPSTREAM as DEFAULT_TILE_UPSTREAM
+from pooling import PoolRequest, best_partner, WINDOW_MINUTES as POOL_WINDOW_MINUTES, MAX_PICKUP_GAP_KM as MAX_POOL_PICKUP_GAP_KM
+
+# Every route and request hook lives on this blueprint; create_app() builds
+# the Flask app around it
+bp = Blueprint("web", __name__)
+
+# Defaults for current_app.config (create_app() overrides them per app). The shared
+# resources built at import (ride shards, notifier, tile cache) read them here.
+settings = {}
+settings['SECRET_KEY'] = "CHANGE_ME"
 
 DB_PATH = "database.db"
 
+# Bumped (rewritten) after every change to the waiting-rides queue so the
+# driver feed can answer conditional polls without opening the database.
+FEED_VERSION_PATH = DB_PATH + ".feed"
+
 # File upload configuration
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'jfif'}
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+settings['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+settings['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+
+# Local place list used by the address autocomplete (name,lat,lng,weight CSV)
+settings['GAZETTEER_PATH'] = os.environ.get("GAZETTEER_PATH", os.path.join("data", "gazetteer.csv"))
+
+# Offline road graph for quotes (see routing.py for the file format).
+# When the file is absent, fares fall back to the straight-line estimate.
+settings['ROAD_GRAPH_PATH'] = os.environ.get("ROAD_GRAPH_PATH", os.path.join("data", "roads.graph"))
+
+# Per-region ride databases (see shards.py). Without this file all rides stay in DB_PATH.
+settings['REGIONS_PATH'] = os.environ.get("REGIONS_PATH", os.path.join("data", "regions.csv"))
+
+# Ride notifications (see notifications.py): comma-separated "log", "smtp", "webhook".
+# Set NOTIFY_DISPATCHER=0 when a standalone `python notifications.py dispatch` drains the outbox.
+settings['NOTIFY_CHANNELS'] = os.environ.get("NOTIFY_CHANNELS", "log")
+settings['NOTIFY_SMTP_HOST'] = os.environ.get("NOTIFY_SMTP_HOST", "localhost")
+settings['NOTIFY_SMTP_PORT'] = int(os.environ.get("NOTIFY_SMTP_PORT", 1025))
+settings['NOTIFY_WEBHOOK_URL'] = os.environ.get("NOTIFY_WEBHOOK_URL")
+settings['NOTIFY_DISPATCHER_ENABLED'] = os.environ.get("NOTIFY_DISPATCHER", "1") != "0"
+# The log channel masks addresses and leaves the text out unless this is set
+settings['NOTIFY_LOG_CONTENT'] = os.environ.get("NOTIFY_LOG_CONTENT", "0") == "1"
+
+# Map tile proxy (see tiles.py). Point TILE_UPSTREAM_URL at `python tiles.py upstream-stub` offline.
+settings['TILE_CACHE_DIR'] = os.environ.get("TILE_CACHE_DIR", "tile_cache")
+settings['TILE_CACHE_MAX_MB'] = int(os.environ.get("TILE_CACHE_MAX_MB", 256))
+settings['TILE_UPSTREAM_URL'] = os.environ.get("TILE_UPSTREAM_URL", DEFAULT_TILE_UPSTREAM)
 
-# Create uploads directory if it doesn't exist
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+# Compiled templates, shared by all workers (see fragments.py)
+settings['JINJA_CACHE_DIR'] = os.environ.get("JINJA_CACHE_DIR", "jinja_cache")
+
+# Number of proxies in front of the app whose X-Forwarded-For is trusted.
+# Off by default: without a proxy that overwrites the header, clients could
+# pick their own address. Set PROXY_X_FOR=1 behind the Heroku router.
+settings['PROXY_X_FOR'] = int(os.environ.get("PROXY_X_FOR", 0))
+
+# Startup (see create_app): freeze the warmed heap before workers fork
+settings['STARTUP_GC_FREEZE'] = os.environ.get("STARTUP_GC_FREEZE", "1") != "0"
+
+# Sanitized request log for `python capture.py replay` (off when unset)
+settings['TRAFFIC_CAPTURE_PATH'] = os.environ.get("TRAFFIC_CAPTURE_PATH")
+
+# Sampling profiler (see profiler.py); usually switched on at /admin/profiler instead
+settings['PROFILER_ENABLED'] = os.environ.get("PROFILER_ENABLED", "0") == "1"
+settings['PROFILER_RATE'] = float(os.environ.get("PROFILER_RATE", 0.01))
+settings['PROFILER_ROUTES'] = os.environ.get("PROFILER_ROUTES", "")
+settings['PROFILER_TOKEN'] = os.environ.get("PROFILER_TOKEN")
 
 
 # ===============================
@@ -30,6 +113,37 @@ def get_db():
     return conn
 
 
+shard_map = ShardMap(DB_PATH, settings["REGIONS_PATH"])
+# Global writes made by ride transactions: direct in this file, journaled in region files
+core_writes = CoreWriteJournal(
+    shard_map,
+    {"eta_observe": lambda cursor, *trip: observe_trip(cursor, *trip)},
+    on_apply=surge_engine.invalidate,
+)
+notifier = Dispatcher(
+    [functools.partial(shard_map.connect, region) for region in shard_map.regions],
+    channels_from_config(settings),
+    ride_query=shard_map.by_ids,
+)
+notifier.enabled = settings["NOTIFY_DISPATCHER_ENABLED"]
+
+
+def get_ride_db(ride_id):
+    """
+    Connection to the database holding ride_id. Global tables (users,
+    drivers, ...) are reachable from it under their usual names, but ride
+    transactions make their global writes through a core_writes batch.
+    """
+    return shard_map.connect(shard_map.region_for_ride(ride_id))
+
+
+def get_region_db(lat, lng):
+    """
+    Connection to the database that new rides picked up at (lat, lng) go to.
+    """
+    return shard_map.connect(shard_map.region_for_point(lat, lng))
+
+
 def init_db():
     with open("schema.sql", "r") as f:
         sql = f.read()
@@ -38,7 +152,7 @@ def init_db():
 
     cursor = conn.cursor()
 
-    # --- Migration: ensure rides table has estimated_time_minutes + driver_id columns ---
+    # --- Migration: ensure rides table has estimated_time_minutes, driver_id + lifecycle columns ---
     try:
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='rides'")
         if cursor.fetchone() is not None:
@@ -50,10 +164,92 @@ def init_db():
 
             if "driver_id" not in columns:
                 cursor.execute("ALTER TABLE rides ADD COLUMN driver_id INTEGER")
+
+            # Lifecycle timestamps (feed the ETA model)
+            for column in ("accepted_at", "arrived_at", "picked_up_at", "completed_at"):
+                if column not in columns:
+                    cursor.execute(f"ALTER TABLE rides ADD COLUMN {column} TIMESTAMP")
+
+            # Shared rides: passenger opt-in + the pool (lead ride id) a ride was matched into
+            if "allow_pool" not in columns:
+                cursor.execute("ALTER TABLE rides ADD COLUMN allow_pool INTEGER NOT NULL DEFAULT 0")
+
+            if "pool_id" not in columns:
+                cursor.execute("ALTER TABLE rides ADD COLUMN pool_id INTEGER")
+
+            # Pool matching only looks at the waiting queue (match_pool_partner)
+            cursor.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_rides_pool_queue
+                ON rides(status, allow_pool, created_at) WHERE status = 'waiting'
+                """
+            )
+
+            # Quoted surge + what was actually charged (from the GPS trace when there is one)
+            for column in ("surge_multiplier", "final_distance_km", "final_fare"):
+                if column not in columns:
+                    cursor.execute(f"ALTER TABLE rides ADD COLUMN {column} REAL")
+
+            # Change marker for cached ride fragments (fragments.py); bumped on every update
+            if "version" not in columns:
+                cursor.execute("ALTER TABLE rides ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            cursor.execute(
+                """
+                CREATE TRIGGER IF NOT EXISTS rides_version AFTER UPDATE ON rides
+                WHEN NEW.version = OLD.version
+                BEGIN
+                    UPDATE rides SET version = OLD.version + 1 WHERE id = NEW.id;
+                END
+                """
+            )
+
+            settlement.ensure_index(conn)
+            # Rides completed before completed_at existed (settlement walks completed_at)
+            conn.commit()
+            settlement.backfill_completed_at(conn)
     except sqlite3.Error as e:
         # If something goes wrong, just print it; do not break the app
         print(f"[init_db] Migration for rides extra columns failed: {e}")
 
+    # --- Migration: driver_status keeps the driver's last known position (surge supply) and active ride ---
+    try:
+        cursor.execute("PRAGMA table_info(driver_status)")
+        columns = [row[1] for row in cursor.fetchall()]
+        for column in ("lat", "lng"):
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE driver_status ADD COLUMN {column} REAL")
+        # Global claim on the ride a driver is committed to (claim_driver)
+        if "active_ride_id" not in columns:
+            cursor.execute("ALTER TABLE driver_status ADD COLUMN active_ride_id INTEGER")
+    except sqlite3.Error as e:
+        print(f"[init_db] Migration for driver_status location failed: {e}")
+
+    # --- Migration: per-channel delivery state for notifications ---
+    try:
+        cursor.execute("PRAGMA table_info(notification_outbox)")
+        if "delivered" not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE notification_outbox ADD COLUMN delivered TEXT NOT NULL DEFAULT ''")
+    except sqlite3.Error as e:
+        print(f"[init_db] Migration for notification_outbox failed: {e}")
+
+    # Per-region ride files follow the global rides schema
+    try:
+        conn.commit()
+        shard_map.sync_schema()
+    except sqlite3.Error as e:
+        print(f"[init_db] Syncing ride shards failed: {e}")
+
+    # Global writes journaled by region files before a restart
+    try:
+        core_writes.run_once()
+    except sqlite3.Error as e:
+        print(f"[init_db] Applying the core write journal failed: {e}")
+
+    try:
+        surge_engine.rebuild_gauges(conn, shard_map.fanout)
+    except sqlite3.Error as e:
+        print(f"[init_db] Rebuilding surge counters failed: {e}")
+
     # Check if admin user exists, if not create one
     cursor.execute("SELECT id FROM users WHERE email = 'admin@ridehail.com'")
     admin_exists = cursor.fetchone()
@@ -76,7 +272,13 @@ def get_current_driver():
     """
     if "user_id" not in session or session.get("role") != "driver":
         return None
+    return load_driver(session["user_id"])
 
+
+def load_driver(user_id):
+    """
+    The driver row (joined with user + status) for a driver's user id, or None.
+    """
     conn = get_db()
     cursor = conn.cursor()
     cursor.execute(
@@ -87,29 +289,261 @@ def get_current_driver():
             d.license_number,
             d.vehicle_info,
             d.verification_status,
-            COALESCE(ds.is_online, 0) AS is_online
+            COALESCE(ds.is_online, 0) AS is_online,
+            ds.lat,
+            ds.lng
         FROM drivers d
         JOIN users u ON d.user_id = u.id
         LEFT JOIN driver_status ds ON ds.driver_id = d.id
         WHERE u.id = ?
         """,
-        (session["user_id"],),
+        (user_id,),
     )
     driver = cursor.fetchone()
     conn.close()
     return driver
 
 
+# ===============================
+# STARTUP
+# ===============================
+# Importing this module has no side effects. One-time work (directories,
+# migrations, warm caches) is registered below and runs once per process,
+# inside the app context of the app that triggers it: from create_app() or
+# lazily before the first request.
+#
+# With `gunicorn --preload "app:create_app()"` it runs once in the master,
+# and the forked workers share the warmed caches copy-on-write.
+startup_hooks = []      # (name, fn) in run order
+startup_lock = threading.Lock()
+startup_report = {"pid": None, "seconds": {}}
+IMPORT_SECONDS = None   # set at the end of this module
+
 
-if not os.path.exists(DB_PATH):
-    init_db()
-else:
+def startup_hook(name):
+    def decorator(fn):
+        startup_hooks.append((name, fn))
+        return fn
+    return decorator
+
+
+@startup_hook("directories")
+def prepare_directories():
+    os.makedirs(current_app.config["UPLOAD_FOLDER"], exist_ok=True)
+
+
+@startup_hook("migrate")
+def migrate():
     init_db()
 
 
+@startup_hook("warm:gazetteer")
+def warm_gazetteer():
+    get_gazetteer(current_app.config["GAZETTEER_PATH"])
+
+
+@startup_hook("warm:road_graph")
+def warm_road_graph():
+    get_road_graph(current_app.config["ROAD_GRAPH_PATH"])
+
+
+@startup_hook("warm:models")
+def warm_models():
+    eta_model.refresh_if_stale(get_db)
+    surge_engine.refresh_if_stale(get_db)
+    candidate_store.reload_if_stale(get_db, shard_map.fanout)
+
+
+@startup_hook("warm:templates")
+def warm_templates():
+    asset_manifest.load()
+    for name in current_app.jinja_env.list_templates(extensions=["html"]):
+        current_app.jinja_env.get_template(name)
+
+
+def run_startup(app):
+    """
+    Run every startup hook once in this process and print how long each took.
+    """
+    if startup_report["pid"] is not None:
+        return
+    with startup_lock, app.app_context():
+        if startup_report["pid"] is not None:
+            return
+        seconds = {"import": round(IMPORT_SECONDS, 3)} if IMPORT_SECONDS is not None else {}
+        for name, fn in startup_hooks:
+            started = time.perf_counter()
+            fn()
+            seconds[name] = round(time.perf_counter() - started, 3)
+
+        if app.config["STARTUP_GC_FREEZE"]:
+            # Move everything loaded so far out of the collector's reach, so
+            # forked workers do not dirty (and copy) the shared pages
+            gc.collect()
+            gc.freeze()
+
+        startup_report["seconds"] = seconds
+        startup_report["pid"] = os.getpid()
+    print("[startup] " + ", ".join(f"{name} {s:.3f}s" for name, s in seconds.items())
+          + f" (total {sum(seconds.values()):.3f}s)")
+
+
+def create_app(config=None, startup=True):
+    """
+    Application factory: a new Flask app serving the `web` blueprint.
+    `config` overrides the defaults in `settings`; startup=False skips the
+    startup hooks (e.g. for a quick app in tests), in which case they run
+    before the first request instead.
+    """
+    app = Flask(__name__)
+    app.config.update(settings)
+    if config:
+        app.config.update(config)
+
+    os.makedirs(app.config["JINJA_CACHE_DIR"], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config["JINJA_CACHE_DIR"])
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.globals["tile_url_template"] = "/tiles/{z}/{x}/{y}.png"
+    app.register_blueprint(bp)
+
+    if app.config['PROXY_X_FOR']:
+        # request.remote_addr is the client, not the router (admission control keys on it)
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_X_FOR'], x_proto=1)
+
+    if startup:
+        run_startup(app)
+    return app
+
+
+@bp.before_app_request
+def ensure_started():
+    if startup_report["pid"] is None:
+        run_startup(current_app._get_current_object())
+    start_background_work()
+
+
+# Background threads are not started by the startup hooks: under --preload
+# those run in the gunicorn master, and a thread there would be lost at
+# fork (and could leave a lock held in every worker). Each worker starts
+# its own, from gunicorn's post_fork hook (gunicorn.conf.py) or else
+# before its first request.
+background_pid = None
+
+
+def start_background_work():
+    global background_pid
+    if background_pid == os.getpid():
+        return
+    background_pid = os.getpid()
+    # Retries pending from before a restart go out without waiting for a new event
+    notifier.wake()
+    core_writes.wake()
+
+
+# ===============================
+# TRAFFIC CAPTURE
+# ===============================
+# One sanitized line per request (see capture.py). When TRAFFIC_CAPTURE_PATH
+# is unset, traffic_capture stays None and both hooks return immediately.
+traffic_capture = None
+
+
+@startup_hook("capture")
+def open_traffic_capture():
+    global traffic_capture
+    if current_app.config["TRAFFIC_CAPTURE_PATH"]:
+        traffic_capture = TrafficCapture(current_app.config["TRAFFIC_CAPTURE_PATH"], current_app.secret_key)
+
+
+@bp.before_app_request
+def start_capture():
+    if traffic_capture is not None:
+        g.capture_started = time.perf_counter()
+
+
+@bp.after_app_request
+def record_capture(response):
+    started = g.pop("capture_started", None)
+    if started is None or request.url_rule is None or request.endpoint == "static":
+        return response
+
+    traffic_capture.record({
+        "t": round(time.time(), 3),
+        "session": traffic_capture.pseudonym(session.get("user_id")),
+        "role": session.get("role"),
+        "method": request.method,
+        "endpoint": request.endpoint,
+        "rule": request.url_rule.rule,
+        "view_args": request.view_args,
+        "args": params_shape(request.args),
+        "form": params_shape(request.form),
+        "json": params_shape(request.get_json(silent=True)) if request.is_json else None,
+        "status": response.status_code,
+        "action_error": bool(g.get("action_error")),
+        "ms": round((time.perf_counter() - started) * 1000, 3),
+    })
+    return response
+
+
+# ===============================
+# SAMPLING PROFILER
+# ===============================
+# Admin-only, per worker (see profiler.py and /admin/profiler). A request is
+# profiled when its endpoint is listed, when it sends PROFILE_HEADER with the
+# token, or at random with probability rate.
+PROFILE_HEADER = "X-Profile"
+
+profiler = SamplingProfiler()
+
+
+@startup_hook("profiler")
+def configure_profiler():
+    profiler.rate = current_app.config["PROFILER_RATE"]
+    profiler.routes = {r.strip() for r in current_app.config["PROFILER_ROUTES"].split(",") if r.strip()}
+    profiler.token = current_app.config["PROFILER_TOKEN"]
+    if current_app.config["PROFILER_ENABLED"]:
+        profiler.start()
+
+
+@bp.before_app_request
+def start_profiling():
+    if not profiler.enabled or request.endpoint in (None, "static"):
+        return
+    if profiler.wants(request.endpoint, request.headers.get(PROFILE_HEADER)):
+        profiler.begin(request.endpoint)
+        g.profiling = True
+
+
+@bp.teardown_app_request
+def stop_profiling(exc=None):
+    if g.pop("profiling", False):
+        profiler.end()
+
+
+
 # ===============================
 # HELPERS
 # ===============================
+ACTION_ERROR_HEADER = "X-Action-Error"
+
+
+def flash_error(message):
+    """
+    Flash why an action failed. The response (usually a redirect, which
+    looks the same as a successful one) also carries ACTION_ERROR_HEADER,
+    so clients that never render the next page, like the traffic
+    replayer, can tell the two apart.
+    """
+    flash(message, "error")
+    g.action_error = True
+
+
+@bp.after_app_request
+def mark_action_error(response):
+    if g.get("action_error"):
+        response.headers[ACTION_ERROR_HEADER] = "1"
+    return response
+
 def password_strong(pw):
     if len(pw) < 8:
         return False
@@ -141,7 +575,7 @@ def save_uploaded_file(file, folder):
         file_ext = file.filename.rsplit('.', 1)[1].lower()
         unique_filename = f"{uuid.uuid4().hex}.{file_ext}"
         filename = secure_filename(unique_filename)
-        folder_path = os.path.join(app.config['UPLOAD_FOLDER'], folder)
+        folder_path = os.path.join(current_app.config['UPLOAD_FOLDER'], folder)
 
         # Create subdirectory if it doesn't exist
         os.makedirs(folder_path, exist_ok=True)
@@ -152,61 +586,376 @@ def save_uploaded_file(file, folder):
         return file_path
     return None
 
-def get_current_driver():
+# ===============================
+# IDEMPOTENCY KEYS
+# ===============================
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_FORM_FIELD = "idempotency_key"
+IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60
+
+# HTML forms cannot set headers, so templates embed a fresh key per render
+bp.add_app_template_global(lambda: uuid.uuid4().hex, "idempotency_key")
+
+
+def idempotency_key_hash(key):
     """
-    Return the driver row (joined with user) for the logged-in driver, or None.
+    Hash the client key together with who is calling and which route, so the
+    same key can never replay another user's (or another endpoint's) response.
     """
-    if "user_id" not in session or session.get("role") != "driver":
-        return None
+    scope = f"{session.get('user_id', '')}|{request.endpoint}|{sorted(request.view_args.items())}|{key}"
+    return hashlib.sha256(scope.encode("utf-8")).digest()
 
-    conn = get_db()
+
+def get_idempotency_db(key_hash):
+    """
+    Connection to the database holding key_hash: always the global file,
+    so adding a region never moves a key (and a retry never misses it).
+    """
+    return get_db()
+
+
+def forget_idempotency_key(key_hash):
+    conn = get_idempotency_db(key_hash)
+    conn.execute("DELETE FROM idempotency_keys WHERE key_hash = ?", (key_hash,))
+    conn.commit()
+    conn.close()
+
+
+def reserve_idempotency_key(key_hash):
+    """
+    Reserve key_hash for a first attempt, in one short transaction.
+    Returns (reserved, previous): previous is the stored row of an earlier
+    attempt (status_code is NULL while it is still running), or None.
+    """
+    now = int(time.time())
+    conn = get_idempotency_db(key_hash)
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT
-            u.name,
-            d.id AS driver_id,
-            d.license_number,
-            d.vehicle_info,
-            d.verification_status,
-            COALESCE(ds.is_online, 0) AS is_online
-        FROM drivers d
-        JOIN users u ON d.user_id = u.id
-        LEFT JOIN driver_status ds ON ds.driver_id = d.id
-        WHERE u.id = ?
-    """, (session["user_id"],))
-    driver = cursor.fetchone()
+    try:
+        cursor.execute(
+            "DELETE FROM idempotency_keys WHERE created_at < ?",
+            (now - IDEMPOTENCY_TTL_SECONDS,),
+        )
+        cursor.execute(
+            "INSERT OR IGNORE INTO idempotency_keys (key_hash, created_at) VALUES (?, ?)",
+            (key_hash, now),
+        )
+        reserved = cursor.rowcount == 1
+        conn.commit()
+
+        previous = None
+        if not reserved:
+            cursor.execute(
+                "SELECT status_code, location, content_type, body FROM idempotency_keys WHERE key_hash = ?",
+                (key_hash,),
+            )
+            previous = cursor.fetchone()
+    finally:
+        conn.close()
+    return reserved, previous
+
+
+def store_idempotency_response(key_hash, status_code, location, content_type, body):
+    conn = get_idempotency_db(key_hash)
+    conn.execute(
+        """
+        UPDATE idempotency_keys
+        SET status_code = ?, location = ?, content_type = ?, body = ?
+        WHERE key_hash = ?
+        """,
+        (status_code, location, content_type, body, key_hash),
+    )
+    conn.commit()
     conn.close()
-    return driver
+
+
+def idempotent(view):
+    """
+    Replay the stored response for a repeated Idempotency-Key instead of
+    running the view (and its writes / uploads) again.
+    Requests without a key behave exactly as before.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER) or request.form.get(IDEMPOTENCY_FORM_FIELD)
+        if not key:
+            return view(*args, **kwargs)
+
+        key_hash = idempotency_key_hash(key.strip()[:255])
+
+        # Reserve the key (or find the earlier attempt)
+        reserved, previous = reserve_idempotency_key(key_hash)
+
+        if not reserved:
+            if previous is None or previous["status_code"] is None:
+                # First attempt is still running: ask the client to retry shortly
+                response = Response("A request with this idempotency key is already in progress.", status=409)
+                response.headers["Retry-After"] = "1"
+                return response
+
+            response = Response(
+                previous["body"],
+                status=previous["status_code"],
+                content_type=previous["content_type"],
+            )
+            if previous["location"]:
+                response.headers["Location"] = previous["location"]
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except Exception:
+            forget_idempotency_key(key_hash)
+            raise
+
+        # Server errors and streamed bodies are not worth replaying
+        if response.status_code >= 500 or response.is_streamed:
+            forget_idempotency_key(key_hash)
+            return response
+
+        store_idempotency_response(
+            key_hash,
+            response.status_code,
+            response.headers.get("Location"),
+            response.content_type,
+            response.get_data(),
+        )
+        return response
+
+    return wrapper
+
+
+# ===============================
+# ADMISSION CONTROL (TOKEN BUCKETS + CONCURRENCY CAPS)
+# ===============================
+# State is per worker process. Each gunicorn worker enforces its own budget,
+# which is the point: a worker must not be fully occupied by one burst.
+settings["ADMISSION_CONTROL_ENABLED"] = os.environ.get("ADMISSION_CONTROL", "1") != "0"
+
+# capacity = burst size, refill = tokens per second, concurrency = max in-flight per worker
+ADMISSION_POLICIES = {
+    "auth": {"capacity": 5, "refill": 5 / 60, "concurrency": 4},
+    "upload": {"capacity": 3, "refill": 1 / 60, "concurrency": 2},
+    "write": {"capacity": 10, "refill": 0.5, "concurrency": 8},
+    # One map view pulls a few dozen tiles, and every pan or zoom more
+    "tiles": {"capacity": 600, "refill": 50.0, "concurrency": None},
+    "default": {"capacity": 60, "refill": 5.0, "concurrency": None},
+}
+
+# Fingerprinted assets are files on disk with year-long caching, like /static
+ADMISSION_EXEMPT = {"static", "web.serve_asset"}
+
+ROUTE_POLICIES = {
+    "web.passenger_login_submit": "auth",
+    "web.passenger_register_submit": "auth",
+    "web.driver_register_submit": "upload",
+    "web.passenger_request_ride": "write",
+    "web.confirm_ride": "write",
+    "web.map_tile": "tiles",
+}
+
+ADMISSION_MAX_BUCKETS = 50000
+
+admission_lock = threading.Lock()
+admission_buckets = {}  # (policy, "ip:..." | "user:...") -> [tokens, last_refill_monotonic]
+admission_in_flight = {name: 0 for name in ADMISSION_POLICIES}
+admission_stats = {name: {"admitted": 0, "rate_limited": 0, "over_capacity": 0} for name in ADMISSION_POLICIES}
+
+
+def refill_bucket(policy_name, identity, now):
+    """
+    The bucket for (policy, identity), refilled up to `now`.
+    Caller must hold admission_lock.
+    """
+    policy = ADMISSION_POLICIES[policy_name]
+    bucket = admission_buckets.get((policy_name, identity))
+    if bucket is None:
+        if len(admission_buckets) >= ADMISSION_MAX_BUCKETS:
+            prune_full_buckets(now)
+        bucket = [float(policy["capacity"]), now]
+        admission_buckets[(policy_name, identity)] = bucket
+
+    bucket[0] = min(policy["capacity"], bucket[0] + (now - bucket[1]) * policy["refill"])
+    bucket[1] = now
+    return bucket
+
+
+def prune_full_buckets(now):
+    """
+    Drop buckets that have refilled completely; they carry no information.
+    """
+    for key, (tokens, last) in list(admission_buckets.items()):
+        policy = ADMISSION_POLICIES[key[0]]
+        if tokens + (now - last) * policy["refill"] >= policy["capacity"]:
+            del admission_buckets[key]
+
+
+def reject_request(status, message, retry_after):
+    response = Response(message, status=status, mimetype="text/plain")
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def admit(policy_name, identities):
+    """
+    Admit one request under policy_name, charged to every identity. Returns
+    None when admitted (release it with release_admission), otherwise
+    (status, message, retry_after). A token is only taken when every
+    bucket has one, so a rejected request costs nothing.
+    """
+    policy = ADMISSION_POLICIES[policy_name]
+    now = time.monotonic()
+    with admission_lock:
+        stats = admission_stats[policy_name]
+
+        cap = policy["concurrency"]
+        if cap is not None and admission_in_flight[policy_name] >= cap:
+            stats["over_capacity"] += 1
+            return 503, "Server busy, please retry shortly.", 1
+
+        buckets = [refill_bucket(policy_name, identity, now) for identity in identities]
+        wait = max((1 - tokens) / policy["refill"] if tokens < 1 else 0 for tokens, _ in buckets)
+        if wait:
+            stats["rate_limited"] += 1
+            return 429, "Too many requests, please slow down.", wait
+
+        for bucket in buckets:
+            bucket[0] -= 1
+        stats["admitted"] += 1
+        admission_in_flight[policy_name] += 1
+    return None
+
+
+def release_admission(policy_name):
+    with admission_lock:
+        admission_in_flight[policy_name] -= 1
+
+
+@bp.before_app_request
+def admission_control():
+    if not current_app.config.get("ADMISSION_CONTROL_ENABLED") or request.endpoint is None or request.endpoint in ADMISSION_EXEMPT:
+        return None
+
+    policy_name = ROUTE_POLICIES.get(request.endpoint, "default")
+    identities = [f"ip:{request.remote_addr}"]
+    if session.get("user_id"):
+        identities.append(f"user:{session['user_id']}")
+
+    rejected = admit(policy_name, identities)
+    if rejected:
+        return reject_request(*rejected)
+    g.admission_policy = policy_name
+    return None
+
+
+@bp.teardown_app_request
+def release_admission_slot(exc=None):
+    policy_name = g.pop("admission_policy", None)
+    if policy_name is not None:
+        release_admission(policy_name)
+
 
 # ===============================
 # BASIC ROUTE
 # ===============================
-@app.route("/")
+@bp.route("/")
 def home():
     return render_template("home.html")
 
 
 # Route to serve uploaded files
-@app.route('/uploads/<path:filename>')
+@bp.route('/uploads/<path:filename>')
 def serve_uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+
+
+# ===============================
+# STATIC ASSETS (see assets.py)
+# ===============================
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+asset_manifest = AssetManifest(os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
+
+
+def asset_url(path, cdn=None):
+    """
+    Fingerprinted URL for a file under static/. Falls back to the plain
+    static URL before `python assets.py build` has run, or to `cdn` when a
+    vendored file is missing entirely.
+    """
+    if current_app.debug:
+        asset_manifest.load()  # pick up rebuilds without a restart
+    hashed = asset_manifest.lookup(path)
+    if hashed:
+        return url_for("web.serve_asset", filename=hashed)
+    if cdn and not asset_manifest.exists(path):
+        return cdn
+    return url_for("static", filename=path)
+
+
+bp.add_app_template_global(asset_url)
+
+
+@bp.route("/assets/<path:filename>")
+def serve_asset(filename):
+    served, encoding, mimetype = asset_manifest.variant(filename, request.accept_encodings)
+    response = send_from_directory(asset_manifest.dist_dir, served, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+    # The name changes whenever the content does, so the file never needs revalidating
+    response.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    response.vary.add("Accept-Encoding")
+    response.headers.pop("Content-Disposition", None)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+# ===============================
+# MAP TILES (see tiles.py)
+# ===============================
+TILE_BROWSER_MAX_AGE = 24 * 60 * 60
+tile_cache = TileCache(
+    settings["TILE_CACHE_DIR"],
+    max_bytes=settings["TILE_CACHE_MAX_MB"] * 1024 * 1024,
+    upstream=settings["TILE_UPSTREAM_URL"],
+)
+
+# Leaflet URL template for the proxied tiles
+
+
+@bp.route("/tiles/<int:z>/<int:x>/<int:y>.png")
+def map_tile(z, x, y):
+    if not valid_tile(z, x, y):
+        return "Tile not found", 404
+    try:
+        meta, body = tile_cache.get(z, x, y)
+    except TileError as e:
+        return f"Tile unavailable: {e}", 502
+
+    # Pass the upstream ETag through, so browsers revalidate against it
+    etag, weak = unquote_etag(meta["etag"])
+    if etag and request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype=meta["content_type"])
+    response.set_etag(etag, weak=weak)
+    response.headers["Cache-Control"] = f"public, max-age={TILE_BROWSER_MAX_AGE}"
+    return response
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     session.clear()
     flash("You have been logged out.")
-    return redirect(url_for("home"))
+    return redirect(url_for("web.home"))
 
 # ============================================================
 # STORY 1 — PASSENGER REGISTRATION & LOGIN (YOUR PART)
 # ============================================================
 
-@app.route("/passenger/register", methods=["GET"])
+@bp.route("/passenger/register", methods=["GET"])
 def passenger_register_page():
     return render_template("passenger_register.html")
 
 
-@app.route("/passenger/register", methods=["POST"])
+@bp.route("/passenger/register", methods=["POST"])
 def passenger_register_submit():
     name = request.form.get("name", "").strip()
     email = request.form.get("email", "").strip().lower()
@@ -215,18 +964,18 @@ def passenger_register_submit():
 
     # Validate required fields
     if not all([name, email, phone, password]):
-        flash("All fields are required.")
-        return redirect(url_for("passenger_register_page"))
+        flash_error("All fields are required.")
+        return redirect(url_for("web.passenger_register_page"))
 
     # Password strength
     if not password_strong(password):
-        flash("Weak password. Password must be at least 8 characters and include a digit and a symbol.")
-        return redirect(url_for("passenger_register_page"))
+        flash_error("Weak password. Password must be at least 8 characters and include a digit and a symbol.")
+        return redirect(url_for("web.passenger_register_page"))
 
     # Unique email / phone
     if email_or_phone_exists(email, phone):
-        flash("Email or phone number already registered.")
-        return redirect(url_for("passenger_register_page"))
+        flash_error("Email or phone number already registered.")
+        return redirect(url_for("web.passenger_register_page"))
 
     pw_hash = generate_password_hash(password)
 
@@ -244,16 +993,16 @@ def passenger_register_submit():
     session["user_id"] = user_id
     session["role"] = "passenger"
 
-    return redirect(url_for("home"))
+    return redirect(url_for("web.home"))
 
 
 
-@app.route("/passenger/login", methods=["GET"])
+@bp.route("/passenger/login", methods=["GET"])
 def passenger_login_page():
     return render_template("passenger_login.html")
 
 
-@app.route("/passenger/login", methods=["POST"])
+@bp.route("/passenger/login", methods=["POST"])
 def passenger_login_submit():
     email = request.form.get("email", "").strip().lower()
     password = request.form.get("password", "")
@@ -268,8 +1017,8 @@ def passenger_login_submit():
 
     # Invalid email or password
     if user is None or not check_password_hash(user["password_hash"], password):
-        flash("Invalid email or password.")
-        return redirect(url_for("passenger_login_page"))
+        flash_error("Invalid email or password.")
+        return redirect(url_for("web.passenger_login_page"))
 
         # Save session
     session["user_id"] = user["id"]
@@ -277,19 +1026,40 @@ def passenger_login_submit():
 
     # Redirect by role
     if user["role"] == "admin":
-        return redirect(url_for("admin_drivers_list"))
+        return redirect(url_for("web.admin_drivers_list"))
     elif user["role"] == "driver":
-        return redirect(url_for("driver_dashboard"))
+        return redirect(url_for("web.driver_dashboard"))
     else:  # passenger
-        return redirect(url_for("passenger_dashboard"))
+        return redirect(url_for("web.passenger_dashboard"))
+
+
+def find_active_ride(passenger_id):
+    """
+    The passenger's most recent waiting / accepted / picked-up ride, in any region.
+    """
+    rides = shard_map.fanout(
+        """
+        SELECT id, created_at
+        FROM rides
+        WHERE passenger_id = ?
+          AND status IN ('waiting', 'accepted', 'picked_up')
+        ORDER BY created_at DESC
+        LIMIT 1
+        """,
+        (passenger_id,),
+        key=lambda r: r["created_at"],
+        reverse=True,
+        limit=1,
+    )
+    return rides[0] if rides else None
 
 
-@app.route("/passenger/dashboard", methods=["GET", "POST"])
+@bp.route("/passenger/dashboard", methods=["GET", "POST"])
 def passenger_dashboard():
     # Must be logged in as a passenger
     if "user_id" not in session or session.get("role") != "passenger":
-        flash("Please log in as a passenger to access your dashboard.")
-        return redirect(url_for("passenger_login_page"))
+        flash_error("Please log in as a passenger to access your dashboard.")
+        return redirect(url_for("web.passenger_login_page"))
 
     conn = get_db()
     cursor = conn.cursor()
@@ -297,23 +1067,13 @@ def passenger_dashboard():
     # Get passenger info
     cursor.execute("SELECT name, email FROM users WHERE id = ?", (session["user_id"],))
     passenger = cursor.fetchone()
+    conn.close()
 
     # Check if passenger already has an active ride
-    cursor.execute(
-        """
-        SELECT id
-        FROM rides
-        WHERE passenger_id = ?
-          AND status IN ('waiting', 'accepted', 'picked_up')
-        ORDER BY created_at DESC
-        LIMIT 1
-        """,
-        (session["user_id"],),
-    )
-    active_ride = cursor.fetchone()
+    active_ride = find_active_ride(session["user_id"])
 
-    # Fetch recent completed / cancelled rides for history
-    cursor.execute(
+    # Fetch recent completed / cancelled rides for history (from every region)
+    recent_rides = shard_map.fanout(
         """
         SELECT
             r.*,
@@ -327,14 +1087,14 @@ def passenger_dashboard():
         LIMIT 5
         """,
         (session["user_id"],),
+        key=lambda r: r["created_at"],
+        reverse=True,
+        limit=5,
     )
-    recent_rides = cursor.fetchall()
-
-    conn.close()
 
     if active_ride:
         # Redirect to waiting / status page if they already have a ride
-        return redirect(url_for("wait_driver", ride_id=active_ride["id"]))
+        return redirect(url_for("web.wait_driver", ride_id=active_ride["id"]))
 
     return render_template(
         "passenger_dashboard.html",
@@ -346,62 +1106,66 @@ def passenger_dashboard():
 
 
 # ============================================================
-# SPRINT 2 - TASK 1: Passenger Ride Request Form
+# ADDRESS AUTOCOMPLETE (LOCAL GAZETTEER)
 # ============================================================
 
-@app.route("/passenger/request-ride", methods=["POST"])
-def passenger_request_ride():
-    # Must be logged in as a passenger
-    if "user_id" not in session or session.get("role") != "passenger":
-        flash("Please log in as a passenger to request a ride.")
-        return redirect(url_for("passenger_login_page"))
+@bp.route("/places/autocomplete", methods=["GET"])
+def places_autocomplete():
+    q = request.args.get("q", "").strip()
+    limit = max(1, min(request.args.get("limit", 5, type=int), 10))
 
-    conn = get_db()
-    cursor = conn.cursor()
+    results = []
+    if len(q) >= 2:
+        results = list(get_gazetteer(current_app.config["GAZETTEER_PATH"]).autocomplete(q, limit))
 
-    # Do not allow a new request if passenger already has an active ride
-    cursor.execute(
-        """
-        SELECT id
-        FROM rides
-        WHERE passenger_id = ?
-          AND status IN ('waiting', 'accepted', 'picked_up')
-        ORDER BY created_at DESC
-        LIMIT 1
-        """,
-        (session["user_id"],),
-    )
-    existing = cursor.fetchone()
-    if existing:
-        conn.close()
-        flash("You already have an active ride. You must finish or cancel it before requesting another.")
-        return redirect(url_for("wait_driver", ride_id=existing["id"]))
+    response = current_app.json.response({"query": q, "results": results})
+    response.headers["Cache-Control"] = "public, max-age=300"
+    return response
 
-    # Get form data
-    pickup_address = request.form.get("pickup_address", "").strip()
-    dropoff_address = request.form.get("dropoff_address", "").strip()
-    notes = request.form.get("notes", "").strip()
 
-    # Get lat/lng from form (set by Leaflet + Nominatim JS)
-    def parse_float(value):
-        try:
-            if not value:
-                return None
-            return float(value)
-        except ValueError:
+# ============================================================
+# RIDE LIFECYCLE (shared by the HTML views and the JSON API in api.py)
+# ============================================================
+# These take the acting user explicitly and never touch the request,
+# session or flash, so they can also run on api.py's database threads.
+
+class RideActionError(Exception):
+    """
+    A lifecycle step that cannot be carried out. The message is shown to
+    the user; ride_id points at a ride the user should be sent to instead.
+    """
+    def __init__(self, message, status=409, ride_id=None):
+        super().__init__(message)
+        self.status = status
+        self.ride_id = ride_id
+
+
+def parse_coordinate(value):
+    try:
+        if value is None or value == "":
             return None
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
 
-    pickup_lat = parse_float(request.form.get("pickup_lat"))
-    pickup_lng = parse_float(request.form.get("pickup_lng"))
-    dropoff_lat = parse_float(request.form.get("dropoff_lat"))
-    dropoff_lng = parse_float(request.form.get("dropoff_lng"))
+def create_ride(passenger_id, pickup_address, dropoff_address, pickup_lat=None, pickup_lng=None,
+                dropoff_lat=None, dropoff_lng=None, notes="", allow_pool=False):
+    # Do not allow a new request if passenger already has an active ride
+    existing = find_active_ride(passenger_id)
+    if existing:
+        raise RideActionError(
+            "You already have an active ride. You must finish or cancel it before requesting another.",
+            ride_id=existing["id"],
+        )
 
     if not pickup_address or not dropoff_address:
-        conn.close()
-        flash("Please enter both pickup and dropoff addresses.")
-        return redirect(url_for("passenger_dashboard"))
+        raise RideActionError("Please enter both pickup and dropoff addresses.", status=400)
 
+    # The ride is stored in the region of its pickup point
+    conn = get_region_db(pickup_lat, pickup_lng)
     try:
+        cursor = conn.cursor()
         cursor.execute(
             """
             INSERT INTO rides (
@@ -413,12 +1177,13 @@ def passenger_request_ride():
                 dropoff_lat,
                 dropoff_lng,
                 notes,
+                allow_pool,
                 status
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'requested')
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'requested')
             """,
             (
-                session["user_id"],
+                passenger_id,
                 pickup_address,
                 dropoff_address,
                 pickup_lat,
@@ -426,154 +1191,129 @@ def passenger_request_ride():
                 dropoff_lat,
                 dropoff_lng,
                 notes,
+                1 if allow_pool else 0,
             ),
         )
         conn.commit()
-        ride_id = cursor.lastrowid
-
-        flash("Ride request submitted successfully!")
-        return redirect(url_for("fare_estimate", ride_id=ride_id))
-
-    except Exception as e:
-        conn.rollback()
-        flash(f"Error submitting ride request: {str(e)}")
-        return redirect(url_for("passenger_dashboard"))
-
+        return cursor.lastrowid
     finally:
         conn.close()
 
 
-@app.route("/fare-estimate/<int:ride_id>")
-def fare_estimate(ride_id):
-    # Must be logged in as a passenger
-    if "user_id" not in session or session.get("role") != "passenger":
-        flash("Please log in as a passenger.")
-        return redirect(url_for("passenger_login_page"))
-
-    # Get ride from database
-    conn = get_db()
+def quote_ride(ride_id, passenger_id):
+    """
+    Price the passenger's ride and store the quote. Returns (ride, fare_breakdown).
+    """
+    conn = get_ride_db(ride_id)
     cursor = conn.cursor()
     cursor.execute("""
         SELECT r.*, u.name as passenger_name
         FROM rides r
         JOIN users u ON r.passenger_id = u.id
         WHERE r.id = ? AND r.passenger_id = ?
-    """, (ride_id, session["user_id"]))
-    
+    """, (ride_id, passenger_id))
     ride = cursor.fetchone()
     conn.close()
 
     if not ride:
-        flash("Ride not found.")
-        return redirect(url_for("passenger_dashboard"))
-
-    # Calculate fake distance and duration
-    # Calculate distance and duration
-    import math
-
-    # 1) Distance (km)
-    if ride["pickup_lat"] and ride["dropoff_lat"]:
-        # Haversine straight-line distance
-        lat1, lon1 = float(ride["pickup_lat"]), float(ride["pickup_lng"])
-        lat2, lon2 = float(ride["dropoff_lat"]), float(ride["dropoff_lng"])
+        raise RideActionError("Ride not found.", status=404)
 
-        dlat = math.radians(lat2 - lat1)
-        dlon = math.radians(lon2 - lon1)
-        a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-        straight_distance = 6371 * c  # km
+    # 1) Distance (km) and 2) duration (minutes)
+    distance_km, duration_min = estimate_trip(ride)
 
-        # Approximate road distance as ~1.3x straight line, and clamp
-        distance_km = round(max(1.0, min(straight_distance * 1.3, 40.0)), 1)
-    else:
-        # Fallback when we have no coordinates: assume a medium city trip
-        distance_km = 7.0
+    # 3) Fare breakdown – tariff in pricing.py, scaled by the pickup zone's surge
+    surge_multiplier = 1.0
+    if ride["pickup_lat"] and ride["pickup_lng"]:
+        surge_engine.refresh_if_stale(get_db)
+        surge_multiplier = surge_engine.multiplier(ride["pickup_lat"], ride["pickup_lng"])
 
-    # 2) Duration (minutes) – assume ~3 minutes per km + 5 minutes overhead
-    duration_min = round(distance_km * 3 + 5)
+    fare = fare_breakdown(distance_km, duration_min, surge_multiplier)
 
-    # Store estimated time in the database for use on the waiting screen
+    # Store estimated time (waiting screen) and the quoted surge (final fare) in the database
     try:
-        conn = get_db()
+        conn = get_ride_db(ride_id)
         cursor = conn.cursor()
         cursor.execute(
-            "UPDATE rides SET estimated_time_minutes = ? WHERE id = ?",
-            (duration_min, ride_id)
+            "UPDATE rides SET estimated_time_minutes = ?, surge_multiplier = ? WHERE id = ?",
+            (duration_min, surge_multiplier, ride_id)
         )
         conn.commit()
         conn.close()
     except sqlite3.Error as e:
-        print(f"[fare_estimate] Failed to update estimated_time_minutes: {e}")
+        print(f"[quote_ride] Failed to update estimated_time_minutes: {e}")
 
-    # 3) Fare breakdown – more moderate pricing
-    base_fare = 15.0             # starting fee
-    per_km = 5.0                 # per km
-    per_min = 0.3                # per minute in traffic
-    service_fee = 3.0            # fixed platform fee
+    return ride, fare
 
-    distance_charge = distance_km * per_km
-    duration_charge = duration_min * per_min
-    total_fare = round(base_fare + distance_charge + duration_charge + service_fee, 2)
 
-    
-    fare_estimate = {
-        'distance_km': distance_km,
-        'duration_min': duration_min,
-        'base_fare': base_fare,
-        'distance_charge': round(distance_charge, 2),
-        'duration_charge': round(duration_charge, 2),
-        'service_fee': service_fee,
-        'total_fare': total_fare
-    }
-    
-    return render_template("fare_estimate.html", 
-                         ride=ride, 
-                         fare_estimate=fare_estimate)
+def queue_ride(ride_id, passenger_id):
+    """
+    Confirm a quoted ride: it enters the waiting queue drivers see.
+    Confirming an already waiting ride does nothing.
+    """
+    conn = get_ride_db(ride_id)
+    cursor = conn.cursor()
 
+    cursor.execute(
+        """
+        SELECT status, pickup_lat, pickup_lng, dropoff_lat, dropoff_lng, allow_pool, pool_id,
+               CAST(strftime('%s', created_at) AS REAL) AS created_ts
+        FROM rides
+        WHERE id = ? AND passenger_id = ?
+        """,
+        (ride_id, passenger_id),
+    )
+    row = cursor.fetchone()
 
-@app.route("/confirm-ride/<int:ride_id>", methods=["POST"])
-def confirm_ride(ride_id):
-    # Ensure passenger is logged in
-    if "user_id" not in session or session.get("role") != "passenger":
-        flash("Please log in first.")
-        return redirect(url_for("passenger_login_page"))
+    if not row:
+        conn.close()
+        raise RideActionError("Ride not found.", status=404)
 
-    conn = get_db()
-    cursor = conn.cursor()
+    if row["status"] not in ("requested", "waiting"):
+        conn.close()
+        raise RideActionError("This ride can no longer be confirmed.")
 
-    # Update ride status → waiting for driver
+    # Update ride status → waiting for driver, unless it changed since the read
     cursor.execute(
-        "UPDATE rides SET status = 'waiting' WHERE id = ?",
-        (ride_id,)
+        "UPDATE rides SET status = 'waiting' WHERE id = ? AND status = ?",
+        (ride_id, row["status"])
     )
+    if cursor.rowcount == 0:
+        conn.rollback()
+        conn.close()
+        raise RideActionError("This ride can no longer be confirmed.")
+    feed_seq = None
+    writes = core_writes.batch(cursor, ride_id)
+    if row["status"] != "waiting":
+        feed_seq = record_ride_feed_change(cursor, ride_id, "added")
+        surge_engine.ride_queued(writes, row["pickup_lat"], row["pickup_lng"])
+        if row["allow_pool"] and row["pool_id"] is None:
+            partner_id = match_pool_partner(cursor, ride_id, row)
+            if partner_id is not None:
+                # The partner's queue entry now carries the pool id: send it to drivers again
+                feed_seq = record_ride_feed_change(cursor, partner_id, "added")
     conn.commit()
     conn.close()
-
-    # Redirect passenger to waiting screen
-    return redirect(url_for("wait_driver", ride_id=ride_id))
+    writes.submit()
+    publish_ride_feed_version(feed_seq)
 
 
-@app.route("/wait-driver/<int:ride_id>")
-def wait_driver(ride_id):
-    # Passenger must be logged in to view their ride status
-    if "user_id" not in session or session.get("role") != "passenger":
-        flash("Please log in as a passenger to view your ride.")
-        return redirect(url_for("passenger_login_page"))
-
-    conn = get_db()
+def load_ride_details(ride_id, passenger_id):
+    """
+    The passenger's ride and, once one is assigned, its driver. Returns (ride, driver or None).
+    """
+    conn = get_ride_db(ride_id)
     cursor = conn.cursor()
 
     # Get the ride for this passenger
     cursor.execute(
         "SELECT * FROM rides WHERE id = ? AND passenger_id = ?",
-        (ride_id, session["user_id"]),
+        (ride_id, passenger_id),
     )
     ride = cursor.fetchone()
 
     if not ride:
         conn.close()
-        flash("Ride not found.")
-        return redirect(url_for("passenger_dashboard"))
+        raise RideActionError("Ride not found.", status=404)
 
     # Default: no driver info
     driver = None
@@ -595,174 +1335,810 @@ def wait_driver(ride_id):
         driver = cursor.fetchone()
 
     conn.close()
+    return ride, driver
 
-    return render_template("wait_driver.html", ride=ride, driver=driver)
 
-@app.route("/passenger/rides/<int:ride_id>/cancel", methods=["POST"])
-def passenger_cancel_ride(ride_id):
-    # Must be logged in as a passenger
-    if "user_id" not in session or session.get("role") != "passenger":
-        flash("Please log in as a passenger to cancel a ride.")
-        return redirect(url_for("passenger_login_page"))
+def still_busy(cursor, driver_id):
+    """
+    Whether the driver still carries another ride of a shared pool (pooled
+    rides live in the same region database). Call after the status change.
+    """
+    cursor.execute(
+        "SELECT 1 FROM rides WHERE driver_id = ? AND status IN ('accepted', 'picked_up') LIMIT 1",
+        (driver_id,),
+    )
+    return cursor.fetchone() is not None
+
+
+def ride_holds_driver(claim_id, driver_id):
+    """
+    Whether the ride (or shared pool) claim_id still occupies the driver:
+    it is theirs and active, or still waiting (an accept in progress).
+    """
+    conn = get_ride_db(claim_id)
+    try:
+        row = conn.execute(
+            """
+            SELECT 1 FROM rides
+            WHERE (id = ? OR pool_id = ?)
+              AND (status = 'waiting' OR (status IN ('accepted', 'picked_up') AND driver_id = ?))
+            LIMIT 1
+            """,
+            (claim_id, claim_id, driver_id),
+        ).fetchone()
+    finally:
+        conn.close()
+    return row is not None
 
+
+def claim_driver(driver_id, claim_id):
+    """
+    Take the driver's global claim for claim_id (a ride id, or the pool id
+    of a shared ride) before the ride itself is accepted. Rides of
+    different regions commit in different files, so this claim in the
+    global file is what keeps one driver from accepting two of them.
+    Returns False if another ride holds the driver. A claim left behind by
+    a ride that has since finished is taken over.
+    """
+    conn = get_db()
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            """
+            INSERT INTO driver_status (driver_id, is_online)
+            SELECT ?, 0 WHERE NOT EXISTS (SELECT 1 FROM driver_status WHERE driver_id = ?)
+            """,
+            (driver_id, driver_id),
+        )
+        row = conn.execute(
+            "SELECT active_ride_id FROM driver_status WHERE driver_id = ?", (driver_id,)
+        ).fetchone()
+        held = row["active_ride_id"]
+        if held is not None and held != claim_id and ride_holds_driver(held, driver_id):
+            conn.execute("ROLLBACK")
+            return False
+        conn.execute(
+            "UPDATE driver_status SET active_ride_id = ? WHERE driver_id = ?",
+            (claim_id, driver_id),
+        )
+        conn.execute("COMMIT")
+        return True
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def release_claim(driver_id, claim_id):
+    """
+    Give back a claim whose ride was not accepted after all.
+    """
     conn = get_db()
+    conn.execute(
+        "UPDATE driver_status SET active_ride_id = NULL WHERE driver_id = ? AND active_ride_id = ?",
+        (driver_id, claim_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+def release_driver(writes, driver_id, claim_id):
+    """
+    Drop the driver's claim once its ride (or pool) is over, through the
+    ride transaction's core writes. Guarded on claim_id, so a late write
+    never clears the claim of a newer ride.
+    """
+    writes.execute(
+        "UPDATE driver_status SET active_ride_id = NULL WHERE driver_id = ? AND active_ride_id = ?",
+        (driver_id, claim_id),
+    )
+
+
+def cancel_ride_as_passenger(ride_id, passenger_id):
+    conn = get_ride_db(ride_id)
     cursor = conn.cursor()
 
     # Make sure this ride belongs to this passenger
     cursor.execute(
         """
-        SELECT status
+        SELECT status, driver_id, pickup_lat, pickup_lng, pool_id
         FROM rides
         WHERE id = ? AND passenger_id = ?
         """,
-        (ride_id, session["user_id"]),
+        (ride_id, passenger_id),
     )
     ride = cursor.fetchone()
 
     if not ride:
         conn.close()
-        flash("Ride not found.")
-        return redirect(url_for("passenger_dashboard"))
+        raise RideActionError("Ride not found.", status=404)
 
     # Only allow cancellation if the ride is still in an active pre-trip state
     if ride["status"] in ("completed", "cancelled"):
         conn.close()
-        flash("This ride is already finished.")
-        return redirect(url_for("passenger_dashboard"))
+        raise RideActionError("This ride is already finished.")
 
     if ride["status"] == "picked_up":
         conn.close()
-        flash("You cannot cancel a ride after being picked up.")
-        return redirect(url_for("passenger_dashboard"))
+        raise RideActionError("You cannot cancel a ride after being picked up.")
+
+    # Read before the write, so the shard transaction never holds the global file
+    status = None
+    if ride["status"] == "accepted" and ride["driver_id"]:
+        status = get_driver_status(cursor, ride["driver_id"])
 
     cursor.execute(
-        "UPDATE rides SET status = 'cancelled' WHERE id = ?",
-        (ride_id,),
+        "UPDATE rides SET status = 'cancelled' WHERE id = ? AND status = ?",
+        (ride_id, ride["status"]),
     )
+    if cursor.rowcount == 0:
+        conn.rollback()
+        conn.close()
+        raise RideActionError("This ride has just changed, please try again.")
+    feed_seq = None
+    driver_freed = False
+    writes = core_writes.batch(cursor, ride_id)
+    if ride["status"] == "waiting":
+        feed_seq = record_ride_feed_change(cursor, ride_id, "removed")
+        surge_engine.ride_dequeued(writes, ride["pickup_lat"], ride["pickup_lng"])
+    elif ride["status"] == "accepted" and ride["driver_id"]:
+        # The assigned driver is free again, unless the other pool passenger is still aboard
+        driver_freed = not still_busy(cursor, ride["driver_id"])
+        if driver_freed:
+            release_driver(writes, ride["driver_id"], ride["pool_id"] or ride_id)
+        if driver_freed and status and status["is_online"]:
+            surge_engine.driver_idle(writes, status["lat"], status["lng"], 1)
+        enqueue_notification(cursor, ride_id, "ride_cancelled", recipient="driver")
     conn.commit()
     conn.close()
+    writes.submit()
+    publish_ride_feed_version(feed_seq)
+    notifier.wake()
+    if driver_freed:
+        candidate_store.set_busy(ride["driver_id"], False)
 
-    flash("Your ride has been cancelled.")
-    return redirect(url_for("passenger_dashboard"))
 
-    
-# ============================================================
-# STORY 4 — DRIVER REGISTRATION (TASK A - COMPLETE WITH FILE UPLOADS)
-# ============================================================
+def accept_ride(driver, ride_id):
+    """
+    Assign a waiting ride (and the rest of its shared pool) to the driver.
+    Returns the accepted ride ids.
+    """
+    # Ensure driver has no active ride already
+    if find_driver_active_rides(driver["driver_id"]):
+        raise RideActionError("You already have an active ride. Finish it before accepting a new one.")
 
-@app.route("/driver/register", methods=["GET"])
-def driver_register_page():
-    return render_template("driver_register.html")
+    conn = get_ride_db(ride_id)
+    cursor = conn.cursor()
 
+    # Check ride still exists & is waiting
+    cursor.execute("SELECT status, pickup_lat, pickup_lng, pool_id FROM rides WHERE id = ?", (ride_id,))
+    row = cursor.fetchone()
 
-@app.route("/driver/register", methods=["POST"])
-def driver_register_submit():
-    # --------------------
-    # Get Form Data
-    # --------------------
-    name = request.form.get("name", "").strip()
-    email = request.form.get("email", "").strip().lower()
-    phone = request.form.get("phone", "").strip()
-    password = request.form.get("password", "")
-    license_number = request.form.get("license_number", "").strip()
-    vehicle_info = request.form.get("vehicle_info", "").strip()
+    if not row:
+        conn.close()
+        raise RideActionError("Ride not found.", status=404)
 
-    # --------------------
-    # Validation
-    # --------------------
-    if not all([name, email, phone, password, license_number, vehicle_info]):
-        flash("All fields are required.")
-        return redirect("/driver/register")
+    if row["status"] != "waiting":
+        conn.close()
+        raise RideActionError("Ride has already been taken or is not available.")
 
-    if not password_strong(password):
-        flash("Weak password. Must be at least 8 characters with at least one digit and one symbol.")
-        return redirect("/driver/register")
+    # A shared ride is accepted together with every still-waiting ride in its pool
+    rides_to_accept = [row]
+    if row["pool_id"] is not None:
+        cursor.execute(
+            "SELECT id, pickup_lat, pickup_lng FROM rides WHERE pool_id = ? AND status = 'waiting' AND id != ?",
+            (row["pool_id"], ride_id),
+        )
+        rides_to_accept += cursor.fetchall()
+    ride_ids = [ride_id] + [r["id"] for r in rides_to_accept[1:]]
 
-    if email_or_phone_exists(email, phone):
-        flash("Email or phone number already registered.")
-        return redirect("/driver/register")
+    # Claim the driver in the global file first: rides in other regions
+    # commit elsewhere, so only this claim sees them
+    claim_id = row["pool_id"] or ride_id
+    if not claim_driver(driver["driver_id"], claim_id):
+        conn.close()
+        raise RideActionError("You already have an active ride. Finish it before accepting a new one.")
 
-    # Check if files were uploaded
-    if 'id_document' not in request.files or 'license_document' not in request.files or 'vehicle_document' not in request.files:
-        flash("Please upload all required documents.")
-        return redirect("/driver/register")
+    # Mark as accepted and assign this driver. Guarded on the status, so of
+    # two drivers accepting at once only the first one gets the ride.
+    try:
+        feed_seq = None
+        writes = core_writes.batch(cursor, ride_id)
+        accepted_ids = []
+        for accept_id, accept_row in zip(ride_ids, rides_to_accept):
+            cursor.execute(
+                """
+                UPDATE rides SET status = 'accepted', driver_id = ?, accepted_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'waiting'
+                """,
+                (driver["driver_id"], accept_id),
+            )
+            if cursor.rowcount == 0:
+                if accept_id == ride_id:
+                    raise RideActionError("Ride has already been taken or is not available.")
+                continue    # a pool partner that was cancelled meanwhile
+            accepted_ids.append(accept_id)
+            feed_seq = record_ride_feed_change(cursor, accept_id, "removed")
+            surge_engine.ride_dequeued(writes, accept_row["pickup_lat"], accept_row["pickup_lng"])
+            enqueue_notification(cursor, accept_id, "driver_accepted")
+        if driver["is_online"]:
+            surge_engine.driver_idle(writes, driver["lat"], driver["lng"], -1)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        release_claim(driver["driver_id"], claim_id)
+        raise
+    finally:
+        conn.close()
+    writes.submit()
+    publish_ride_feed_version(feed_seq)
+    candidate_store.set_busy(driver["driver_id"], True)
+    notifier.wake()
+    return accepted_ids
 
-    id_document = request.files['id_document']
-    license_document = request.files['license_document']
-    vehicle_document = request.files['vehicle_document']
 
-    if id_document.filename == '' or license_document.filename == '' or vehicle_document.filename == '':
-        flash("Please select all required documents.")
-        return redirect("/driver/register")
+def reject_ride(ride_id):
+    conn = get_ride_db(ride_id)
+    cursor = conn.cursor()
 
-    # --------------------
-    # Save uploaded files
-    # --------------------
-    id_doc_path = save_uploaded_file(id_document, 'id_documents')
-    license_doc_path = save_uploaded_file(license_document, 'license_documents')
-    vehicle_doc_path = save_uploaded_file(vehicle_document, 'vehicle_documents')
+    cursor.execute("SELECT status, pickup_lat, pickup_lng FROM rides WHERE id = ?", (ride_id,))
+    row = cursor.fetchone()
 
-    if not all([id_doc_path, license_doc_path, vehicle_doc_path]):
-        flash("Invalid file type. Allowed formats: PDF, PNG, JPG, JPEG")
-        return redirect("/driver/register")
+    if not row:
+        conn.close()
+        raise RideActionError("Ride not found.", status=404)
 
-    pw_hash = generate_password_hash(password)
+    if row["status"] != "waiting":
+        conn.close()
+        raise RideActionError("Ride is no longer available.")
 
-    conn = get_db()
-    cursor = conn.cursor()
+    cursor.execute("UPDATE rides SET status = 'cancelled' WHERE id = ? AND status = 'waiting'", (ride_id,))
+    if cursor.rowcount == 0:
+        conn.rollback()
+        conn.close()
+        raise RideActionError("Ride is no longer available.")
+    feed_seq = record_ride_feed_change(cursor, ride_id, "removed")
+    writes = core_writes.batch(cursor, ride_id)
+    surge_engine.ride_dequeued(writes, row["pickup_lat"], row["pickup_lng"])
+    enqueue_notification(cursor, ride_id, "ride_cancelled")
+    conn.commit()
+    conn.close()
+    writes.submit()
+    publish_ride_feed_version(feed_seq)
+    notifier.wake()
 
-    try:
-        # --------------------
-        # Insert into users table
-        # --------------------
-        cursor.execute("""
-                       INSERT INTO users (name, email, phone, password_hash, role)
-                       VALUES (?, ?, ?, ?, 'driver')
-                       """, (name, email, phone, pw_hash))
 
-        user_id = cursor.lastrowid
+def cancel_ride_as_driver(driver, ride_id):
+    conn = get_ride_db(ride_id)
+    cursor = conn.cursor()
 
-        # --------------------
-        # Insert into drivers table WITH FILE PATHS
-        # --------------------
-        cursor.execute("""
-                       INSERT INTO drivers (user_id, license_number, vehicle_info,
-                                            id_doc_path, license_doc_path, vehicle_doc_path,
-                                            verification_status)
-                       VALUES (?, ?, ?, ?, ?, ?, 'pending')
-                       """, (user_id, license_number, vehicle_info,
-                             id_doc_path, license_doc_path, vehicle_doc_path))
+    cursor.execute(
+        """
+        SELECT status, pool_id
+        FROM rides
+        WHERE id = ? AND driver_id = ?
+        """,
+        (ride_id, driver["driver_id"]),
+    )
+    ride = cursor.fetchone()
 
-        conn.commit()
+    if not ride:
+        conn.close()
+        raise RideActionError("Ride not found or not assigned to you.", status=404)
 
-        flash("Driver registration submitted successfully! Waiting for admin approval.")
-        return redirect("/")
+    if ride["status"] not in ("accepted", "picked_up"):
+        conn.close()
+        raise RideActionError("Ride is no longer active.")
 
-    except Exception as e:
+    cursor.execute(
+        "UPDATE rides SET status = 'cancelled' WHERE id = ? AND driver_id = ? AND status = ?",
+        (ride_id, driver["driver_id"], ride["status"]),
+    )
+    if cursor.rowcount == 0:
         conn.rollback()
-        # Clean up uploaded files if database operation fails
-        for file_path in [id_doc_path, license_doc_path, vehicle_doc_path]:
-            if file_path and os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], file_path)):
-                os.remove(os.path.join(app.config['UPLOAD_FOLDER'], file_path))
-        flash(f"Registration failed: {str(e)}")
-        return redirect("/driver/register")
-
-    finally:
         conn.close()
+        raise RideActionError("Ride is no longer active.")
+    driver_freed = not still_busy(cursor, driver["driver_id"])
+    writes = core_writes.batch(cursor, ride_id)
+    if driver_freed:
+        release_driver(writes, driver["driver_id"], ride["pool_id"] or ride_id)
+    if driver_freed and driver["is_online"]:
+        surge_engine.driver_idle(writes, driver["lat"], driver["lng"], 1)
+    enqueue_notification(cursor, ride_id, "ride_cancelled")
+    conn.commit()
+    conn.close()
+    writes.submit()
+    if driver_freed:
+        candidate_store.set_busy(driver["driver_id"], False)
+    notifier.wake()
 
 
-# ============================================================
-# STORY 4 — ADMIN APPROVAL (TASK B - COMPLETE IMPLEMENTATION)
-# ============================================================
-
-@app.route("/admin/drivers", methods=["GET"])
-def admin_drivers_list():
-    # Only admins can access this page
-    if session.get("role") != "admin":
-        return render_template("access_denied.html"), 403
-
-    conn = get_db()
-    cursor = conn.cursor()
+def mark_arrived(driver, ride_id):
+    """
+    The driver is waiting at the pickup: tell the passenger, once.
+    """
+    conn = get_ride_db(ride_id)
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        UPDATE rides SET arrived_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND driver_id = ? AND status = 'accepted' AND arrived_at IS NULL
+        """,
+        (ride_id, driver["driver_id"]),
+    )
+    if cursor.rowcount == 0:
+        conn.rollback()
+        conn.close()
+        raise RideActionError("Ride is not waiting for pickup.")
+    enqueue_notification(cursor, ride_id, "driver_arrived")
+    conn.commit()
+    conn.close()
+    notifier.wake()
+
+
+def mark_picked_up(driver, ride_id):
+    conn = get_ride_db(ride_id)
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT status
+        FROM rides
+        WHERE id = ? AND driver_id = ?
+        """,
+        (ride_id, driver["driver_id"]),
+    )
+    ride = cursor.fetchone()
+
+    if not ride:
+        conn.close()
+        raise RideActionError("Ride not found or not assigned to you.", status=404)
+
+    if ride["status"] != "accepted":
+        conn.close()
+        raise RideActionError("Ride is not in 'accepted' state.")
+
+    cursor.execute(
+        "UPDATE rides SET status = 'picked_up', picked_up_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'accepted'",
+        (ride_id,),
+    )
+    if cursor.rowcount == 0:
+        conn.rollback()
+        conn.close()
+        raise RideActionError("Ride is not in 'accepted' state.")
+    enqueue_notification(cursor, ride_id, "picked_up")
+    conn.commit()
+    conn.close()
+    notifier.wake()
+
+
+def observe_trip(cursor, pickup_zone, dropoff_zone, hour, minutes):
+    """
+    ETA model update, the "eta_observe" core write (see CoreWriteBatch).
+    Returns the in-memory update to apply once the global write commits.
+    """
+    try:
+        updates = eta_model.observe(cursor, pickup_zone, dropoff_zone, hour, minutes)
+    except sqlite3.Error as e:
+        print(f"[complete_ride] ETA model update failed: {e}")
+        return None
+    return functools.partial(eta_model.apply, updates)
+
+
+def complete_ride(driver, ride_id):
+    """
+    Finish the trip and charge it. Returns (final_fare, final_distance_km).
+    """
+    conn = get_ride_db(ride_id)
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT
+            status,
+            pickup_lat,
+            pickup_lng,
+            dropoff_lat,
+            dropoff_lng,
+            surge_multiplier,
+            picked_up_at,
+            pool_id,
+            (julianday('now') - julianday(COALESCE(picked_up_at, accepted_at))) * 1440 AS trip_minutes
+        FROM rides
+        WHERE id = ? AND driver_id = ?
+        """,
+        (ride_id, driver["driver_id"]),
+    )
+    ride = cursor.fetchone()
+
+    if not ride:
+        conn.close()
+        raise RideActionError("Ride not found or not assigned to you.", status=404)
+
+    if ride["status"] not in ("accepted", "picked_up"):
+        conn.close()
+        raise RideActionError("Ride is not active.")
+
+    # Charge for the distance actually driven when the trip was traced
+    cursor.execute("SELECT points, distance_km FROM ride_traces WHERE ride_id = ?", (ride_id,))
+    trace = cursor.fetchone()
+    if trace and trace["points"] >= 2 and ride["trip_minutes"] is not None:
+        final_distance_km = round(trace["distance_km"], 2)
+        final_minutes = ride["trip_minutes"]
+    else:
+        final_distance_km, final_minutes = estimate_trip(ride)
+    final_fare = fare_breakdown(final_distance_km, round(final_minutes), ride["surge_multiplier"] or 1.0)["total_fare"]
+
+    cursor.execute(
+        """
+        UPDATE rides
+        SET status = 'completed', completed_at = CURRENT_TIMESTAMP, final_distance_km = ?, final_fare = ?
+        WHERE id = ? AND status = ?
+        """,
+        (final_distance_km, final_fare, ride_id, ride["status"]),
+    )
+    if cursor.rowcount == 0:
+        conn.rollback()
+        conn.close()
+        raise RideActionError("Ride is not active.")
+
+    # The driver is now at the dropoff, and available again once the last
+    # passenger of a shared pool is dropped off
+    writes = core_writes.batch(cursor, ride_id)
+    if ride["dropoff_lat"] is not None and ride["dropoff_lng"] is not None:
+        writes.execute(
+            "UPDATE driver_status SET lat = ?, lng = ? WHERE driver_id = ?",
+            (ride["dropoff_lat"], ride["dropoff_lng"], driver["driver_id"]),
+        )
+        idle_lat, idle_lng = ride["dropoff_lat"], ride["dropoff_lng"]
+    else:
+        idle_lat, idle_lng = driver["lat"], driver["lng"]
+    driver_freed = not still_busy(cursor, driver["driver_id"])
+    if driver_freed:
+        release_driver(writes, driver["driver_id"], ride["pool_id"] or ride_id)
+    if driver_freed and driver["is_online"]:
+        surge_engine.driver_idle(writes, idle_lat, idle_lng, 1)
+
+    # Feed the ETA model with the rest of the global writes. Without a pickup
+    # time, trip_minutes also covers the drive to the pickup.
+    if ride["picked_up_at"] is not None:
+        writes.call(
+            "eta_observe",
+            zone_of(ride["pickup_lat"], ride["pickup_lng"]),
+            zone_of(ride["dropoff_lat"], ride["dropoff_lng"]),
+            hour_of_week(time.time() - ride["trip_minutes"] * 60),
+            ride["trip_minutes"],
+        )
+
+    enqueue_notification(cursor, ride_id, "ride_completed")
+
+    conn.commit()
+    conn.close()
+    writes.submit()
+    if driver_freed:
+        candidate_store.set_busy(driver["driver_id"], False, idle_lat, idle_lng)
+    notifier.wake()
+    return final_fare, final_distance_km
+
+
+# ============================================================
+# SPRINT 2 - TASK 1: Passenger Ride Request Form
+# ============================================================
+
+@bp.route("/passenger/request-ride", methods=["POST"])
+@idempotent
+def passenger_request_ride():
+    # Must be logged in as a passenger
+    if "user_id" not in session or session.get("role") != "passenger":
+        flash_error("Please log in as a passenger to request a ride.")
+        return redirect(url_for("web.passenger_login_page"))
+
+    try:
+        ride_id = create_ride(
+            session["user_id"],
+            request.form.get("pickup_address", "").strip(),
+            request.form.get("dropoff_address", "").strip(),
+            # lat/lng are set by Leaflet + Nominatim JS
+            parse_coordinate(request.form.get("pickup_lat")),
+            parse_coordinate(request.form.get("pickup_lng")),
+            parse_coordinate(request.form.get("dropoff_lat")),
+            parse_coordinate(request.form.get("dropoff_lng")),
+            request.form.get("notes", "").strip(),
+            bool(request.form.get("allow_pool")),
+        )
+    except RideActionError as e:
+        flash_error(str(e))
+        if e.ride_id:
+            return redirect(url_for("web.wait_driver", ride_id=e.ride_id))
+        return redirect(url_for("web.passenger_dashboard"))
+    except Exception as e:
+        flash_error(f"Error submitting ride request: {str(e)}")
+        return redirect(url_for("web.passenger_dashboard"))
+
+    flash("Ride request submitted successfully!")
+    return redirect(url_for("web.fare_estimate", ride_id=ride_id))
+
+
+def estimate_trip(ride):
+    """
+    Return (distance_km, duration_min) for a ride row.
+    Uses the road graph when one is installed and both ends snap to it,
+    otherwise the straight-line approximation.
+    """
+    if ride["pickup_lat"] and ride["dropoff_lat"]:
+        lat1, lon1 = float(ride["pickup_lat"]), float(ride["pickup_lng"])
+        lat2, lon2 = float(ride["dropoff_lat"]), float(ride["dropoff_lng"])
+
+        graph = get_road_graph(current_app.config["ROAD_GRAPH_PATH"])
+        route = graph.route_between(lat1, lon1, lat2, lon2) if graph else None
+
+        # Learned duration for this zone pair / hour, once enough trips are in
+        eta_model.refresh_if_stale(get_db)
+        learned = eta_model.estimate(zone_of(lat1, lon1), zone_of(lat2, lon2), hour_of_week())
+
+        if route is not None:
+            distance_km = round(max(1.0, route["distance_km"]), 1)
+            duration = learned[0] if learned else route["duration_min"]
+            return distance_km, max(1, round(duration))
+
+        # Approximate road distance from the straight line
+        distance_km, duration_min = straight_line_trip(lat1, lon1, lat2, lon2)
+        if learned:
+            return distance_km, max(1, round(learned[0]))
+        return distance_km, duration_min
+    else:
+        # Fallback when we have no coordinates: assume a medium city trip
+        distance_km = 7.0
+
+    # Assume ~3 minutes per km + 5 minutes overhead
+    return distance_km, round(distance_km * 3 + 5)
+
+
+@bp.route("/fare-estimate/<int:ride_id>")
+def fare_estimate(ride_id):
+    # Must be logged in as a passenger
+    if "user_id" not in session or session.get("role") != "passenger":
+        flash_error("Please log in as a passenger.")
+        return redirect(url_for("web.passenger_login_page"))
+
+    try:
+        ride, fare_estimate = quote_ride(ride_id, session["user_id"])
+    except RideActionError as e:
+        flash_error(str(e))
+        return redirect(url_for("web.passenger_dashboard"))
+
+    return render_template("fare_estimate.html", 
+                         ride=ride, 
+                         fare_estimate=fare_estimate)
+
+
+@bp.route("/confirm-ride/<int:ride_id>", methods=["POST"])
+@idempotent
+def confirm_ride(ride_id):
+    # Ensure passenger is logged in
+    if "user_id" not in session or session.get("role") != "passenger":
+        flash_error("Please log in first.")
+        return redirect(url_for("web.passenger_login_page"))
+
+    try:
+        queue_ride(ride_id, session["user_id"])
+    except RideActionError as e:
+        flash_error(str(e))
+        return redirect(url_for("web.passenger_dashboard"))
+
+    # Redirect passenger to waiting screen
+    return redirect(url_for("web.wait_driver", ride_id=ride_id))
+
+
+def match_pool_partner(cursor, ride_id, ride):
+    """
+    Pair a newly waiting shared-ride request with the best compatible one
+    already waiting. Candidates are narrowed in SQL (idx_rides_pool_queue)
+    to recent requests with a pickup within MAX_PICKUP_GAP_KM, so the work
+    per confirm does not grow with the ride history or the queue.
+    Returns the partner's ride id, or None.
+    """
+    if None in (ride["pickup_lat"], ride["pickup_lng"], ride["dropoff_lat"], ride["dropoff_lng"]):
+        return None
+
+    request_ = PoolRequest(
+        ride_id, ride["pickup_lat"], ride["pickup_lng"],
+        ride["dropoff_lat"], ride["dropoff_lng"], ride["created_ts"] or time.time(),
+    )
+    # Degrees around the pickup; a degree of longitude shrinks with cos(latitude)
+    box_lat = MAX_POOL_PICKUP_GAP_KM / 111.0
+    box_lng = box_lat / max(math.cos(math.radians(ride["pickup_lat"])), 0.01)
+    cursor.execute(
+        """
+        SELECT id, pickup_lat, pickup_lng, dropoff_lat, dropoff_lng,
+               CAST(strftime('%s', created_at) AS REAL) AS created_ts
+        FROM rides
+        WHERE status = 'waiting'
+          AND allow_pool = 1
+          AND pool_id IS NULL
+          AND id != ?
+          AND created_at >= datetime('now', ?)
+          AND pickup_lat BETWEEN ? AND ?
+          AND pickup_lng BETWEEN ? AND ?
+          AND dropoff_lat IS NOT NULL
+          AND dropoff_lng IS NOT NULL
+        """,
+        (
+            ride_id,
+            f"-{POOL_WINDOW_MINUTES} minutes",
+            ride["pickup_lat"] - box_lat, ride["pickup_lat"] + box_lat,
+            ride["pickup_lng"] - box_lng, ride["pickup_lng"] + box_lng,
+        ),
+    )
+    candidates = [
+        PoolRequest(r["id"], r["pickup_lat"], r["pickup_lng"], r["dropoff_lat"], r["dropoff_lng"], r["created_ts"])
+        for r in cursor.fetchall()
+    ]
+
+    found = best_partner(request_, candidates)
+    if not found:
+        return None
+
+    partner = found[0]
+    pool_id = min(ride_id, partner.ride_id)
+    cursor.execute(
+        "UPDATE rides SET pool_id = ? WHERE id IN (?, ?)",
+        (pool_id, ride_id, partner.ride_id),
+    )
+    return partner.ride_id
+
+
+@bp.route("/wait-driver/<int:ride_id>")
+def wait_driver(ride_id):
+    # Passenger must be logged in to view their ride status
+    if "user_id" not in session or session.get("role") != "passenger":
+        flash_error("Please log in as a passenger to view your ride.")
+        return redirect(url_for("web.passenger_login_page"))
+
+    try:
+        ride, driver = load_ride_details(ride_id, session["user_id"])
+    except RideActionError as e:
+        flash_error(str(e))
+        return redirect(url_for("web.passenger_dashboard"))
+
+    return render_template("wait_driver.html", ride=ride, driver=driver)
+
+@bp.route("/passenger/rides/<int:ride_id>/cancel", methods=["POST"])
+def passenger_cancel_ride(ride_id):
+    # Must be logged in as a passenger
+    if "user_id" not in session or session.get("role") != "passenger":
+        flash_error("Please log in as a passenger to cancel a ride.")
+        return redirect(url_for("web.passenger_login_page"))
+
+    try:
+        cancel_ride_as_passenger(ride_id, session["user_id"])
+    except RideActionError as e:
+        flash_error(str(e))
+        return redirect(url_for("web.passenger_dashboard"))
+
+    flash("Your ride has been cancelled.")
+    return redirect(url_for("web.passenger_dashboard"))
+
+    
+# ============================================================
+# STORY 4 — DRIVER REGISTRATION (TASK A - COMPLETE WITH FILE UPLOADS)
+# ============================================================
+
+@bp.route("/driver/register", methods=["GET"])
+def driver_register_page():
+    return render_template("driver_register.html")
+
+
+@bp.route("/driver/register", methods=["POST"])
+@idempotent
+def driver_register_submit():
+    # --------------------
+    # Get Form Data
+    # --------------------
+    name = request.form.get("name", "").strip()
+    email = request.form.get("email", "").strip().lower()
+    phone = request.form.get("phone", "").strip()
+    password = request.form.get("password", "")
+    license_number = request.form.get("license_number", "").strip()
+    vehicle_info = request.form.get("vehicle_info", "").strip()
+
+    # --------------------
+    # Validation
+    # --------------------
+    if not all([name, email, phone, password, license_number, vehicle_info]):
+        flash_error("All fields are required.")
+        return redirect("/driver/register")
+
+    if not password_strong(password):
+        flash_error("Weak password. Must be at least 8 characters with at least one digit and one symbol.")
+        return redirect("/driver/register")
+
+    if email_or_phone_exists(email, phone):
+        flash_error("Email or phone number already registered.")
+        return redirect("/driver/register")
+
+    # Check if files were uploaded
+    if 'id_document' not in request.files or 'license_document' not in request.files or 'vehicle_document' not in request.files:
+        flash_error("Please upload all required documents.")
+        return redirect("/driver/register")
+
+    id_document = request.files['id_document']
+    license_document = request.files['license_document']
+    vehicle_document = request.files['vehicle_document']
+
+    if id_document.filename == '' or license_document.filename == '' or vehicle_document.filename == '':
+        flash_error("Please select all required documents.")
+        return redirect("/driver/register")
+
+    # --------------------
+    # Save uploaded files
+    # --------------------
+    id_doc_path = save_uploaded_file(id_document, 'id_documents')
+    license_doc_path = save_uploaded_file(license_document, 'license_documents')
+    vehicle_doc_path = save_uploaded_file(vehicle_document, 'vehicle_documents')
+
+    if not all([id_doc_path, license_doc_path, vehicle_doc_path]):
+        flash_error("Invalid file type. Allowed formats: PDF, PNG, JPG, JPEG")
+        return redirect("/driver/register")
+
+    pw_hash = generate_password_hash(password)
+
+    conn = get_db()
+    cursor = conn.cursor()
+
+    try:
+        # --------------------
+        # Insert into users table
+        # --------------------
+        cursor.execute("""
+                       INSERT INTO users (name, email, phone, password_hash, role)
+                       VALUES (?, ?, ?, ?, 'driver')
+                       """, (name, email, phone, pw_hash))
+
+        user_id = cursor.lastrowid
+
+        # --------------------
+        # Insert into drivers table WITH FILE PATHS
+        # --------------------
+        cursor.execute("""
+                       INSERT INTO drivers (user_id, license_number, vehicle_info,
+                                            id_doc_path, license_doc_path, vehicle_doc_path,
+                                            verification_status)
+                       VALUES (?, ?, ?, ?, ?, ?, 'pending')
+                       """, (user_id, license_number, vehicle_info,
+                             id_doc_path, license_doc_path, vehicle_doc_path))
+
+        conn.commit()
+
+        flash("Driver registration submitted successfully! Waiting for admin approval.")
+        return redirect("/")
+
+    except Exception as e:
+        conn.rollback()
+        # Clean up uploaded files if database operation fails
+        for file_path in [id_doc_path, license_doc_path, vehicle_doc_path]:
+            if file_path and os.path.exists(os.path.join(current_app.config['UPLOAD_FOLDER'], file_path)):
+                os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], file_path))
+        flash_error(f"Registration failed: {str(e)}")
+        return redirect("/driver/register")
+
+    finally:
+        conn.close()
+
+
+# ============================================================
+# STORY 4 — ADMIN APPROVAL (TASK B - COMPLETE IMPLEMENTATION)
+# ============================================================
+
+@bp.route("/admin/drivers", methods=["GET"])
+def admin_drivers_list():
+    # Only admins can access this page
+    if session.get("role") != "admin":
+        return render_template("access_denied.html"), 403
+
+    conn = get_db()
+    cursor = conn.cursor()
 
     # Pending drivers
     cursor.execute("""
@@ -812,6 +2188,7 @@ def admin_drivers_list():
                    """)
     rejected_drivers = cursor.fetchall()
 
+    drivers_version = data_version(conn, "drivers")
     conn.close()
 
     return render_template(
@@ -819,10 +2196,11 @@ def admin_drivers_list():
         pending_drivers=pending_drivers,
         approved_drivers=approved_drivers,
         rejected_drivers=rejected_drivers,
+        drivers_version=drivers_version,
     )
 
 
-@app.route("/admin/drivers/<int:driver_id>/approve", methods=["POST"])
+@bp.route("/admin/drivers/<int:driver_id>/approve", methods=["POST"])
 def admin_approve(driver_id):
     if session.get("role") != "admin":
         return render_template("access_denied.html"), 403
@@ -840,75 +2218,398 @@ def admin_approve(driver_id):
         flash(f"Driver #{driver_id} has been approved.")
     except Exception as e:
         conn.rollback()
-        flash(f"Error approving driver: {str(e)}")
+        flash_error(f"Error approving driver: {str(e)}")
     finally:
         conn.close()
 
-    return redirect(url_for("admin_drivers_list"))
+    return redirect(url_for("web.admin_drivers_list"))
 
 
-@app.route("/admin/drivers/<int:driver_id>/reject", methods=["POST"])
+@bp.route("/admin/drivers/<int:driver_id>/reject", methods=["POST"])
 def admin_reject(driver_id):
     if session.get("role") != "admin":
         return render_template("access_denied.html"), 403
 
-    conn = get_db()
-    cursor = conn.cursor()
-
-    try:
-        cursor.execute("""
-                       UPDATE drivers
-                       SET verification_status = 'rejected'
-                       WHERE id = ?
-                       """, (driver_id,))
-        conn.commit()
-        flash(f"Driver #{driver_id} has been rejected.")
-    except Exception as e:
-        conn.rollback()
-        flash(f"Error rejecting driver: {str(e)}")
-    finally:
-        conn.close()
+    conn = get_db()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute("""
+                       UPDATE drivers
+                       SET verification_status = 'rejected'
+                       WHERE id = ?
+                       """, (driver_id,))
+        conn.commit()
+        flash(f"Driver #{driver_id} has been rejected.")
+    except Exception as e:
+        conn.rollback()
+        flash_error(f"Error rejecting driver: {str(e)}")
+    finally:
+        conn.close()
+
+    return redirect(url_for("web.admin_drivers_list"))
+
+
+# ============================================================
+# ADMIN — STREAMING CSV / NDJSON EXPORTS
+# ============================================================
+
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+RIDE_STATUSES = ("requested", "waiting", "accepted", "picked_up", "completed", "cancelled")
+
+
+def iter_query_rows(sql, params=(), chunk_size=EXPORT_CHUNK_SIZE, connect=get_db):
+    """
+    Yield (columns, row) pairs for a query, pulling chunk_size rows at a time
+    with fetchmany so the full result set is never held in memory.
+    The connection is opened lazily and closed when the generator finishes.
+    """
+    conn = connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        columns = [col[0] for col in cursor.description]
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield columns, row
+    finally:
+        conn.close()
+
+
+def encode_export_rows(rows, fmt):
+    """
+    Turn (columns, row) pairs into CSV or NDJSON text chunks.
+    One chunk is produced per row (plus the CSV header).
+    """
+    header_written = False
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    for columns, row in rows:
+        if fmt == "csv":
+            if not header_written:
+                writer.writerow(columns)
+                header_written = True
+            writer.writerow(tuple(row))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        else:
+            yield json.dumps(dict(zip(columns, tuple(row))), default=str) + "\n"
+
+
+def gzip_chunks(chunks, flush_every=64 * 1024):
+    """
+    Incrementally gzip a stream of text chunks, emitting compressed output
+    whenever roughly flush_every bytes of input have been consumed.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+    pending = 0
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        pending += len(data)
+        out = compressor.compress(data)
+        if pending >= flush_every:
+            out += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def batch_chunks(chunks, batch_bytes=64 * 1024):
+    """
+    Group small text chunks into ~batch_bytes pieces so the WSGI server is not
+    asked to write one tiny buffer per row.
+    """
+    parts = []
+    size = 0
+    for chunk in chunks:
+        parts.append(chunk)
+        size += len(chunk)
+        if size >= batch_bytes:
+            yield "".join(parts)
+            parts = []
+            size = 0
+    if parts:
+        yield "".join(parts)
+
+
+def iter_ride_shard_rows(sql, params=()):
+    """
+    iter_query_rows over every ride shard in region order. Region id ranges
+    are ordered, so a query sorted by ride id stays sorted across shards.
+    """
+    for region in shard_map.regions:
+        yield from iter_query_rows(sql, params, connect=functools.partial(shard_map.connect, region))
+
+
+def export_response(sql, params, fmt, basename, rows=None):
+    """
+    Build a streaming Response for an export query. The body is gzipped
+    on the fly when the client advertises gzip in Accept-Encoding.
+    `rows` overrides the default single-database row source.
+    """
+    chunks = encode_export_rows(rows if rows is not None else iter_query_rows(sql, params), fmt)
+    headers = {
+        "Content-Disposition": f"attachment; filename={basename}.{fmt}",
+        "Vary": "Accept-Encoding",
+        "X-Accel-Buffering": "no",
+    }
+
+    if request.accept_encodings["gzip"]:
+        body = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    else:
+        body = batch_chunks(chunks)
+
+    return Response(
+        stream_with_context(body),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers=headers,
+    )
+
+
+@bp.route("/admin/export/rides.<fmt>", methods=["GET"])
+def admin_export_rides(fmt):
+    if session.get("role") != "admin":
+        return render_template("access_denied.html"), 403
+
+    if fmt not in EXPORT_FORMATS:
+        return "Unsupported export format. Use csv or ndjson.", 400
+
+    # Optional filters: ?from=YYYY-MM-DD&to=YYYY-MM-DD&status=completed,cancelled
+    date_from = request.args.get("from", "").strip()
+    date_to = request.args.get("to", "").strip()
+    statuses = [s.strip() for s in request.args.get("status", "").split(",") if s.strip()]
+
+    if any(s not in RIDE_STATUSES for s in statuses):
+        return f"Unknown status. Allowed: {', '.join(RIDE_STATUSES)}", 400
+
+    where = []
+    params = []
+    if date_from:
+        where.append("r.created_at >= ?")
+        params.append(date_from)
+    if date_to:
+        # Inclusive upper bound on the whole day
+        where.append("r.created_at < date(?, '+1 day')")
+        params.append(date_to)
+    if statuses:
+        where.append(f"r.status IN ({', '.join('?' for _ in statuses)})")
+        params.extend(statuses)
+
+    sql = """
+        SELECT
+            r.id,
+            r.passenger_id,
+            r.driver_id,
+            r.status,
+            r.pickup_address,
+            r.dropoff_address,
+            r.pickup_lat,
+            r.pickup_lng,
+            r.dropoff_lat,
+            r.dropoff_lng,
+            r.estimated_time_minutes,
+            r.notes,
+            r.created_at
+        FROM rides r
+    """
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY r.id ASC"
+
+    return export_response(sql, tuple(params), fmt, "rides", rows=iter_ride_shard_rows(sql, tuple(params)))
+
+
+@bp.route("/admin/export/drivers.<fmt>", methods=["GET"])
+def admin_export_drivers(fmt):
+    if session.get("role") != "admin":
+        return render_template("access_denied.html"), 403
+
+    if fmt not in EXPORT_FORMATS:
+        return "Unsupported export format. Use csv or ndjson.", 400
+
+    sql = """
+        SELECT
+            d.id AS driver_id,
+            u.name,
+            u.email,
+            u.phone,
+            d.license_number,
+            d.vehicle_info,
+            d.verification_status,
+            COALESCE(ds.is_online, 0) AS is_online
+        FROM drivers d
+        JOIN users u ON d.user_id = u.id
+        LEFT JOIN driver_status ds ON ds.driver_id = d.id
+        ORDER BY d.id ASC
+    """
+    return export_response(sql, (), fmt, "drivers")
+
+
+# ============================================================
+# ADMIN — ADMISSION CONTROL METRICS
+# ============================================================
+
+@bp.route("/admin/metrics/admission", methods=["GET"])
+def admin_admission_metrics():
+    if session.get("role") != "admin":
+        return render_template("access_denied.html"), 403
+
+    limit = request.args.get("limit", 50, type=int)
+    now = time.monotonic()
+
+    with admission_lock:
+        policies = {}
+        for name, policy in ADMISSION_POLICIES.items():
+            policies[name] = dict(policy, in_flight=admission_in_flight[name], **admission_stats[name])
+
+        # Emptiest buckets first: those are the callers currently being throttled
+        buckets = []
+        for (name, identity), (tokens, last) in admission_buckets.items():
+            policy = ADMISSION_POLICIES[name]
+            current = min(policy["capacity"], tokens + (now - last) * policy["refill"])
+            buckets.append({"policy": name, "identity": identity, "tokens": round(current, 3)})
+        total_buckets = len(buckets)
+
+    buckets.sort(key=lambda b: b["tokens"])
+    return {
+        "pid": os.getpid(),
+        "policies": policies,
+        "routes": ROUTE_POLICIES,
+        "bucket_count": total_buckets,
+        "buckets": buckets[:limit],
+    }
+
+
+@bp.route("/admin/metrics/startup", methods=["GET"])
+def admin_startup_metrics():
+    if session.get("role") != "admin":
+        return render_template("access_denied.html"), 403
+
+    # Under --preload, "pid" is the master that did the work, not this worker
+    return dict(startup_report, worker_pid=os.getpid(), hooks=[name for name, _ in startup_hooks])
+
+
+@bp.route("/admin/metrics/tiles", methods=["GET"])
+def admin_tile_metrics():
+    if session.get("role") != "admin":
+        return render_template("access_denied.html"), 403
+
+    return dict(tile_cache.report(), pid=os.getpid())
+
+
+# ============================================================
+# ADMIN — SAMPLING PROFILER
+# ============================================================
+
+@bp.route("/admin/profiler", methods=["GET"])
+def admin_profiler_status():
+    if session.get("role") != "admin":
+        return render_template("access_denied.html"), 403
+
+    return dict(profiler.report(), pid=os.getpid(), header=PROFILE_HEADER)
+
+
+@bp.route("/admin/profiler", methods=["POST"])
+def admin_profiler_configure():
+    """
+    Form fields, all optional: action=start|stop|reset, rate (0-1),
+    routes (comma-separated endpoints), token (empty to disable the header
+    trigger), interval_ms. Applies to the worker that handles this request.
+    """
+    if session.get("role") != "admin":
+        return render_template("access_denied.html"), 403
+
+    if "rate" in request.form:
+        rate = request.form.get("rate", type=float)
+        if rate is None or not 0 <= rate <= 1:
+            return {"error": "rate must be between 0 and 1"}, 400
+        profiler.rate = rate
+    if "routes" in request.form:
+        routes = {r.strip() for r in request.form["routes"].split(",") if r.strip()}
+        unknown = routes - set(current_app.view_functions)
+        if unknown:
+            return {"error": f"unknown endpoints: {', '.join(sorted(unknown))}"}, 400
+        profiler.routes = routes
+    if "token" in request.form:
+        profiler.token = request.form["token"].strip() or None
+    if "interval_ms" in request.form:
+        interval = request.form.get("interval_ms", type=float)
+        if interval is None or not 1 <= interval <= 1000:
+            return {"error": "interval_ms must be between 1 and 1000"}, 400
+        profiler.interval = interval / 1000
+
+    action = request.form.get("action")
+    if action == "start":
+        profiler.start()
+    elif action == "stop":
+        profiler.stop()
+    elif action == "reset":
+        profiler.reset()
+    elif action:
+        return {"error": "action must be start, stop or reset"}, 400
+
+    return dict(profiler.report(), pid=os.getpid(), header=PROFILE_HEADER)
+
+
+@bp.route("/admin/profiler/collapsed", methods=["GET"])
+def admin_profiler_download():
+    """
+    Collapsed stacks for flamegraph.pl / speedscope, optionally for one route.
+    """
+    if session.get("role") != "admin":
+        return render_template("access_denied.html"), 403
 
-    return redirect(url_for("admin_drivers_list"))
+    route = request.args.get("route")
+    name = f"profile-{route or 'all'}-{os.getpid()}-{int(time.time())}.folded"
+    response = Response(profiler.collapsed(route), mimetype="text/plain")
+    response.headers["Content-Disposition"] = f"attachment; filename={secure_filename(name)}"
+    response.headers["Cache-Control"] = "no-store"
+    return response
 
 
 # ============================================================
 # STORY 5 — DRIVER DASHBOARD + TOGGLE (PLACEHOLDER FOR TEAM)
 # ============================================================
 
-@app.route("/driver/dashboard", methods=["GET"])
+@bp.route("/driver/dashboard", methods=["GET"])
 def driver_dashboard():
     # Must be logged in as a driver
     if "user_id" not in session or session.get("role") != "driver":
-        flash("Please log in as a driver to access your dashboard.")
-        return redirect(url_for("passenger_login_page"))
+        flash_error("Please log in as a driver to access your dashboard.")
+        return redirect(url_for("web.passenger_login_page"))
 
     driver = get_current_driver()
     if driver is None:
-        flash("Driver profile not found. Please complete registration.")
-        return redirect(url_for("driver_register_page"))
-
-    conn = get_db()
-    cursor = conn.cursor()
+        flash_error("Driver profile not found. Please complete registration.")
+        return redirect(url_for("web.driver_register_page"))
 
-    # One active ride per driver: accepted or picked_up
-    cursor.execute(
-        """
-        SELECT *
-        FROM rides
-        WHERE driver_id = ?
-          AND status IN ('accepted', 'picked_up')
-        ORDER BY created_at ASC
-        LIMIT 1
-        """,
-        (driver["driver_id"],),
-    )
-    active_ride = cursor.fetchone()
+    # One active ride per driver (or one shared pool): accepted or picked_up
+    active_rides = find_driver_active_rides(driver["driver_id"])
+    active_ride = active_rides[0] if active_rides else None
 
     # Only show waiting requests if no active ride
     ride_requests = []
+    feed_cursor = ""
     if not active_ride:
-        cursor.execute(
+        # Read the cursor before the list so the first poll can only over-report
+        positions = []
+        for region in shard_map.regions:
+            conn = shard_map.connect(region)
+            positions.append(ride_feed_position(conn)[0])
+            conn.close()
+        feed_cursor = format_feed_cursor(positions)
+        ride_requests = shard_map.fanout(
             """
             SELECT
                 id,
@@ -919,16 +2620,18 @@ def driver_dashboard():
                 dropoff_lat,
                 dropoff_lng,
                 estimated_time_minutes,
-                created_at
+                pool_id,
+                created_at,
+                version
             FROM rides
             WHERE status = 'waiting'
             ORDER BY created_at ASC
-            """
+            """,
+            key=lambda r: r["created_at"],
         )
-        ride_requests = cursor.fetchall()
 
     # Fetch recent completed / cancelled rides for this driver
-    cursor.execute(
+    ride_history = shard_map.fanout(
         """
         SELECT
             r.*,
@@ -941,169 +2644,276 @@ def driver_dashboard():
         LIMIT 5
         """,
         (driver["driver_id"],),
+        key=lambda r: r["created_at"],
+        reverse=True,
+        limit=5,
     )
-    ride_history = cursor.fetchall()
-
-    conn.close()
 
     return render_template(
         "driver_dashboard.html",
         driver=driver,
         active_ride=active_ride,
+        active_rides=active_rides,
         ride_requests=ride_requests,
         ride_history=ride_history,
+        feed_cursor=feed_cursor,
     )
 
 
-@app.route("/driver/rides/<int:ride_id>/accept", methods=["POST"])
-def driver_accept_ride(ride_id):
-    if "user_id" not in session or session.get("role") != "driver":
-        flash("Please log in as a driver.")
-        return redirect(url_for("passenger_login_page"))
-
-    driver = get_current_driver()
-    if driver is None:
-        flash("Driver profile not found.")
-        return redirect(url_for("driver_dashboard"))
-
-    conn = get_db()
-    cursor = conn.cursor()
-
-    # Ensure driver has no active ride already
-    cursor.execute(
+def find_driver_active_rides(driver_id):
+    """
+    The driver's accepted / picked-up rides (one, or one shared pool), in any region.
+    """
+    return shard_map.fanout(
         """
-        SELECT id
+        SELECT *
         FROM rides
         WHERE driver_id = ?
           AND status IN ('accepted', 'picked_up')
-        LIMIT 1
+        ORDER BY created_at ASC
         """,
-        (driver["driver_id"],),
+        (driver_id,),
+        key=lambda r: r["created_at"],
     )
-    existing = cursor.fetchone()
-    if existing:
-        conn.close()
-        flash("You already have an active ride. Finish it before accepting a new one.")
-        return redirect(url_for("driver_dashboard"))
-
-    # Check ride still exists & is waiting
-    cursor.execute("SELECT status FROM rides WHERE id = ?", (ride_id,))
-    row = cursor.fetchone()
-
-    if not row:
-        conn.close()
-        flash("Ride not found.")
-        return redirect(url_for("driver_dashboard"))
 
-    if row["status"] != "waiting":
-        conn.close()
-        flash("Ride has already been taken or is not available.")
-        return redirect(url_for("driver_dashboard"))
 
-    # Mark as accepted and assign this driver
+def get_driver_status(cursor, driver_id):
     cursor.execute(
-        "UPDATE rides SET status = 'accepted', driver_id = ? WHERE id = ?",
-        (driver["driver_id"], ride_id),
+        "SELECT is_online, lat, lng FROM driver_status WHERE driver_id = ?",
+        (driver_id,),
     )
-    conn.commit()
-    conn.close()
+    return cursor.fetchone()
 
-    flash(f"Ride #{ride_id} accepted successfully.")
-    return redirect(url_for("driver_dashboard"))
 
+@bp.route("/driver/status", methods=["POST"])
+def driver_toggle_status():
+    if "user_id" not in session or session.get("role") != "driver":
+        flash_error("Please log in as a driver.")
+        return redirect(url_for("web.passenger_login_page"))
 
+    driver = get_current_driver()
+    if driver is None:
+        flash_error("Driver profile not found.")
+        return redirect(url_for("web.driver_dashboard"))
 
+    go_online = request.form.get("online") == "1"
+    if go_online and driver["verification_status"] != "approved":
+        flash_error("Your account must be approved before you can go online.")
+        return redirect(url_for("web.driver_dashboard"))
 
-@app.route("/driver/rides/<int:ride_id>/reject", methods=["POST"])
-def driver_reject_ride(ride_id):
-    if "user_id" not in session or session.get("role") != "driver":
-        flash("Please log in as a driver.")
-        return redirect(url_for("passenger_login_page"))
+    def parse_float(value):
+        try:
+            return float(value) if value else None
+        except ValueError:
+            return None
+
+    # Position from the browser, if shared; otherwise keep the last known one
+    lat = parse_float(request.form.get("lat"))
+    lng = parse_float(request.form.get("lng"))
+    if lat is None or lng is None:
+        lat, lng = driver["lat"], driver["lng"]
+
+    busy = bool(find_driver_active_rides(driver["driver_id"]))
 
     conn = get_db()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT status FROM rides WHERE id = ?", (ride_id,))
-    row = cursor.fetchone()
-
-    if not row:
-        conn.close()
-        flash("Ride not found.")
-        return redirect(url_for("driver_dashboard"))
+    if get_driver_status(cursor, driver["driver_id"]) is None:
+        cursor.execute(
+            "INSERT INTO driver_status (driver_id, is_online, lat, lng) VALUES (?, ?, ?, ?)",
+            (driver["driver_id"], int(go_online), lat, lng),
+        )
+    else:
+        cursor.execute(
+            """
+            UPDATE driver_status
+            SET is_online = ?, lat = ?, lng = ?, last_change = CURRENT_TIMESTAMP
+            WHERE driver_id = ?
+            """,
+            (int(go_online), lat, lng, driver["driver_id"]),
+        )
 
-    if row["status"] != "waiting":
-        conn.close()
-        flash("Ride is no longer available.")
-        return redirect(url_for("driver_dashboard"))
+    # Move this driver's supply between zones / in or out of the idle pool
+    if not busy:
+        if driver["is_online"]:
+            surge_engine.driver_idle(cursor, driver["lat"], driver["lng"], -1)
+        if go_online:
+            surge_engine.driver_idle(cursor, lat, lng, 1)
 
-    cursor.execute("UPDATE rides SET status = 'cancelled' WHERE id = ?", (ride_id,))
     conn.commit()
     conn.close()
+    surge_engine.invalidate()
+
+    if go_online:
+        candidate_store.upsert(driver["driver_id"], lat, lng, busy=busy)
+    else:
+        candidate_store.remove(driver["driver_id"])
+
+    flash("You are now online." if go_online else "You are now offline.")
+    return redirect(url_for("web.driver_dashboard"))
+
+
+@bp.route("/drivers/nearby", methods=["GET"])
+def drivers_nearby():
+    """
+    Idle online drivers around a point, served from the in-memory
+    candidate store. Passengers only see counts and distances.
+    """
+    if "user_id" not in session:
+        return {"error": "Please log in."}, 401
+
+    lat = request.args.get("lat", type=float)
+    lng = request.args.get("lng", type=float)
+    if lat is None or lng is None:
+        return {"error": "lat and lng are required."}, 400
+    radius_km = min(request.args.get("radius_km", 3.0, type=float), 25.0)
+
+    candidate_store.reload_if_stale(get_db, shard_map.fanout)
+    nearby = candidate_store.nearby(lat, lng, radius_km=radius_km, limit=10)
+
+    result = {
+        "count": len(nearby),
+        "nearest_km": round(nearby[0][1], 2) if nearby else None,
+        "distances_km": [round(d, 2) for _, d in nearby],
+    }
+    if session.get("role") == "admin":
+        result["driver_ids"] = [driver_id for driver_id, _ in nearby]
+    return result
+
+
+@bp.route("/driver/rides/<int:ride_id>/accept", methods=["POST"])
+def driver_accept_ride(ride_id):
+    if "user_id" not in session or session.get("role") != "driver":
+        flash_error("Please log in as a driver.")
+        return redirect(url_for("web.passenger_login_page"))
+
+    driver = get_current_driver()
+    if driver is None:
+        flash_error("Driver profile not found.")
+        return redirect(url_for("web.driver_dashboard"))
+
+    try:
+        ride_ids = accept_ride(driver, ride_id)
+    except RideActionError as e:
+        flash_error(str(e))
+        return redirect(url_for("web.driver_dashboard"))
+
+    if len(ride_ids) > 1:
+        flash(f"Shared rides {', '.join(f'#{i}' for i in ride_ids)} accepted successfully.")
+    else:
+        flash(f"Ride #{ride_id} accepted successfully.")
+    return redirect(url_for("web.driver_dashboard"))
+
+
+@bp.route("/driver/rides/<int:ride_id>/reject", methods=["POST"])
+def driver_reject_ride(ride_id):
+    if "user_id" not in session or session.get("role") != "driver":
+        flash_error("Please log in as a driver.")
+        return redirect(url_for("web.passenger_login_page"))
+
+    try:
+        reject_ride(ride_id)
+    except RideActionError as e:
+        flash_error(str(e))
+        return redirect(url_for("web.driver_dashboard"))
 
     flash(f"Ride #{ride_id} rejected.")
-    return redirect(url_for("driver_dashboard"))
+    return redirect(url_for("web.driver_dashboard"))
 
 
-@app.route("/driver/rides/<int:ride_id>/cancel", methods=["POST"])
+@bp.route("/driver/rides/<int:ride_id>/cancel", methods=["POST"])
 def driver_cancel_ride(ride_id):
     if "user_id" not in session or session.get("role") != "driver":
-        flash("Please log in as a driver.")
-        return redirect(url_for("passenger_login_page"))
+        flash_error("Please log in as a driver.")
+        return redirect(url_for("web.passenger_login_page"))
 
     driver = get_current_driver()
     if driver is None:
-        flash("Driver profile not found.")
-        return redirect(url_for("driver_dashboard"))
+        flash_error("Driver profile not found.")
+        return redirect(url_for("web.driver_dashboard"))
 
-    conn = get_db()
-    cursor = conn.cursor()
+    try:
+        cancel_ride_as_driver(driver, ride_id)
+    except RideActionError as e:
+        flash_error(str(e))
+        return redirect(url_for("web.driver_dashboard"))
 
-    cursor.execute(
-        """
-        SELECT status
-        FROM rides
-        WHERE id = ? AND driver_id = ?
-        """,
-        (ride_id, driver["driver_id"]),
-    )
-    ride = cursor.fetchone()
+    flash(f"Ride #{ride_id} has been cancelled.")
+    return redirect(url_for("web.driver_dashboard"))
 
-    if not ride:
-        conn.close()
-        flash("Ride not found or not assigned to you.")
-        return redirect(url_for("driver_dashboard"))
 
-    if ride["status"] not in ("accepted", "picked_up"):
-        conn.close()
-        flash("Ride is no longer active.")
-        return redirect(url_for("driver_dashboard"))
+@bp.route("/driver/rides/<int:ride_id>/arrived", methods=["POST"])
+def driver_arrived(ride_id):
+    if "user_id" not in session or session.get("role") != "driver":
+        flash_error("Please log in as a driver.")
+        return redirect(url_for("web.passenger_login_page"))
 
-    cursor.execute("UPDATE rides SET status = 'cancelled' WHERE id = ?", (ride_id,))
-    conn.commit()
-    conn.close()
+    driver = get_current_driver()
+    if driver is None:
+        flash_error("Driver profile not found.")
+        return redirect(url_for("web.driver_dashboard"))
 
-    flash(f"Ride #{ride_id} has been cancelled.")
-    return redirect(url_for("driver_dashboard"))
+    try:
+        mark_arrived(driver, ride_id)
+    except RideActionError as e:
+        flash_error(str(e))
+        return redirect(url_for("web.driver_dashboard"))
+
+    flash(f"Passenger of ride #{ride_id} notified that you have arrived.")
+    return redirect(url_for("web.driver_dashboard"))
 
 
-@app.route("/driver/rides/<int:ride_id>/picked-up", methods=["POST"])
+@bp.route("/driver/rides/<int:ride_id>/picked-up", methods=["POST"])
 def driver_picked_up(ride_id):
     if "user_id" not in session or session.get("role") != "driver":
-        flash("Please log in as a driver.")
-        return redirect(url_for("passenger_login_page"))
+        flash_error("Please log in as a driver.")
+        return redirect(url_for("web.passenger_login_page"))
 
     driver = get_current_driver()
     if driver is None:
-        flash("Driver profile not found.")
-        return redirect(url_for("driver_dashboard"))
+        flash_error("Driver profile not found.")
+        return redirect(url_for("web.driver_dashboard"))
 
-    conn = get_db()
+    try:
+        mark_picked_up(driver, ride_id)
+    except RideActionError as e:
+        flash_error(str(e))
+        return redirect(url_for("web.driver_dashboard"))
+
+    flash(f"Ride #{ride_id} marked as picked up.")
+    return redirect(url_for("web.driver_dashboard"))
+
+
+TRACE_MAX_BATCH = 600  # fixes per upload (10 minutes at 1 Hz)
+
+
+@bp.route("/driver/rides/<int:ride_id>/trace", methods=["POST"])
+def driver_ride_trace(ride_id):
+    """
+    Append a batch of GPS fixes to a picked-up ride's trace.
+    Body: {"points": [[lat, lng, unix_seconds], ...]}
+    """
+    if "user_id" not in session or session.get("role") != "driver":
+        return {"error": "Please log in as a driver."}, 401
+
+    driver = get_current_driver()
+    if driver is None:
+        return {"error": "Driver profile not found."}, 404
+
+    payload = request.get_json(silent=True) or {}
+    try:
+        points = [(float(p[0]), float(p[1]), int(p[2])) for p in payload.get("points", [])[:TRACE_MAX_BATCH]]
+    except (TypeError, ValueError, IndexError):
+        return {"error": "points must be [lat, lng, unix_seconds] triples."}, 400
+
+    conn = get_ride_db(ride_id)
     cursor = conn.cursor()
     cursor.execute(
         """
-        SELECT status
-        FROM rides
-        WHERE id = ? AND driver_id = ?
+        SELECT r.status, t.points, t.last_lat, t.last_lng, t.last_t
+        FROM rides r
+        LEFT JOIN ride_traces t ON t.ride_id = r.id
+        WHERE r.id = ? AND r.driver_id = ?
         """,
         (ride_id, driver["driver_id"]),
     )
@@ -1111,67 +2921,310 @@ def driver_picked_up(ride_id):
 
     if not ride:
         conn.close()
-        flash("Ride not found or not assigned to you.")
-        return redirect(url_for("driver_dashboard"))
+        return {"error": "Ride not found or not assigned to you."}, 404
 
-    if ride["status"] != "accepted":
+    if ride["status"] != "picked_up":
         conn.close()
-        flash("Ride is not in 'accepted' state.")
-        return redirect(url_for("driver_dashboard"))
+        return {"error": "Ride is not in 'picked_up' state."}, 409
+
+    stored = ride["points"] or 0
+    previous = None
+    last = None
+    if stored:
+        previous = (ride["last_lat"], ride["last_lng"], ride["last_t"])
+        last = (previous[0] / traces.PRECISION, previous[1] / traces.PRECISION, previous[2])
+
+    kept, added_km = traces.filter_points(points, last)
+    if kept:
+        encoded, (last_lat, last_lng, last_t) = traces.encode(kept, previous)
+        # Guarded on the stored point count so two overlapping batches cannot interleave
+        cursor.execute(
+            """
+            INSERT INTO ride_traces (ride_id, encoded, points, last_lat, last_lng, last_t, distance_km)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(ride_id) DO UPDATE SET
+                encoded = encoded || excluded.encoded,
+                points = points + excluded.points,
+                last_lat = excluded.last_lat,
+                last_lng = excluded.last_lng,
+                last_t = excluded.last_t,
+                distance_km = distance_km + excluded.distance_km
+            WHERE points = ?
+            """,
+            (ride_id, encoded, len(kept), last_lat, last_lng, last_t, added_km, stored),
+        )
+        if cursor.rowcount == 0:
+            conn.rollback()
+            conn.close()
+            return {"error": "Trace changed concurrently, please resend."}, 409
+
+        # Latest fix doubles as the driver's live position
+        writes = core_writes.batch(cursor, ride_id)
+        writes.execute(
+            "UPDATE driver_status SET lat = ?, lng = ? WHERE driver_id = ?",
+            (kept[-1][0], kept[-1][1], driver["driver_id"]),
+        )
+        conn.commit()
+        writes.submit()
+        candidate_store.set_busy(driver["driver_id"], True, kept[-1][0], kept[-1][1])
+    conn.close()
 
-    cursor.execute("UPDATE rides SET status = 'picked_up' WHERE id = ?", (ride_id,))
-    conn.commit()
+    return {"accepted": len(kept), "points": stored + len(kept)}
+
+
+@bp.route("/rides/<int:ride_id>/trace", methods=["GET"])
+def ride_trace(ride_id):
+    """
+    Decoded trace of a ride, for the ride's driver and passenger and for admins.
+    """
+    if "user_id" not in session:
+        return {"error": "Please log in."}, 401
+
+    conn = get_ride_db(ride_id)
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT r.passenger_id, d.user_id AS driver_user_id, t.encoded, t.distance_km
+        FROM rides r
+        LEFT JOIN drivers d ON d.id = r.driver_id
+        LEFT JOIN ride_traces t ON t.ride_id = r.id
+        WHERE r.id = ?
+        """,
+        (ride_id,),
+    )
+    row = cursor.fetchone()
     conn.close()
 
-    flash(f"Ride #{ride_id} marked as picked up.")
-    return redirect(url_for("driver_dashboard"))
+    if not row or (
+        session.get("role") != "admin"
+        and session["user_id"] not in (row["passenger_id"], row["driver_user_id"])
+    ):
+        return {"error": "Ride not found."}, 404
+
+    return {
+        "ride_id": ride_id,
+        "distance_km": round(row["distance_km"] or 0.0, 3),
+        "encoded_bytes": len(row["encoded"] or ""),
+        "points": [list(p) for p in traces.decode(row["encoded"] or "")],
+    }
 
 
-@app.route("/driver/rides/<int:ride_id>/complete", methods=["POST"])
+@bp.route("/driver/rides/<int:ride_id>/complete", methods=["POST"])
 def driver_complete_ride(ride_id):
     if "user_id" not in session or session.get("role") != "driver":
-        flash("Please log in as a driver.")
-        return redirect(url_for("passenger_login_page"))
+        flash_error("Please log in as a driver.")
+        return redirect(url_for("web.passenger_login_page"))
 
     driver = get_current_driver()
     if driver is None:
-        flash("Driver profile not found.")
-        return redirect(url_for("driver_dashboard"))
+        flash_error("Driver profile not found.")
+        return redirect(url_for("web.driver_dashboard"))
 
-    conn = get_db()
-    cursor = conn.cursor()
+    try:
+        final_fare, final_distance_km = complete_ride(driver, ride_id)
+    except RideActionError as e:
+        flash_error(str(e))
+        return redirect(url_for("web.driver_dashboard"))
+
+    flash(f"Ride #{ride_id} marked as completed. Fare: EGP {final_fare:.2f} ({final_distance_km} km).")
+    return redirect(url_for("web.driver_dashboard"))
+
+
+@bp.route("/driver/requests", methods=["GET"])
+def driver_requests():
+    return redirect(url_for("web.driver_dashboard"))
+
+
+# ============================================================
+# DRIVER — WAITING RIDES DELTA FEED (ETag / 304)
+# ============================================================
+
+RIDE_FEED_RETAIN = 10000  # change-log rows kept before old ones are pruned
+
+
+def record_ride_feed_change(cursor, ride_id, change):
+    """
+    Append an 'added' / 'removed' entry to the waiting-rides change log.
+    Must run inside the same transaction as the status update; returns the
+    new sequence number so the caller can publish it after commit.
+    """
     cursor.execute(
-        """
-        SELECT status
-        FROM rides
-        WHERE id = ? AND driver_id = ?
-        """,
-        (ride_id, driver["driver_id"]),
+        "INSERT INTO ride_feed (ride_id, change) VALUES (?, ?)",
+        (ride_id, change),
     )
-    ride = cursor.fetchone()
+    seq = cursor.lastrowid
+    if seq % 1000 == 0:
+        cursor.execute("DELETE FROM ride_feed WHERE id <= ?", (seq - RIDE_FEED_RETAIN,))
+    return seq
 
-    if not ride:
-        conn.close()
-        flash("Ride not found or not assigned to you.")
-        return redirect(url_for("driver_dashboard"))
 
-    if ride["status"] not in ("accepted", "picked_up"):
-        conn.close()
-        flash("Ride is not active.")
-        return redirect(url_for("driver_dashboard"))
+def ride_feed_position(conn):
+    """
+    (latest, oldest) change-log ids in the region file behind conn. Latest
+    is the last id handed out, so an empty or fully pruned log still has a
+    position (region k starts at k * ID_STRIDE).
+    """
+    return conn.execute(
+        """
+        SELECT COALESCE((SELECT seq FROM main.sqlite_sequence WHERE name = 'ride_feed'), 0),
+               COALESCE((SELECT MIN(id) FROM main.ride_feed), 0)
+        """
+    ).fetchone()
 
-    cursor.execute("UPDATE rides SET status = 'completed' WHERE id = ?", (ride_id,))
-    conn.commit()
-    conn.close()
 
-    flash(f"Ride #{ride_id} marked as completed.")
-    return redirect(url_for("driver_dashboard"))
+def format_feed_cursor(positions):
+    """
+    Every region has its own change log, so a cursor is one position per
+    region, in region order: "812.1000000000042".
+    """
+    return ".".join(str(p) for p in positions)
+
+
+def parse_feed_cursor(value):
+    try:
+        positions = [int(p) for p in value.split(".")]
+    except ValueError:
+        return None
+    return positions if len(positions) == len(shard_map.regions) else None
+
+
+def publish_ride_feed_version(seq):
+    """
+    Rewrite the feed version marker after a committed queue change.
+    The token is unique per publish, so ETags never repeat even if two
+    workers publish out of order.
+    """
+    if seq is None:
+        return
+    tmp_path = f"{FEED_VERSION_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            f.write(f"{seq}.{time.time_ns()}")
+        os.replace(tmp_path, FEED_VERSION_PATH)
+    except OSError as e:
+        print(f"[publish_ride_feed_version] Failed to write feed marker: {e}")
+
+
+def read_ride_feed_version():
+    """
+    Return the feed marker's token without touching the database, or None
+    if no change has been published yet.
+    """
+    try:
+        with open(FEED_VERSION_PATH, "r") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def waiting_ride_to_dict(ride):
+    return {
+        "id": ride["id"],
+        "pickup_address": ride["pickup_address"],
+        "dropoff_address": ride["dropoff_address"],
+        "pickup_lat": ride["pickup_lat"],
+        "pickup_lng": ride["pickup_lng"],
+        "estimated_time_minutes": ride["estimated_time_minutes"],
+        "pool_id": ride["pool_id"],
+        "created_at": ride["created_at"],
+        "accept_url": url_for("web.driver_accept_ride", ride_id=ride["id"]),
+        "reject_url": url_for("web.driver_reject_ride", ride_id=ride["id"]),
+    }
+
+
+@bp.route("/driver/requests/feed", methods=["GET"])
+def driver_requests_feed():
+    """
+    JSON delta of the waiting-rides queue since ?since=<cursor>.
+    Without a cursor (or with one that has been pruned) a full snapshot is
+    returned with "reset": true.
+    """
+    if "user_id" not in session or session.get("role") != "driver":
+        return {"error": "Please log in as a driver."}, 401
+
+    token = read_ride_feed_version()
+    etag = f"feed-{token}" if token else None
+
+    # Conditional poll: nothing has changed since the client's last response.
+    # Only the ETag is trusted; If-Modified-Since has one-second resolution
+    # and would hide a second change within the same second.
+    if token:
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+    since = parse_feed_cursor(request.args.get("since", ""))
+
+    # Changes per region; a position the log no longer covers means a full snapshot
+    reset = since is None
+    latest, changes = [], []
+    for i, region in enumerate(shard_map.regions):
+        conn = shard_map.connect(region)
+        try:
+            last, oldest = ride_feed_position(conn)
+            latest.append(last)
+            if reset:
+                continue
+            if since[i] > last or (oldest and since[i] < oldest - 1):
+                reset = True
+                continue
+            changes += conn.execute(
+                "SELECT ride_id, change FROM ride_feed WHERE id > ? AND id <= ? ORDER BY id ASC",
+                (since[i], last),
+            ).fetchall()
+        finally:
+            conn.close()
+
+    removed = []
+    if reset:
+        waiting = shard_map.fanout(
+            """
+            SELECT id, pickup_address, dropoff_address, pickup_lat, pickup_lng,
+                   estimated_time_minutes, pool_id, created_at
+            FROM rides
+            WHERE status = 'waiting'
+            ORDER BY created_at ASC
+            """,
+            key=lambda r: r["created_at"],
+        )
+        added = [waiting_ride_to_dict(r) for r in waiting]
+    else:
+        # Net effect per ride: the last change wins (a ride's changes all live in its region)
+        net = {}
+        for row in changes:
+            net[row["ride_id"]] = row["change"]
+
+        added_ids = [rid for rid, change in net.items() if change == "added"]
+        removed = [rid for rid, change in net.items() if change == "removed"]
+
+        added = []
+        if added_ids:
+            waiting = shard_map.by_ids(
+                """
+                SELECT id, pickup_address, dropoff_address, pickup_lat, pickup_lng,
+                       estimated_time_minutes, pool_id, created_at
+                FROM rides
+                WHERE status = 'waiting' AND id IN ({ids})
+                """,
+                added_ids,
+            )
+            added = [waiting_ride_to_dict(r) for r in sorted(waiting, key=lambda r: r["created_at"])]
+
+    response = current_app.json.response({
+        "cursor": format_feed_cursor(latest),
+        "reset": bool(reset),
+        "added": added,
+        "removed": removed,
+    })
+    response.headers["Cache-Control"] = "private, no-cache"
+    if token:
+        response.set_etag(etag, weak=True)
+    return response
 
 
-@app.route("/driver/requests", methods=["GET"])
-def driver_requests():
-    return redirect(url_for("driver_dashboard"))
 
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
 
 
 # ===============================
@@ -1180,4 +3233,4 @@ def driver_requests():
 if __name__ == "__main__":
     import os
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
+    create_app().run(host="0.0.0.0", port=port)
@@ -0,0 +1,246 @@
+"""
+Static asset pipeline.
+
+    python assets.py vendor     # maintainers: download, then commit static/vendor/
+    python assets.py build      # every deploy
+
+Third-party files (Leaflet) are committed under static/vendor/, so a
+deploy never depends on a CDN. `vendor` downloads missing ones and checks
+each against its Subresource Integrity hash; run it when bumping a
+version and commit the result.
+
+`build`:
+
+1. Verifies the committed vendor files against their SRI hashes (nothing
+   is downloaded; pages fall back to the CDN for a missing file).
+2. Copies every file under static/ into static/dist/ with a content hash in
+   its name (style.css -> style.3f2a1b9c0d1e.css). url(...) references in
+   CSS are rewritten to the hashed names first.
+3. Writes .gz and .br (when the Brotli package is installed) variants
+   next to each compressible file.
+4. Writes static/dist/manifest.json mapping logical names to hashed names.
+
+At runtime asset_url() maps a logical name to /assets/<hashed name>. That
+route serves the best precompressed variant with a one-year immutable
+Cache-Control header, since a changed file always gets a new name. Assets
+that were never built are served from /static as before.
+"""
+import base64
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import sys
+import threading
+import urllib.request
+
+try:
+    import brotli
+except ImportError:  # optional: only .gz variants are produced without it
+    brotli = None
+
+STATIC_DIR = "static"
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFEST_NAME = "manifest.json"
+HASH_LENGTH = 12
+COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".txt", ".map"}
+MIN_COMPRESS_BYTES = 512
+
+LEAFLET = "https://unpkg.com/leaflet@1.9.4/dist/"
+VENDOR = [
+    # (url, path under static/, sha256 SRI or None)
+    (LEAFLET + "leaflet.js", "vendor/leaflet/leaflet.js", "sha256-20nQCchB9co0qIjJZRGuk2/Z9VM+kNiyxNV1lvTlZBo="),
+    (LEAFLET + "leaflet.css", "vendor/leaflet/leaflet.css", "sha256-p4NxAoJBhIIN+hmNHrzRCf9tD/miZyoHS5obTRR9BMY="),
+    (LEAFLET + "images/layers.png", "vendor/leaflet/images/layers.png", None),
+    (LEAFLET + "images/layers-2x.png", "vendor/leaflet/images/layers-2x.png", None),
+    (LEAFLET + "images/marker-icon.png", "vendor/leaflet/images/marker-icon.png", None),
+    (LEAFLET + "images/marker-icon-2x.png", "vendor/leaflet/images/marker-icon-2x.png", None),
+    (LEAFLET + "images/marker-shadow.png", "vendor/leaflet/images/marker-shadow.png", None),
+]
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def sri(data):
+    return "sha256-" + base64.b64encode(hashlib.sha256(data).digest()).decode("ascii")
+
+
+# ---------------- build ----------------
+
+def vendor(static_dir=STATIC_DIR, download=True):
+    """
+    Verify vendored files and download missing ones (download=False only
+    reports them). Returns False if any are missing or do not match.
+    """
+    ok = True
+    for url, rel_path, integrity in VENDOR:
+        path = os.path.join(static_dir, rel_path)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                if integrity and sri(f.read()) != integrity:
+                    print(f"[assets] {rel_path} does not match {integrity}; delete it to re-download")
+                    ok = False
+            continue
+        if not download:
+            print(f"[assets] {rel_path} is not vendored; run `python assets.py vendor` and commit it")
+            ok = False
+            continue
+        try:
+            with urllib.request.urlopen(url, timeout=30) as resp:
+                data = resp.read()
+        except OSError as e:
+            print(f"[assets] Could not download {url}: {e}")
+            ok = False
+            continue
+        if integrity and sri(data) != integrity:
+            print(f"[assets] Integrity check failed for {url}")
+            ok = False
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        print(f"[assets] Vendored {rel_path} ({len(data)} bytes)")
+    return ok
+
+
+def hashed_name(rel_path, data):
+    root, ext = os.path.splitext(rel_path)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}"
+
+
+def rewrite_css(rel_path, text, manifest):
+    """
+    Point relative url(...) references at hashed names. Referenced files
+    are fingerprinted before the CSS that uses them.
+    """
+    base = os.path.dirname(rel_path)
+
+    def replace(match):
+        target = match.group(2)
+        if re.match(r"^(data:|https?:|//|/|#)", target):
+            return match.group(0)
+        clean = target.split("?")[0].split("#")[0]
+        logical = os.path.normpath(os.path.join(base, clean)).replace(os.sep, "/")
+        if logical not in manifest:
+            return match.group(0)
+        hashed = os.path.relpath(manifest[logical], base or ".").replace(os.sep, "/")
+        return f"url({match.group(1)}{hashed}{match.group(1)})"
+
+    return CSS_URL.sub(replace, text)
+
+
+def write_variants(path, data):
+    if os.path.splitext(path)[1] not in COMPRESSIBLE or len(data) < MIN_COMPRESS_BYTES:
+        return
+    with open(path + ".gz", "wb") as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(path + ".br", "wb") as f:
+            f.write(brotli.compress(data, quality=11))
+
+
+def build(static_dir=STATIC_DIR):
+    dist_dir = os.path.join(static_dir, "dist")
+    sources = []
+    for root, dirs, files in os.walk(static_dir):
+        if os.path.abspath(root).startswith(os.path.abspath(dist_dir)):
+            continue
+        for name in files:
+            rel_path = os.path.relpath(os.path.join(root, name), static_dir).replace(os.sep, "/")
+            sources.append(rel_path)
+    # Non-CSS first, so CSS can reference their hashed names
+    sources.sort(key=lambda p: (p.endswith(".css"), p))
+
+    manifest = {}
+    fresh = set()
+    for rel_path in sources:
+        with open(os.path.join(static_dir, rel_path), "rb") as f:
+            data = f.read()
+        if rel_path.endswith(".css"):
+            data = rewrite_css(rel_path, data.decode("utf-8"), manifest).encode("utf-8")
+
+        target = hashed_name(rel_path, data)
+        manifest[rel_path] = target
+        fresh.add(target)
+        out_path = os.path.join(dist_dir, target)
+        if not os.path.exists(out_path):
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            with open(out_path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(out_path + ".tmp", out_path)
+            write_variants(out_path, data)
+
+    tmp_path = os.path.join(dist_dir, MANIFEST_NAME + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, os.path.join(dist_dir, MANIFEST_NAME))
+    print(f"[assets] {len(manifest)} assets fingerprinted into {dist_dir}" + ("" if brotli else " (no Brotli; .gz only)"))
+    return manifest, fresh
+
+
+def clean(static_dir=STATIC_DIR, keep=()):
+    """
+    Remove hashed files from older builds (keep the current ones).
+    """
+    dist_dir = os.path.join(static_dir, "dist")
+    keep = set(keep)
+    for root, _, files in os.walk(dist_dir):
+        for name in files:
+            rel_path = os.path.relpath(os.path.join(root, name), dist_dir).replace(os.sep, "/")
+            base = re.sub(r"\.(gz|br)$", "", rel_path)
+            if base != MANIFEST_NAME and base not in keep:
+                os.remove(os.path.join(root, name))
+
+
+# ---------------- runtime ----------------
+
+class AssetManifest:
+    def __init__(self, static_dir=STATIC_DIR):
+        self.static_dir = static_dir
+        self.dist_dir = os.path.join(static_dir, "dist")
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(os.path.join(self.dist_dir, MANIFEST_NAME), "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        with self.lock:
+            self.entries = entries
+
+    def lookup(self, rel_path):
+        if self.entries is None:
+            self.load()
+        return self.entries.get(rel_path)
+
+    def exists(self, rel_path):
+        return self.lookup(rel_path) is not None or os.path.isfile(os.path.join(self.static_dir, rel_path))
+
+    def variant(self, hashed_path, accept_encodings):
+        """
+        (file name under dist/, Content-Encoding or None, mimetype) for the
+        best precompressed copy the client accepts.
+        """
+        mimetype = mimetypes.guess_type(hashed_path)[0] or "application/octet-stream"
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if accept_encodings[encoding] and os.path.isfile(os.path.join(self.dist_dir, hashed_path + suffix)):
+                return hashed_path + suffix, encoding, mimetype
+        return hashed_path, None, mimetype
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("build", "vendor", "clean"):
+        print("usage: python assets.py build | vendor | clean")
+        sys.exit(1)
+    if sys.argv[1] == "vendor":
+        sys.exit(0 if vendor() else 1)
+    if sys.argv[1] == "build":
+        vendor(download=False)
+        build()
+    else:
+        manifest, fresh = build()
+        clean(keep=fresh)
@@ -0,0 +1,403 @@
+"""
+Production traffic capture and time-scaled replay.
+
+With TRAFFIC_CAPTURE_PATH set, every request (HTML routes and /api/v1)
+appends one JSON line:
+
+    {"t": 1760860000.123, "session": "3f9a0c1e7b2d", "role": "driver", "method": "POST",
+     "endpoint": "web.driver_accept_ride", "rule": "/driver/ride/<int:ride_id>/accept",
+     "view_args": {"ride_id": 42}, "args": {}, "form": {"idempotency_key": "str:32"},
+     "json": null, "status": 302, "action_error": false, "ms": 4.81}
+
+API lines have an "api." endpoint (e.g. "api.driver_action") and "api": true.
+action_error marks a response that flashed an error, typically a redirect
+that otherwise looks like a successful one (see app.flash_error).
+
+Only the shape of query, form and JSON parameters is kept ("int", "float",
+"str:<length>", "empty"; "secret" for passwords), never their values. The
+session is a keyed hash of the user id, stable across workers but not
+reversible without the secret key. Lines are written with a single
+O_APPEND write, so workers can share one file.
+
+    python capture.py replay traffic.ndjson --base http://127.0.0.1:5000 --speed 10 --out new.ndjson \\
+        --login passenger=p@example.com:secret --login driver=d@example.com:secret
+    python capture.py compare old.ndjson new.ndjson
+
+Replay keeps the order of requests within a session and the captured gaps
+between them, divided by --speed ("max" sends each session back to back).
+Parameter values are synthesized from their shapes. Pass --login once per
+account; captured sessions are assigned the accounts of their role in
+turn, so concurrent sessions do not act as one user (a role with fewer
+accounts than sessions shares them, which the replay reports). API
+requests sign in with the same account for a bearer token. Redirects that
+flashed an error are counted as "3xx-error", not "3xx". Run both builds
+against copies of the same database, with ADMISSION_CONTROL=0 so the
+replay is not throttled.
+"""
+import argparse
+import hashlib
+import hmac
+import http.cookiejar
+import json
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+SECRET_FIELDS = ("password", "token", "secret")
+CITY_CENTER = (30.0444, 31.2357)    # same as simulate.py
+LOGIN_PATH = "/passenger/login"     # shared by every role
+API_LOGIN_PATH = "/api/v1/session"
+ACTION_ERROR_HEADER = "X-Action-Error"
+# Account changes are not replayed; sessions log in with the --login accounts instead
+SKIPPED_ENDPOINTS = {
+    "web.passenger_login_submit", "web.logout", "web.passenger_register_submit", "web.driver_register_submit",
+    "api.create_session",
+}
+INT_RE = re.compile(r"^-?\d+$")
+FLOAT_RE = re.compile(r"^-?\d+\.\d*$")
+
+
+# ---------------- capture ----------------
+
+def value_shape(name, value):
+    if any(word in name.lower() for word in SECRET_FIELDS):
+        return "secret"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if value is None or value == "":
+        return "empty"
+    if isinstance(value, (dict, list)):
+        return type(value).__name__
+    value = str(value)
+    if INT_RE.match(value):
+        return "int"
+    if FLOAT_RE.match(value):
+        return "float"
+    return f"str:{len(value)}"
+
+
+def params_shape(params):
+    """
+    {name: shape} for a MultiDict or a JSON object (first value per name).
+    """
+    if not isinstance(params, dict):
+        return {}
+    return {name: value_shape(name, params[name]) for name in params}
+
+
+class TrafficCapture:
+    def __init__(self, path, secret_key):
+        self.path = path
+        self.key = hashlib.sha256(str(secret_key).encode("utf-8")).digest()
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.errors = 0
+
+    def pseudonym(self, user_id):
+        if user_id is None:
+            return None
+        return hmac.new(self.key, f"user:{user_id}".encode(), hashlib.sha256).hexdigest()[:12]
+
+    def record(self, entry):
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        try:
+            os.write(self.fd, line.encode("utf-8"))
+        except OSError:
+            self.errors += 1    # capture must never break the request
+
+
+# ---------------- replay ----------------
+
+def load_capture(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthesize(name, shape):
+    lowered = name.lower()
+    if lowered == "idempotency_key":
+        return uuid.uuid4().hex     # a fixed value would be answered from the replay cache
+    if shape == "int":
+        return "1"
+    if shape == "float":
+        if "lat" in lowered:
+            return str(CITY_CENTER[0])
+        if "lng" in lowered or "lon" in lowered:
+            return str(CITY_CENTER[1])
+        return "1.5"
+    if shape == "bool":
+        return "on"
+    if shape.startswith("str:"):
+        return "x" * int(shape[4:])
+    return ""
+
+
+def build_path(entry):
+    path = entry["rule"]
+    for name, value in (entry.get("view_args") or {}).items():
+        path = re.sub(r"<(?:[^:<>]+:)?" + re.escape(name) + ">", urllib.parse.quote(str(value)), path)
+    args = {name: synthesize(name, shape) for name, shape in (entry.get("args") or {}).items()}
+    return path + ("?" + urllib.parse.urlencode(args) if args else "")
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None     # time the request itself, not the page it redirects to
+
+
+class Replayer:
+    def __init__(self, base, logins, speed):
+        self.base = base.rstrip("/")
+        self.logins = logins        # role -> [(email, password), ...]
+        self.speed = speed          # None = as fast as possible
+        self.accounts = {}          # captured session -> (email, password) or None
+        self.openers = {}
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def assign_accounts(self, sessions):
+        """
+        Give each captured session its own account of the same role, in
+        order of first request, reusing accounts only when a role runs out.
+        """
+        used = defaultdict(int)
+        for key, entries in sorted(sessions.items(), key=lambda item: item[1][0]["t"]):
+            role = entries[0].get("role")
+            pool = self.logins.get(role)
+            self.accounts[key] = pool[used[role] % len(pool)] if pool else None
+            used[role] += 1
+        for role, count in sorted(used.items(), key=lambda item: str(item[0])):
+            available = len(self.logins.get(role, ()))
+            if role and available and count > available:
+                print(f"[replay] {count} {role} sessions share {available} --login accounts")
+
+    def opener(self, account):
+        """
+        One logged-in cookie jar per account (None: anonymous).
+        """
+        with self.lock:
+            if account in self.openers:
+                return self.openers[account]
+            opener = urllib.request.build_opener(
+                urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect
+            )
+            if account is not None:
+                email, password = account
+                body = urllib.parse.urlencode({"email": email, "password": password}).encode()
+                self.send(opener, "POST", LOGIN_PATH, body, "application/x-www-form-urlencoded")
+            self.openers[account] = opener
+            return opener
+
+    def token(self, account):
+        """
+        Bearer token for the account's API requests, or None.
+        """
+        with self.lock:
+            if account in self.tokens:
+                return self.tokens[account]
+            token = None
+            if account is not None:
+                email, password = account
+                req = urllib.request.Request(
+                    self.base + API_LOGIN_PATH, method="POST",
+                    data=json.dumps({"email": email, "password": password}).encode(),
+                    headers={"Content-Type": "application/json"},
+                )
+                try:
+                    with urllib.request.urlopen(req, timeout=30) as resp:
+                        token = json.loads(resp.read()).get("token")
+                except (OSError, ValueError) as e:
+                    print(f"[replay] API sign-in failed for {email}: {e}")
+            self.tokens[account] = token
+            return token
+
+    def send(self, opener, method, path, body=None, content_type=None, headers=None):
+        """
+        (status, action_error) of one request; status 0 when it never got an answer.
+        """
+        req = urllib.request.Request(self.base + path, data=body, method=method, headers=headers or {})
+        if content_type:
+            req.add_header("Content-Type", content_type)
+        try:
+            with opener.open(req, timeout=30) as resp:
+                resp.read()
+                return resp.status, resp.headers.get(ACTION_ERROR_HEADER) is not None
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code, e.headers.get(ACTION_ERROR_HEADER) is not None
+        except OSError:
+            return 0, False
+
+    def request(self, entry, account):
+        body, content_type = None, None
+        if entry.get("json") is not None:
+            data = {name: synthesize(name, shape) for name, shape in entry["json"].items()}
+            body, content_type = json.dumps(data).encode(), "application/json"
+        elif entry.get("form") or entry["method"] in ("POST", "PUT", "PATCH"):
+            data = {name: synthesize(name, shape) for name, shape in (entry.get("form") or {}).items()}
+            body, content_type = urllib.parse.urlencode(data).encode(), "application/x-www-form-urlencoded"
+
+        headers = {}
+        if entry.get("api"):
+            token = self.token(account)
+            if token:
+                headers["Authorization"] = f"Bearer {token}"
+        opener = self.opener(None if entry.get("api") else account)
+        started = time.perf_counter()
+        status, action_error = self.send(opener, entry["method"], build_path(entry), body, content_type, headers)
+        return status, action_error, (time.perf_counter() - started) * 1000
+
+    def run_session(self, entries, account, origin, started):
+        results = []
+        for entry in entries:
+            if self.speed is not None:
+                due = started + (entry["t"] - origin) / self.speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            lag = max(0.0, time.perf_counter() - due) * 1000 if self.speed is not None else 0.0
+            status, action_error, ms = self.request(entry, account)
+            results.append({
+                "endpoint": entry["endpoint"], "method": entry["method"], "status": status,
+                "action_error": action_error, "ms": round(ms, 3), "captured_ms": entry.get("ms"),
+                "lag_ms": round(lag, 1),
+            })
+        return results
+
+    def run(self, entries, concurrency):
+        """
+        Sessions run in parallel; requests within a session run in order.
+        Anonymous requests have no session and are each replayed on their own.
+        """
+        entries = [e for e in entries if e.get("endpoint") and e["endpoint"] not in SKIPPED_ENDPOINTS]
+        entries.sort(key=lambda e: e["t"])
+        sessions = defaultdict(list)
+        for i, entry in enumerate(entries):
+            sessions[entry.get("session") or f"anonymous:{i}"].append(entry)
+
+        # Log in before the clock starts
+        self.assign_accounts(sessions)
+        for key, session_entries in sessions.items():
+            account = self.accounts[key]
+            if any(e.get("api") for e in session_entries):
+                self.token(account)
+            if not all(e.get("api") for e in session_entries):
+                self.opener(account)
+
+        origin = entries[0]["t"] if entries else 0
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            # Submit in order of first request, so early sessions get threads first
+            ordered = sorted(sessions.items(), key=lambda item: item[1][0]["t"])
+            futures = [pool.submit(self.run_session, s, self.accounts[key], origin, started) for key, s in ordered]
+            results = [r for f in futures for r in f.result()]
+        return results, time.perf_counter() - started
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(results):
+    routes = defaultdict(list)
+    for r in results:
+        routes[f"{r['method']} {r['endpoint']}"].append(r)
+    summary = {}
+    for route, rows in routes.items():
+        ms = [r["ms"] for r in rows]
+        statuses = defaultdict(int)
+        for r in rows:
+            if not r["status"]:
+                statuses["error"] += 1
+            else:
+                statuses[f"{r['status'] // 100}xx" + ("-error" if r.get("action_error") else "")] += 1
+        summary[route] = {
+            "count": len(rows), "p50": round(statistics.median(ms), 2),
+            "p95": round(percentile(ms, 0.95), 2), "statuses": dict(statuses),
+        }
+    return summary
+
+
+def print_summary(summary):
+    print(f"{'route':48} {'count':>6} {'p50 ms':>9} {'p95 ms':>9}  statuses")
+    for route, s in sorted(summary.items(), key=lambda item: -item[1]["count"]):
+        statuses = " ".join(f"{k}={v}" for k, v in sorted(s["statuses"].items()))
+        print(f"{route:48} {s['count']:6d} {s['p50']:9.2f} {s['p95']:9.2f}  {statuses}")
+
+
+def compare(before_path, after_path):
+    before = summarize(load_capture(before_path))
+    after = summarize(load_capture(after_path))
+    print(f"{'route':48} {'count':>6} {'p50 before':>11} {'p50 after':>10} {'delta':>8} "
+          f"{'p95 before':>11} {'p95 after':>10} {'delta':>8}")
+
+    def delta(a, b):
+        return f"{(b - a) / a:+.1%}" if a else "n/a"
+
+    for route in sorted(set(before) & set(after), key=lambda r: -after[r]["count"]):
+        b, a = before[route], after[route]
+        print(f"{route:48} {a['count']:6d} {b['p50']:11.2f} {a['p50']:10.2f} {delta(b['p50'], a['p50']):>8} "
+              f"{b['p95']:11.2f} {a['p95']:10.2f} {delta(b['p95'], a['p95']):>8}")
+    for route in sorted(set(before) ^ set(after)):
+        print(f"{route:48} only in {'before' if route in before else 'after'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic and compare builds")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    replay = commands.add_parser("replay", help="re-issue a capture against a running instance")
+    replay.add_argument("capture")
+    replay.add_argument("--base", default="http://127.0.0.1:5000")
+    replay.add_argument("--speed", default="1", help="1, 10, ... or max")
+    replay.add_argument("--concurrency", type=int, default=64, help="sessions replayed at once")
+    replay.add_argument("--login", action="append", default=[], metavar="ROLE=EMAIL:PASSWORD",
+                        help="repeat per account; each captured session gets its own")
+    replay.add_argument("--out", help="write per-request results as NDJSON (input to compare)")
+
+    diff = commands.add_parser("compare", help="per-route latency deltas between two replay results")
+    diff.add_argument("before")
+    diff.add_argument("after")
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        compare(args.before, args.after)
+        return
+
+    logins = defaultdict(list)
+    for spec in args.login:
+        role, _, account = spec.partition("=")
+        email, _, password = account.partition(":")
+        if not (role and email and password):
+            sys.exit(f"bad --login {spec!r}, expected ROLE=EMAIL:PASSWORD")
+        logins[role].append((email, password))
+    speed = None if args.speed == "max" else float(args.speed)
+
+    entries = load_capture(args.capture)
+    results, elapsed = Replayer(args.base, logins, speed).run(entries, args.concurrency)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            for r in results:
+                f.write(json.dumps(r) + "\n")
+
+    lag = [r["lag_ms"] for r in results]
+    print(f"[replay] {len(results)} requests in {elapsed:.2f}s at speed {args.speed}"
+          + (f", schedule lag p95 {percentile(lag, 0.95):.1f} ms" if lag and speed else ""))
+    print_summary(summarize(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Online per-zone trip duration (ETA) model.
+
+Completed rides feed running statistics keyed by
+(pickup zone, dropoff zone, hour of week). Mean and variance are updated
+with Welford's algorithm, so no history is re-read and nothing is
+retrained in batch. Each ride also updates an "any hour" row
+(hour_of_week = -1) for the zone pair, which is used while a particular
+hour has too few samples.
+
+The eta_stats table is the source of truth. Each worker keeps a dict copy
+for O(1) lookups, refreshed every REFRESH_SECONDS to pick up rides that
+other workers completed.
+"""
+import math
+import threading
+import time
+
+ANY_HOUR = -1
+MIN_SAMPLES = 5
+REFRESH_SECONDS = 60
+MIN_TRIP_MINUTES = 1
+MAX_TRIP_MINUTES = 300
+
+
+class EtaModel:
+    def __init__(self):
+        self.stats = {}          # (pickup_zone, dropoff_zone, hour) -> (n, mean, m2)
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def load(self, conn):
+        cursor = conn.cursor()
+        cursor.execute("SELECT pickup_zone, dropoff_zone, hour_of_week, n, mean, m2 FROM eta_stats")
+        stats = {(r[0], r[1], r[2]): (r[3], r[4], r[5]) for r in cursor.fetchall()}
+        with self.lock:
+            self.stats = stats
+            self.loaded_at = time.monotonic()
+
+    def refresh_if_stale(self, get_conn):
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < REFRESH_SECONDS:
+            return
+        conn = get_conn()
+        try:
+            self.load(conn)
+        finally:
+            conn.close()
+
+    def observe(self, cursor, pickup_zone, dropoff_zone, hour, minutes):
+        """
+        Fold one completed trip into eta_stats using the caller's transaction.
+        Returns the updated rows; pass them to apply() once the transaction
+        commits. Returns [] when the sample is unusable.
+        """
+        if not pickup_zone or not dropoff_zone or minutes is None:
+            return []
+        if not MIN_TRIP_MINUTES <= minutes <= MAX_TRIP_MINUTES:
+            return []
+
+        updated = []
+        for key in ((pickup_zone, dropoff_zone, hour), (pickup_zone, dropoff_zone, ANY_HOUR)):
+            cursor.execute(
+                "SELECT n, mean, m2 FROM eta_stats WHERE pickup_zone = ? AND dropoff_zone = ? AND hour_of_week = ?",
+                key,
+            )
+            row = cursor.fetchone()
+            n, mean, m2 = (row[0], row[1], row[2]) if row else (0, 0.0, 0.0)
+
+            # Welford's online update
+            n += 1
+            delta = minutes - mean
+            mean += delta / n
+            m2 += delta * (minutes - mean)
+
+            cursor.execute(
+                """
+                INSERT INTO eta_stats (pickup_zone, dropoff_zone, hour_of_week, n, mean, m2)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (pickup_zone, dropoff_zone, hour_of_week)
+                DO UPDATE SET n = excluded.n, mean = excluded.mean, m2 = excluded.m2
+                """,
+                key + (n, mean, m2),
+            )
+            updated.append((key, (n, mean, m2)))
+        return updated
+
+    def apply(self, updated):
+        with self.lock:
+            for key, value in updated:
+                self.stats[key] = value
+
+    def estimate(self, pickup_zone, dropoff_zone, hour):
+        """
+        Return (mean_minutes, stddev_minutes, samples) or None when the model
+        has not seen enough trips for this zone pair yet.
+        """
+        for key in ((pickup_zone, dropoff_zone, hour), (pickup_zone, dropoff_zone, ANY_HOUR)):
+            entry = self.stats.get(key)
+            if entry and entry[0] >= MIN_SAMPLES:
+                n, mean, m2 = entry
+                return mean, math.sqrt(m2 / (n - 1)), n
+        return None
+
+
+eta_model = EtaModel()
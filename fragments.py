@@ -0,0 +1,91 @@
+"""
+Template caching.
+
+Compiled templates are kept in a FileSystemBytecodeCache directory shared
+by every worker (entries are keyed on the template source, so an edited
+template is simply compiled again).
+
+Rendered fragments are cached per worker with a {% cache %} tag. Its
+arguments are the cache key and must include a version that changes
+whenever the data behind the fragment does:
+
+    {% cache "ride-card", ride.id, ride.version %} ... {% endcache %}
+
+rides.version is bumped by a trigger on every UPDATE, and data_version()
+reads counters that triggers keep per table group (see schema.sql). Keys
+are never invalidated, only evicted (least recently used first), so a
+fragment must not contain anything per-request: flashed messages,
+idempotency keys, the current user.
+"""
+import threading
+import uuid
+from collections import OrderedDict
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+MAX_FRAGMENTS = 5000
+
+
+def data_version(conn, name):
+    row = conn.execute("SELECT version FROM data_versions WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+
+class FragmentStore:
+    def __init__(self, max_entries=MAX_FRAGMENTS):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, key):
+        with self.lock:
+            html = self.entries.get(key)
+            if html is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return html
+
+    def put(self, key, html):
+        with self.lock:
+            self.entries[key] = html
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class FragmentCacheExtension(Extension):
+    tags = {"cache"}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_store=FragmentStore())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            key.append(parser.parse_expression())
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+
+        # A fresh token per compile, so a changed template never reuses old fragments
+        block = nodes.Const(f"{parser.name}:{lineno}:{uuid.uuid4().hex[:8]}")
+        call = self.call_method("_render", [block, nodes.List(key)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render(self, block, key, caller):
+        store = self.environment.fragment_store
+        cache_key = (block, *key)
+        html = store.get(cache_key)
+        if html is None:
+            html = Markup(caller())
+            store.put(cache_key, html)
+        return html
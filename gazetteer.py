@@ -0,0 +1,117 @@
+"""
+Local place / street gazetteer with a sorted-array prefix index.
+
+The gazetteer is a CSV file with columns name, lat, lng and an optional
+weight (higher = more popular). Every word of a place name is indexed, so
+"tahrir" finds both "Tahrir Square" and "Midan el-Tahrir".
+"""
+import bisect
+import csv
+import heapq
+import re
+import threading
+import unicodedata
+from array import array
+from functools import lru_cache
+
+NON_WORD = re.compile(r"[^0-9a-z]+")
+
+
+def normalize(text):
+    """
+    Lowercase, strip accents and collapse punctuation to single spaces.
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return NON_WORD.sub(" ", text.lower()).strip()
+
+
+class Gazetteer:
+    def __init__(self, rows=()):
+        # Places are stored as parallel columns rather than one object each
+        self.names = []
+        self.lats = array("d")
+        self.lngs = array("d")
+        self.weights = array("d")
+
+        keys = []
+        for name, lat, lng, weight in rows:
+            place_id = len(self.names)
+            self.names.append(name)
+            self.lats.append(lat)
+            self.lngs.append(lng)
+            self.weights.append(weight)
+
+            # Index the full name from every word start
+            words = normalize(name).split()
+            for i in range(len(words)):
+                keys.append((" ".join(words[i:]), place_id))
+
+        keys.sort()
+        self.keys = [k for k, _ in keys]
+        self.key_places = array("i", (p for _, p in keys))
+        self.search = lru_cache(maxsize=4096)(self._search)
+
+    @classmethod
+    def from_csv(cls, path):
+        def rows():
+            with open(path, newline="", encoding="utf-8") as f:
+                for row in csv.DictReader(f):
+                    try:
+                        yield (
+                            row["name"].strip(),
+                            float(row["lat"]),
+                            float(row["lng"]),
+                            float(row.get("weight") or 0),
+                        )
+                    except (KeyError, TypeError, ValueError):
+                        continue  # skip malformed lines rather than failing the load
+
+        return cls(rows())
+
+    def __len__(self):
+        return len(self.names)
+
+    def _search(self, prefix, limit=5):
+        """
+        Return up to `limit` places whose name has a word starting with
+        `prefix` (already normalized), most popular first.
+        Results are cached per (prefix, limit); the gazetteer is read-only.
+        """
+        if not prefix:
+            return ()
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + "\uffff", lo)
+
+        place_ids = set(self.key_places[lo:hi])
+        best = heapq.nlargest(limit, place_ids, key=lambda p: (self.weights[p], -p))
+        return tuple(
+            {"name": self.names[p], "lat": self.lats[p], "lng": self.lngs[p]}
+            for p in best
+        )
+
+    def autocomplete(self, query, limit=5):
+        return self.search(normalize(query), limit)
+
+
+_loaded = {}
+_load_lock = threading.Lock()
+
+
+def get_gazetteer(path):
+    """
+    Load (once per process) and return the gazetteer stored at `path`.
+    A missing file yields an empty gazetteer so autocomplete degrades quietly.
+    """
+    gazetteer = _loaded.get(path)
+    if gazetteer is None:
+        with _load_lock:
+            gazetteer = _loaded.get(path)
+            if gazetteer is None:
+                try:
+                    gazetteer = Gazetteer.from_csv(path)
+                except OSError as e:
+                    print(f"[gazetteer] Could not load {path}: {e}")
+                    gazetteer = Gazetteer()
+                _loaded[path] = gazetteer
+    return gazetteer
@@ -0,0 +1,7 @@
+# Read by gunicorn from the working directory (both Procfile processes)
+
+
+def post_fork(server, worker):
+    # Background threads belong in the workers, not the preloading master
+    import app
+    app.start_background_work()
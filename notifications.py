@@ -0,0 +1,409 @@
+"""
+Ride notifications through a transactional outbox.
+
+Lifecycle routes call enqueue() with their own cursor, so the notification
+row commits (or rolls back) together with the status change, and the route
+does no network I/O. The outbox is sharded with the rides (see shards.py),
+so each region file has its own. A background Dispatcher claims due rows
+from every outbox in batches, renders them, and hands each batch to the
+configured channels:
+
+    log        print to stdout (default); addresses masked and the text left
+               out unless NOTIFY_LOG_CONTENT=1
+    smtp       one SMTP session per batch, e.g. a local debug server:
+               python -m aiosmtpd -n -l localhost:1025
+    webhook    one JSON POST per batch: {"notifications": [...]}
+
+Delivery is at-least-once per channel. Each row records the channels that
+have already delivered it, so when one channel fails only that channel is
+retried (exponential backoff with jitter; rows are marked dead after
+MAX_ATTEMPTS). Receivers can dedupe on the notification "id". With no
+usable channel configured, the dispatcher does not start and rows stay
+pending.
+
+    python notifications.py dispatch              # standalone dispatcher for database.db
+    python notifications.py webhook-sink 8025     # local stand-in webhook receiver
+"""
+import functools
+import json
+import os
+import random
+import smtplib
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from email.message import EmailMessage
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from shards import ShardMap
+
+BATCH_SIZE = 100
+POLL_SECONDS = 5
+CLAIM_SECONDS = 60          # a crashed dispatcher's batch becomes claimable again after this
+BACKOFF_BASE_SECONDS = 5
+BACKOFF_MAX_SECONDS = 3600
+MAX_ATTEMPTS = 8
+SENT_RETENTION_SECONDS = 7 * 86400
+
+EVENTS = {
+    "driver_accepted": (
+        "Your driver is on the way",
+        "{driver_name} ({vehicle}) accepted your ride from {pickup} to {dropoff}.",
+    ),
+    "driver_arrived": (
+        "Your driver has arrived",
+        "{driver_name} ({vehicle}) is waiting for you at {pickup}.",
+    ),
+    "picked_up": (
+        "Your trip has started",
+        "Your driver has picked you up. Enjoy the ride to {dropoff}.",
+    ),
+    "ride_completed": (
+        "Your trip receipt",
+        "You have arrived at {dropoff}. Fare: EGP {fare}.",
+    ),
+    "ride_cancelled": (
+        "Ride cancelled",
+        "Ride #{ride_id} from {pickup} to {dropoff} has been cancelled.",
+    ),
+}
+
+
+def enqueue(cursor, ride_id, event, recipient="passenger"):
+    """
+    Queue `event` for the ride's passenger or assigned driver, in the
+    caller's transaction. Call Dispatcher.wake() after committing.
+    """
+    now = int(time.time())
+    if recipient == "passenger":
+        cursor.execute(
+            """
+            INSERT INTO notification_outbox (ride_id, user_id, event, created_at, next_attempt_at)
+            SELECT id, passenger_id, ?, ?, ? FROM rides WHERE id = ?
+            """,
+            (event, now, now, ride_id),
+        )
+    else:
+        cursor.execute(
+            """
+            INSERT INTO notification_outbox (ride_id, user_id, event, created_at, next_attempt_at)
+            SELECT r.id, d.user_id, ?, ?, ? FROM rides r JOIN drivers d ON d.id = r.driver_id WHERE r.id = ?
+            """,
+            (event, now, now, ride_id),
+        )
+
+
+# ---------------- channels ----------------
+
+def mask_email(email):
+    local, _, domain = (email or "").partition("@")
+    return f"{local[:1]}***@{domain}" if domain else "***"
+
+
+class LogChannel:
+    name = "log"
+
+    def __init__(self, show_content=False):
+        # Off by default: the log would otherwise hold every rider's email and trip
+        self.show_content = show_content
+
+    def send(self, messages):
+        for m in messages:
+            if self.show_content:
+                print(f"[notify] #{m['id']} to {m['to_email']}: {m['subject']} - {m['text']}")
+            else:
+                print(f"[notify] #{m['id']} {m['event']} to {mask_email(m['to_email'])}")
+
+
+class SmtpChannel:
+    name = "smtp"
+
+    def __init__(self, host="localhost", port=1025, sender="no-reply@ridehail.com", timeout=10):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.timeout = timeout
+
+    def send(self, messages):
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            for m in messages:
+                msg = EmailMessage()
+                msg["From"] = self.sender
+                msg["To"] = m["to_email"]
+                msg["Subject"] = m["subject"]
+                msg["X-Notification-Id"] = str(m["id"])
+                msg.set_content(m["text"])
+                smtp.send_message(msg)
+
+
+class WebhookChannel:
+    name = "webhook"
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, messages):
+        body = json.dumps({"notifications": messages}).encode("utf-8")
+        req = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            if resp.status >= 300:
+                raise OSError(f"webhook returned HTTP {resp.status}")
+
+
+def channels_from_config(config):
+    """
+    Build channels from NOTIFY_CHANNELS ("log", "smtp", "webhook", comma separated).
+    """
+    channels = []
+    for name in (n.strip() for n in config.get("NOTIFY_CHANNELS", "log").split(",")):
+        if name == "log":
+            channels.append(LogChannel(str(config.get("NOTIFY_LOG_CONTENT", "0")) in ("1", "True")))
+        elif name == "smtp":
+            channels.append(SmtpChannel(config.get("NOTIFY_SMTP_HOST", "localhost"), int(config.get("NOTIFY_SMTP_PORT", 1025))))
+        elif name == "webhook" and config.get("NOTIFY_WEBHOOK_URL"):
+            channels.append(WebhookChannel(config["NOTIFY_WEBHOOK_URL"]))
+        elif name:
+            print(f"[notify] Ignoring unknown or unconfigured channel {name!r}")
+    return channels
+
+
+# ---------------- dispatcher ----------------
+
+def backoff_seconds(attempts):
+    delay = min(BACKOFF_BASE_SECONDS * 2 ** attempts, BACKOFF_MAX_SECONDS)
+    return int(delay * (0.5 + random.random()))
+
+
+class Dispatcher:
+    def __init__(self, connectors, channels, batch_size=BATCH_SIZE, poll_seconds=POLL_SECONDS, ride_query=None):
+        self.connectors = connectors    # one connect() per database holding an outbox
+        self.channels = channels
+        # ride_query(sql, ids) looks rides up wherever they are stored (see shards.py)
+        self.ride_query = ride_query
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.enabled = True
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.stats = {"sent": 0, "retried": 0, "dead": 0}
+
+    def wake(self):
+        """
+        Nudge the background thread (starting it in this process if needed).
+        Costs an Event.set(); never blocks the caller on delivery.
+        """
+        if not self.enabled:
+            return
+        if self.pid != os.getpid():
+            self.start()
+        self.wakeup.set()
+
+    def start(self):
+        if not self.channels:
+            print("[notify] No notification channels configured; leaving the outbox pending")
+            return
+        with self.lock:
+            # Threads do not survive fork(), so each worker starts its own
+            if self.pid == os.getpid() and self.thread and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.loop, name="notification-dispatcher", daemon=True)
+            self.thread.start()
+
+    def loop(self):
+        while True:
+            self.wakeup.wait(self.poll_seconds)
+            self.wakeup.clear()
+            try:
+                while self.run_once() == self.batch_size:
+                    pass
+            except Exception as e:  # keep the thread alive through DB hiccups
+                print(f"[notify] Dispatcher pass failed: {e}")
+
+    def claim(self, conn, now):
+        token = uuid.uuid4().hex
+        with conn:
+            conn.execute(
+                """
+                UPDATE notification_outbox
+                SET claim = ?, claimed_until = ?
+                WHERE id IN (
+                    SELECT id FROM notification_outbox
+                    WHERE status = 'pending' AND next_attempt_at <= ?
+                      AND (claimed_until IS NULL OR claimed_until < ?)
+                    ORDER BY next_attempt_at, id
+                    LIMIT ?
+                )
+                """,
+                (token, now + CLAIM_SECONDS, now, now, self.batch_size),
+            )
+        return conn.execute(
+            """
+            SELECT o.id, o.ride_id, o.event, o.attempts, o.delivered, u.email, u.name
+            FROM notification_outbox o
+            JOIN users u ON u.id = o.user_id
+            WHERE o.claim = ?
+            ORDER BY o.id
+            """,
+            (token,),
+        ).fetchall()
+
+    def fetch_rides(self, conn, ride_ids):
+        sql = """
+            SELECT r.id, r.pickup_address, r.dropoff_address, r.final_fare,
+                   du.name AS driver_name, d.vehicle_info
+            FROM rides r
+            LEFT JOIN drivers d ON d.id = r.driver_id
+            LEFT JOIN users du ON du.id = d.user_id
+            WHERE r.id IN ({ids})
+        """
+        ids = list(ride_ids)
+        if self.ride_query:
+            rows = self.ride_query(sql, ids)
+        else:
+            rows = conn.execute(sql.format(ids=", ".join("?" for _ in ids)), ids).fetchall()
+        return {r["id"]: r for r in rows}
+
+    @staticmethod
+    def render(row, ride):
+        subject, template = EVENTS.get(row["event"], (row["event"], "Update on ride #{ride_id}."))
+        text = template.format(
+            ride_id=row["ride_id"],
+            pickup=ride["pickup_address"] if ride else "-",
+            dropoff=ride["dropoff_address"] if ride else "-",
+            driver_name=(ride and ride["driver_name"]) or "Your driver",
+            vehicle=(ride and ride["vehicle_info"]) or "vehicle",
+            fare=f"{ride['final_fare']:.2f}" if ride and ride["final_fare"] is not None else "-",
+        )
+        return {
+            "id": row["id"],
+            "event": row["event"],
+            "ride_id": row["ride_id"],
+            "to_email": row["email"],
+            "to_name": row["name"],
+            "subject": subject,
+            "text": text,
+        }
+
+    def run_once(self):
+        """
+        Claim, deliver and record one batch from each outbox. Returns the
+        largest batch size.
+        """
+        if not self.channels:
+            return 0
+        return max((self.run_outbox(connect) for connect in self.connectors), default=0)
+
+    def run_outbox(self, connect):
+        now = int(time.time())
+        conn = connect()
+        try:
+            rows = self.claim(conn, now)
+            if not rows:
+                with conn:
+                    conn.execute(
+                        "DELETE FROM notification_outbox WHERE status = 'sent' AND next_attempt_at < ?",
+                        (now - SENT_RETENTION_SECONDS,),
+                    )
+                return 0
+
+            rides = self.fetch_rides(conn, {r["ride_id"] for r in rows})
+            messages = {r["id"]: self.render(r, rides.get(r["ride_id"])) for r in rows}
+            delivered = {r["id"]: set(filter(None, r["delivered"].split(","))) for r in rows}
+            errors = []
+            for channel in self.channels:
+                # Only what this channel has not delivered on an earlier attempt
+                batch = [messages[r["id"]] for r in rows if channel.name not in delivered[r["id"]]]
+                if not batch:
+                    continue
+                try:
+                    channel.send(batch)
+                except Exception as e:
+                    errors.append(f"{channel.name}: {e}")
+                    continue
+                for m in batch:
+                    delivered[m["id"]].add(channel.name)
+
+            now = int(time.time())
+            wanted = {channel.name for channel in self.channels}
+            sent, updates = [], []
+            for r in rows:
+                channels = ",".join(sorted(delivered[r["id"]]))
+                if wanted <= delivered[r["id"]]:
+                    sent.append((now, channels, r["id"]))
+                    continue
+                attempts = r["attempts"] + 1
+                status = "dead" if attempts >= MAX_ATTEMPTS else "pending"
+                self.stats["dead" if status == "dead" else "retried"] += 1
+                updates.append((status, now + backoff_seconds(attempts), "; ".join(errors), channels, r["id"]))
+            with conn:
+                conn.executemany(
+                    "UPDATE notification_outbox SET status = 'sent', attempts = attempts + 1, next_attempt_at = ?, delivered = ?, claim = NULL, claimed_until = NULL, last_error = NULL WHERE id = ?",
+                    sent,
+                )
+                conn.executemany(
+                    "UPDATE notification_outbox SET status = ?, attempts = attempts + 1, next_attempt_at = ?, last_error = ?, delivered = ?, claim = NULL, claimed_until = NULL WHERE id = ?",
+                    updates,
+                )
+            self.stats["sent"] += len(sent)
+            if updates:
+                print(f"[notify] Delivery of {len(updates)} notifications failed ({'; '.join(errors)}); will retry")
+            return len(rows)
+        finally:
+            conn.close()
+
+
+# ---------------- local stand-ins ----------------
+
+class WebhookSinkHandler(BaseHTTPRequestHandler):
+    """
+    Accepts webhook batches and keeps every notification in `received`.
+    Subclass with status = 500 to stand in for a failing receiver.
+    """
+    status = 204
+    quiet = False
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.status < 300:
+            for m in json.loads(body or b"{}").get("notifications", []):
+                type(self).received.append(m)
+                if not self.quiet:
+                    print(f"[webhook-sink] #{m['id']} {m['event']} -> {mask_email(m['to_email'])}", flush=True)
+        self.send_response(self.status)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    if len(sys.argv) >= 2 and sys.argv[1] == "webhook-sink":
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 8025
+        print(f"[webhook-sink] Listening on http://127.0.0.1:{port}/")
+        ThreadingHTTPServer(("127.0.0.1", port), WebhookSinkHandler).serve_forever()
+    elif len(sys.argv) >= 2 and sys.argv[1] == "dispatch":
+        shard_map = ShardMap("database.db", os.environ.get("REGIONS_PATH", os.path.join("data", "regions.csv")))
+        channels = channels_from_config(os.environ)
+        if not channels:
+            sys.exit("[notify] No usable channel in NOTIFY_CHANNELS; not dispatching")
+        dispatcher = Dispatcher(
+            [functools.partial(shard_map.connect, region) for region in shard_map.regions],
+            channels,
+            ride_query=shard_map.by_ids,
+        )
+        dispatcher.pid = os.getpid()
+        dispatcher.loop()
+    else:
+        print("usage: python notifications.py dispatch | webhook-sink [port]")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Shared-ride (pooling) matcher.
+
+Two waiting requests are compatible when one driver can serve both, with
+pickups and dropoffs interleaved in some order, and each passenger's
+in-car distance stays within their direct distance plus the allowed
+detour. Candidate partners come from a spatial-temporal grid index:
+pickup cell x request minute. Each request is only compared with requests
+picked up nearby at about the same time, never with the whole queue.
+
+Benchmark of match rate versus solve time (index vs. all-pairs):
+
+    python pooling.py
+"""
+import random
+import sys
+import time
+
+from routing import haversine_km
+
+ROAD_FACTOR = 1.3           # same straight-line -> road approximation as the quote fallback
+MAX_DETOUR = 0.4            # each rider may travel up to 40% further than alone...
+MIN_SLACK_KM = 1.0          # ...or at least 1 km, so short trips are not impossible to pool
+MAX_PICKUP_GAP_KM = 2.0
+WINDOW_MINUTES = 5
+CELL_DEG = 0.01             # ~1.1 km grid for the pickup index
+
+
+def road_km(a, b):
+    return haversine_km(a[0], a[1], b[0], b[1]) * ROAD_FACTOR
+
+
+class PoolRequest:
+    __slots__ = ("ride_id", "pickup", "dropoff", "minute", "direct_km")
+
+    def __init__(self, ride_id, pickup_lat, pickup_lng, dropoff_lat, dropoff_lng, created_ts):
+        self.ride_id = ride_id
+        self.pickup = (pickup_lat, pickup_lng)
+        self.dropoff = (dropoff_lat, dropoff_lng)
+        self.minute = int(created_ts // 60)
+        self.direct_km = road_km(self.pickup, self.dropoff)
+
+
+def pair_plan(a, b, max_detour=MAX_DETOUR):
+    """
+    Best stop order for serving a and b together, or None if incompatible.
+    Returns (saved_km, stops) where stops is a list of (ride_id, "pickup"|"dropoff").
+    """
+    if haversine_km(*a.pickup, *b.pickup) > MAX_PICKUP_GAP_KM:
+        return None
+
+    best = None
+    # Try both pickup orders and both dropoff orders
+    for first, second in ((a, b), (b, a)):
+        gap = road_km(first.pickup, second.pickup)
+        for drop_first in (first, second):
+            drop_second = second if drop_first is first else first
+
+            leg_shared = road_km(second.pickup, drop_first.dropoff)
+            leg_last = road_km(drop_first.dropoff, drop_second.dropoff)
+
+            # Distance each rider spends in the car
+            if drop_first is first:
+                ride_first = gap + leg_shared
+                ride_second = leg_shared + leg_last
+            else:
+                ride_first = gap + leg_shared + leg_last
+                ride_second = leg_shared
+
+            if ride_first - first.direct_km > max(max_detour * first.direct_km, MIN_SLACK_KM):
+                continue
+            if ride_second - second.direct_km > max(max_detour * second.direct_km, MIN_SLACK_KM):
+                continue
+
+            total = gap + leg_shared + leg_last
+            saved = first.direct_km + second.direct_km - total
+            if saved > 0 and (best is None or saved > best[0]):
+                stops = [
+                    (first.ride_id, "pickup"),
+                    (second.ride_id, "pickup"),
+                    (drop_first.ride_id, "dropoff"),
+                    (drop_second.ride_id, "dropoff"),
+                ]
+                best = (saved, stops)
+    return best
+
+
+class PoolIndex:
+    """
+    Grid of pickup cells x request minute -> requests not yet pooled.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+
+    @staticmethod
+    def key(request):
+        return (
+            int(request.pickup[0] // CELL_DEG),
+            int(request.pickup[1] // CELL_DEG),
+            request.minute,
+        )
+
+    def add(self, request):
+        self.buckets.setdefault(self.key(request), []).append(request)
+
+    def remove(self, request):
+        bucket = self.buckets.get(self.key(request))
+        if bucket and request in bucket:
+            bucket.remove(request)
+            if not bucket:
+                del self.buckets[self.key(request)]
+
+    def candidates(self, request):
+        cy, cx, minute = self.key(request)
+        reach = int(MAX_PICKUP_GAP_KM / (CELL_DEG * 111)) + 1
+        for dy in range(-reach, reach + 1):
+            for dx in range(-reach, reach + 1):
+                for dm in range(-WINDOW_MINUTES, WINDOW_MINUTES + 1):
+                    for other in self.buckets.get((cy + dy, cx + dx, minute + dm), ()):
+                        if other is not request:
+                            yield other
+
+
+def best_partner(request, candidates, max_detour=MAX_DETOUR):
+    """
+    The compatible candidate with the largest distance saving, as
+    (partner, saved_km, stops), or None.
+    """
+    best = None
+    for other in candidates:
+        if abs(other.minute - request.minute) > WINDOW_MINUTES:
+            continue
+        plan = pair_plan(request, other, max_detour)
+        if plan and (best is None or plan[0] > best[1]):
+            best = (other, plan[0], plan[1])
+    return best
+
+
+def match_batch(requests, max_detour=MAX_DETOUR, use_index=True):
+    """
+    Greedy pairing of a batch of requests in arrival order.
+    Returns a list of (request_a, request_b, saved_km, stops).
+    """
+    pairs = []
+    if use_index:
+        index = PoolIndex()
+        for r in requests:
+            index.add(r)
+    unmatched = set(id(r) for r in requests)
+
+    for r in sorted(requests, key=lambda x: x.minute):
+        if id(r) not in unmatched:
+            continue
+        pool = index.candidates(r) if use_index else requests
+        found = best_partner(r, (o for o in pool if o is not r and id(o) in unmatched), max_detour)
+        if found:
+            partner, saved, stops = found
+            unmatched.discard(id(r))
+            unmatched.discard(id(partner))
+            if use_index:
+                index.remove(r)
+                index.remove(partner)
+            pairs.append((r, partner, saved, stops))
+    return pairs
+
+
+def benchmark(sizes=(500, 2000, 8000), seed=7):
+    rng = random.Random(seed)
+    print(f"{'requests':>8} {'mode':>8} {'matched':>8} {'rate':>6} {'saved km':>9} {'solve ms':>9}")
+    for n in sizes:
+        # n requests spread over an hour across a ~30 x 40 km city
+        requests = []
+        for i in range(n):
+            plat, plng = 29.95 + rng.random() * 0.27, 31.10 + rng.random() * 0.40
+            dlat, dlng = 29.95 + rng.random() * 0.27, 31.10 + rng.random() * 0.40
+            requests.append(PoolRequest(i, plat, plng, dlat, dlng, rng.random() * 3600))
+
+        modes = [("index", True)]
+        if n <= 2000:
+            modes.append(("pairs", False))
+        for label, use_index in modes:
+            started = time.perf_counter()
+            pairs = match_batch(requests, use_index=use_index)
+            solve_ms = (time.perf_counter() - started) * 1000
+            matched = 2 * len(pairs)
+            saved = sum(p[2] for p in pairs)
+            print(f"{n:>8} {label:>8} {matched:>8} {matched / n:>6.1%} {saved:>9.1f} {solve_ms:>9.1f}")
+
+
+if __name__ == "__main__":
+    benchmark(tuple(int(x) for x in sys.argv[1:]) or (500, 2000, 8000))
@@ -0,0 +1,44 @@
+"""
+Fare tariff shared by the quote page and anything that needs to price a trip.
+"""
+
+BASE_FARE = 15.0        # starting fee
+PER_KM = 5.0            # per km
+PER_MIN = 0.3           # per minute in traffic
+SERVICE_FEE = 3.0       # fixed platform fee
+
+
+def fare_breakdown(distance_km, duration_min, surge_multiplier=1.0):
+    """
+    Price a trip. Surge scales the trip charges (base, distance and time)
+    but not the platform fee.
+    """
+    distance_charge = distance_km * PER_KM
+    duration_charge = duration_min * PER_MIN
+    trip_charge = (BASE_FARE + distance_charge + duration_charge) * surge_multiplier
+    total_fare = round(trip_charge + SERVICE_FEE, 2)
+
+    return {
+        'distance_km': distance_km,
+        'duration_min': duration_min,
+        'base_fare': BASE_FARE,
+        'distance_charge': round(distance_charge, 2),
+        'duration_charge': round(duration_charge, 2),
+        'service_fee': SERVICE_FEE,
+        'surge_multiplier': surge_multiplier,
+        'surge_charge': round(trip_charge - (BASE_FARE + distance_charge + duration_charge), 2),
+        'total_fare': total_fare
+    }
+
+
+PLATFORM_COMMISSION = 0.20  # share of the trip charge kept by the platform
+
+
+def driver_earnings(total_fare):
+    """
+    Split a charged fare into (driver_net, platform_commission).
+    The platform fee is not shared with the driver.
+    """
+    trip_charge = max(total_fare - SERVICE_FEE, 0.0)
+    commission = round(trip_charge * PLATFORM_COMMISSION, 2)
+    return round(trip_charge - commission, 2), commission
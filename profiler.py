@@ -0,0 +1,175 @@
+"""
+On-demand sampling profiler for live workers.
+
+While enabled, a background thread wakes every `interval` seconds and
+records the Python stack of each thread that is serving a profiled
+request. Stacks are counted per route in collapsed form, one line per
+distinct stack:
+
+    driver_dashboard;dispatch_request (app.py:1850);render_template (templating.py:138) 37
+
+which flamegraph.pl, speedscope and inferno read directly. A request is
+profiled when its endpoint ("web.<view>") is in `routes`, when it
+carries the trigger header with the configured token, or otherwise with
+probability `rate`.
+
+/api/v1 requests (api.py) use the same routes, named "api.<handler>".
+Their blocking work runs on the database pool, so those threads are
+sampled while they work for a profiled request; time a handler spends
+awaiting on the event loop does not show up.
+
+When disabled there is no sampler thread (it starts with the first
+profiled request) and the request hook only checks one attribute. The
+profile lives in the worker that collected it; each download says which
+pid it came from.
+"""
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+DEFAULT_INTERVAL = 0.005
+MAX_DEPTH = 128
+
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    def __init__(self, rate=0.0, routes=(), token=None, interval=DEFAULT_INTERVAL):
+        self.enabled = False
+        self.rate = rate
+        self.routes = set(routes)
+        self.token = token
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {}            # thread id -> route being profiled
+        self.stacks = defaultdict(Counter)
+        self.requests = Counter()   # profiled requests per route
+        self.samples = 0
+        self.started_at = None
+        self.thread = None
+        self.thread_pid = None      # the sampler does not survive a fork, see begin()
+
+    # ---------------- control ----------------
+
+    def start(self):
+        with self.lock:
+            self.enabled = True
+            self.started_at = self.started_at or time.time()
+
+    def stop(self):
+        with self.lock:
+            self.enabled = False
+            thread, self.thread, self.thread_pid = self.thread, None, None
+        if thread is not None and thread.is_alive():
+            thread.join()
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+            self.requests.clear()
+            self.samples = 0
+            self.started_at = time.time() if self.enabled else None
+
+    # ---------------- requests ----------------
+
+    def wants(self, endpoint, header_value):
+        if endpoint in self.routes:
+            return True
+        if self.token and header_value == self.token:
+            return True
+        return self.rate > 0 and random.random() < self.rate
+
+    def begin(self, route, count=True):
+        """
+        Sample the calling thread for route until end(). count=False adds
+        a thread to a request that was already counted (see api.db).
+        """
+        with self.lock:
+            if self.thread_pid != os.getpid():
+                # Started lazily, so a profiler enabled before gunicorn forks
+                # still gets a sampler thread in each worker
+                self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+                self.thread_pid = os.getpid()
+                self.thread.start()
+            self.active[threading.get_ident()] = route
+            if count:
+                self.requests[route] += 1
+
+    def count(self, route):
+        """
+        Count a profiled request whose work runs on other threads.
+        """
+        with self.lock:
+            self.requests[route] += 1
+
+    def end(self):
+        with self.lock:
+            self.active.pop(threading.get_ident(), None)
+
+    # ---------------- sampling ----------------
+
+    def run(self):
+        own = threading.get_ident()
+        while self.enabled:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    continue
+                active = dict(self.active)
+            frames = sys._current_frames()
+            collected = []
+            for thread_id, route in active.items():
+                frame = frames.get(thread_id)
+                if frame is None or thread_id == own:
+                    continue
+                labels = []
+                while frame is not None and len(labels) < MAX_DEPTH:
+                    labels.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                labels.reverse()
+                collected.append((route, ";".join(labels)))
+            del frames
+
+            with self.lock:
+                for route, stack in collected:
+                    self.stacks[route][stack] += 1
+                self.samples += len(collected)
+
+    # ---------------- output ----------------
+
+    def collapsed(self, route=None):
+        """
+        Collapsed stacks with the route as the root frame, heaviest first.
+        """
+        with self.lock:
+            stacks = {r: dict(c) for r, c in self.stacks.items() if route is None or r == route}
+        lines = [
+            (count, f"{r};{stack} {count}")
+            for r, counter in stacks.items()
+            for stack, count in counter.items()
+        ]
+        lines.sort(key=lambda line: -line[0])
+        return "".join(line + "\n" for _, line in lines)
+
+    def report(self):
+        with self.lock:
+            routes = {
+                route: {"requests": self.requests[route], "samples": sum(self.stacks[route].values())}
+                for route in self.requests
+            }
+            return {
+                "enabled": self.enabled,
+                "rate": self.rate,
+                "routes": sorted(self.routes),
+                "header_trigger": self.token is not None,
+                "interval_ms": round(self.interval * 1000, 3),
+                "started_at": self.started_at,
+                "samples": self.samples,
+                "in_flight": len(self.active),
+                "profiled": routes,
+            }
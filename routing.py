@@ -0,0 +1,373 @@
+"""
+Offline road-network routing for fare and ETA quotes.
+
+The road graph is a plain text file converted offline from an OSM extract:
+
+    # comment
+    n <node_id> <lat> <lng>
+    e <from_node_id> <to_node_id> <length_m> <speed_kmh> [oneway]
+
+Edges are two-way unless `oneway` is 1. Nodes must appear before the
+edges that use them. The graph is held in CSR (compressed sparse row)
+arrays, and queries run A* with ALT landmark bounds (A*, Landmarks,
+Triangle inequality). Landmark tables are precomputed once and cached
+next to the graph file as `<graph>.alt`.
+
+Quick check from the command line:
+
+    python routing.py data/roads.graph 30.0444 31.2357 30.0626 31.2468
+"""
+import hashlib
+import heapq
+import math
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from functools import lru_cache
+
+INF = float("inf")
+GRID_DEG = 0.01             # spatial grid cell for snapping (~1 km)
+MAX_SNAP_KM = 2.0           # coordinates further than this from any road are not routed
+DEFAULT_LANDMARKS = 8
+ALT_MAGIC = b"ALT2"
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 6371 * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def straight_line_trip(lat1, lon1, lat2, lon2):
+    """
+    Fallback (distance_km, duration_min) when no road route is available:
+    road distance ~1.3x the straight line (clamped to 1..40 km), and
+    ~3 minutes per km + 5 minutes overhead.
+    """
+    distance_km = round(max(1.0, min(haversine_km(lat1, lon1, lat2, lon2) * 1.3, 40.0)), 1)
+    return distance_km, round(distance_km * 3 + 5)
+
+
+def build_csr(n, sources, targets, *weights):
+    """
+    Pack an edge list into CSR arrays: offsets[v]..offsets[v+1] index the
+    out-edges of v in the returned target / weight arrays.
+    """
+    counts = array("i", bytes(4 * (n + 1)))
+    for u in sources:
+        counts[u + 1] += 1
+    for v in range(n):
+        counts[v + 1] += counts[v]
+    offsets = array("i", counts)
+
+    fill = array("i", offsets)
+    out_targets = array("i", bytes(4 * len(targets)))
+    out_weights = [array("f", bytes(4 * len(targets))) for _ in weights]
+    for i, u in enumerate(sources):
+        pos = fill[u]
+        fill[u] += 1
+        out_targets[pos] = targets[i]
+        for w_out, w_in in zip(out_weights, weights):
+            w_out[pos] = w_in[i]
+    return offsets, out_targets, out_weights
+
+
+class RoadGraph:
+    def __init__(self, lats, lngs, sources, targets, lengths_m, times_s):
+        self.n = len(lats)
+        self.lats = lats
+        self.lngs = lngs
+
+        self.offsets, self.targets, (self.times, self.lengths) = build_csr(
+            self.n, sources, targets, times_s, lengths_m
+        )
+        # Reverse graph, only needed for "distance to landmark" tables
+        self.r_offsets, self.r_targets, (self.r_times,) = build_csr(
+            self.n, targets, sources, times_s
+        )
+
+        self.grid = {}
+        for v in range(self.n):
+            cell = (int(lats[v] // GRID_DEG), int(lngs[v] // GRID_DEG))
+            self.grid.setdefault(cell, array("i")).append(v)
+
+        self.landmarks = array("i")
+        self.from_lm = array("d")   # from_lm[k * n + v] = time(L_k -> v)
+        self.to_lm = array("d")     # to_lm[k * n + v]   = time(v -> L_k)
+        self.route = lru_cache(maxsize=8192)(self._route)
+
+    # ---------------- loading ----------------
+
+    @classmethod
+    def from_file(cls, path):
+        index = {}
+        lats, lngs = array("d"), array("d")
+        sources, targets = array("i"), array("i")
+        lengths, times = array("f"), array("f")
+
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.split()
+                if not parts or parts[0].startswith("#"):
+                    continue
+                if parts[0] == "n":
+                    index[parts[1]] = len(lats)
+                    lats.append(float(parts[2]))
+                    lngs.append(float(parts[3]))
+                elif parts[0] == "e":
+                    u, v = index[parts[1]], index[parts[2]]
+                    length_m = float(parts[3])
+                    speed_kmh = max(float(parts[4]), 1.0)
+                    travel_s = length_m / (speed_kmh / 3.6)
+                    oneway = len(parts) > 5 and parts[5] == "1"
+
+                    sources.append(u)
+                    targets.append(v)
+                    lengths.append(length_m)
+                    times.append(travel_s)
+                    if not oneway:
+                        sources.append(v)
+                        targets.append(u)
+                        lengths.append(length_m)
+                        times.append(travel_s)
+
+        graph = cls(lats, lngs, sources, targets, lengths, times)
+        graph.load_or_build_landmarks(path + ".alt")
+        return graph
+
+    # ---------------- landmarks (ALT) ----------------
+
+    def dijkstra(self, source, reverse=False):
+        """
+        Single-source travel times (seconds) to every node.
+        """
+        offsets, targets, times = (
+            (self.r_offsets, self.r_targets, self.r_times) if reverse
+            else (self.offsets, self.targets, self.times)
+        )
+        dist = array("d", [INF]) * self.n
+        dist[source] = 0.0
+        heap = [(0.0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            for i in range(offsets[u], offsets[u + 1]):
+                v = targets[i]
+                nd = d + times[i]
+                if nd < dist[v]:
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        return dist
+
+    def build_landmarks(self, k=DEFAULT_LANDMARKS):
+        """
+        Farthest-point landmark selection: each new landmark is the node
+        furthest (in travel time) from all landmarks chosen so far.
+        """
+        if self.n == 0:
+            return
+        k = min(k, self.n)
+        self.landmarks = array("i")
+        self.from_lm = array("d")
+        self.to_lm = array("d")
+
+        closest = array("d", [INF]) * self.n
+        candidate = 0
+        for _ in range(k):
+            self.landmarks.append(candidate)
+            forward = self.dijkstra(candidate)
+            self.from_lm.extend(forward)
+            self.to_lm.extend(self.dijkstra(candidate, reverse=True))
+
+            best, best_d = candidate, -1.0
+            for v in range(self.n):
+                if forward[v] < closest[v]:
+                    closest[v] = forward[v]
+                if closest[v] != INF and closest[v] > best_d:
+                    best, best_d = v, closest[v]
+            if best in self.landmarks:
+                break
+            candidate = best
+
+    def fingerprint(self):
+        """
+        SHA-256 over everything landmark distances depend on: node
+        coordinates, edges and travel times.
+        """
+        digest = hashlib.sha256()
+        for values in (self.lats, self.lngs, self.offsets, self.targets, self.times):
+            digest.update(values.tobytes())
+        return digest.digest()
+
+    def load_or_build_landmarks(self, cache_path, k=DEFAULT_LANDMARKS):
+        """
+        Reuse landmark tables from cache_path when they were built from this
+        exact graph, otherwise compute them and write the cache for the next
+        start. A same-sized but edited graph must not reuse old distances:
+        stale bounds are not admissible and A* would return wrong routes.
+        """
+        fingerprint = self.fingerprint()
+        try:
+            with open(cache_path, "rb") as f:
+                magic, n, count, stored = struct.unpack("<4sii32s", f.read(44))
+                if magic == ALT_MAGIC and n == self.n and stored == fingerprint:
+                    self.landmarks = array("i")
+                    self.landmarks.fromfile(f, count)
+                    self.from_lm = array("d")
+                    self.from_lm.fromfile(f, count * n)
+                    self.to_lm = array("d")
+                    self.to_lm.fromfile(f, count * n)
+                    return
+        except (OSError, EOFError, struct.error):
+            pass
+
+        self.build_landmarks(k)
+        try:
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(struct.pack("<4sii32s", ALT_MAGIC, self.n, len(self.landmarks), fingerprint))
+                self.landmarks.tofile(f)
+                self.from_lm.tofile(f)
+                self.to_lm.tofile(f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"[routing] Could not write landmark cache {cache_path}: {e}")
+
+    def lower_bound(self, v, t):
+        """
+        Admissible lower bound on time(v -> t) from the triangle inequality.
+        """
+        n = self.n
+        best = 0.0
+        for k in range(len(self.landmarks)):
+            base = k * n
+            a, b = self.from_lm[base + t], self.from_lm[base + v]
+            if a != INF and b != INF and a - b > best:
+                best = a - b
+            a, b = self.to_lm[base + v], self.to_lm[base + t]
+            if a != INF and b != INF and a - b > best:
+                best = a - b
+        return best
+
+    # ---------------- queries ----------------
+
+    def nearest_node(self, lat, lng):
+        """
+        Closest graph node within MAX_SNAP_KM, or None.
+        """
+        cy, cx = int(lat // GRID_DEG), int(lng // GRID_DEG)
+        cos_lat = max(math.cos(math.radians(lat)), 0.01)
+        # Cells are GRID_DEG tall but only GRID_DEG * cos(lat) wide (distances
+        # below are in degrees of latitude), so the narrow side bounds the rings
+        cell = GRID_DEG * min(1.0, cos_lat)
+        reach = int(MAX_SNAP_KM / (cell * 111.2)) + 1
+        best, best_d = None, INF
+
+        for ring in range(reach + 1):
+            for dy in range(-ring, ring + 1):
+                for dx in range(-ring, ring + 1):
+                    if max(abs(dy), abs(dx)) != ring:
+                        continue
+                    for v in self.grid.get((cy + dy, cx + dx), ()):
+                        d = (self.lats[v] - lat) ** 2 + ((self.lngs[v] - lng) * cos_lat) ** 2
+                        if d < best_d:
+                            best, best_d = v, d
+            # Anything in a further ring is at least `ring` cell widths away
+            if best is not None and math.sqrt(best_d) <= ring * cell:
+                break
+
+        if best is None or math.sqrt(best_d) * 111.2 > MAX_SNAP_KM:
+            return None
+        return best
+
+    def shortest_path(self, s, t):
+        """
+        ALT A* by travel time. Returns (seconds, meters) or None if unreachable.
+        """
+        if s == t:
+            return 0.0, 0.0
+        dist = {s: 0.0}
+        length = {s: 0.0}
+        done = set()
+        heap = [(self.lower_bound(s, t), s)]
+        offsets, targets, times, lengths = self.offsets, self.targets, self.times, self.lengths
+
+        while heap:
+            _, u = heapq.heappop(heap)
+            if u in done:
+                continue
+            if u == t:
+                return dist[t], length[t]
+            done.add(u)
+            du = dist[u]
+            for i in range(offsets[u], offsets[u + 1]):
+                v = targets[i]
+                nd = du + times[i]
+                if nd < dist.get(v, INF):
+                    dist[v] = nd
+                    length[v] = length[u] + lengths[i]
+                    heapq.heappush(heap, (nd + self.lower_bound(v, t), v))
+        return None
+
+    def _route(self, lat1, lng1, lat2, lng2):
+        s = self.nearest_node(lat1, lng1)
+        t = self.nearest_node(lat2, lng2)
+        if s is None or t is None:
+            return None
+        found = self.shortest_path(s, t)
+        if found is None:
+            return None
+        seconds, meters = found
+        return {"distance_km": meters / 1000.0, "duration_min": seconds / 60.0}
+
+    def route_between(self, lat1, lng1, lat2, lng2):
+        """
+        Road distance / time between two coordinates, or None when either end
+        is off the network. Coordinates are rounded to ~1 m so repeated quotes
+        for the same pair hit the LRU cache.
+        """
+        return self.route(round(lat1, 5), round(lng1, 5), round(lat2, 5), round(lng2, 5))
+
+
+_graphs = {}
+_graph_lock = threading.Lock()
+
+
+def get_road_graph(path):
+    """
+    Load (once per process) the road graph at `path`, or return None when
+    no graph file is installed, in which case callers fall back to the
+    straight-line estimate.
+    """
+    if path in _graphs:
+        return _graphs[path]
+    with _graph_lock:
+        if path not in _graphs:
+            graph = None
+            if path and os.path.exists(path):
+                try:
+                    started = time.perf_counter()
+                    graph = RoadGraph.from_file(path)
+                    print(f"[routing] Loaded {graph.n} nodes from {path} in {time.perf_counter() - started:.2f}s")
+                except (OSError, ValueError, KeyError, IndexError) as e:
+                    print(f"[routing] Could not load road graph {path}: {e}")
+            _graphs[path] = graph
+    return _graphs[path]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 6:
+        print("usage: python routing.py <graph-file> <lat1> <lng1> <lat2> <lng2>")
+        sys.exit(1)
+    graph = get_road_graph(sys.argv[1])
+    if graph is None:
+        sys.exit(1)
+    coords = [float(x) for x in sys.argv[2:]]
+    started = time.perf_counter()
+    result = graph.route_between(*coords)
+    print(result, f"({(time.perf_counter() - started) * 1000:.2f} ms)")
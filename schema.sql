@@ -25,6 +25,7 @@ CREATE TABLE IF NOT EXISTS driver_status (
     driver_id INTEGER NOT NULL,
     is_online INTEGER NOT NULL DEFAULT 0,
     last_change TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    active_ride_id INTEGER,             -- ride (or pool id) the driver is committed to; see claim_driver
     FOREIGN KEY(driver_id) REFERENCES drivers(id)
 );
 -- Rides table
@@ -41,4 +42,156 @@ CREATE TABLE IF NOT EXISTS rides (
                                      status TEXT DEFAULT 'requested', -- requested, estimated, waiting, accepted, completed, cancelled
                                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                                      FOREIGN KEY (passenger_id) REFERENCES users(id)
-    );
\ No newline at end of file
+    );
+
+-- Change log of rides entering / leaving the 'waiting' queue (driver delta feed)
+CREATE TABLE IF NOT EXISTS ride_feed (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ride_id INTEGER NOT NULL,
+    change TEXT NOT NULL CHECK (change IN ('added', 'removed')),
+    changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Responses remembered per Idempotency-Key so retried POSTs are replayed, not re-run
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key_hash BLOB PRIMARY KEY,          -- sha256(user | endpoint | args | key)
+    status_code INTEGER,                -- NULL while the first request is still running
+    location TEXT,
+    content_type TEXT,
+    body BLOB,
+    created_at INTEGER NOT NULL         -- unix seconds, used for TTL eviction
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys(created_at);
+
+-- Online trip-duration statistics per (pickup zone, dropoff zone, hour of week); see eta.py
+CREATE TABLE IF NOT EXISTS eta_stats (
+    pickup_zone TEXT NOT NULL,
+    dropoff_zone TEXT NOT NULL,
+    hour_of_week INTEGER NOT NULL,      -- 0..167, or -1 for "any hour"
+    n INTEGER NOT NULL,
+    mean REAL NOT NULL,                 -- minutes
+    m2 REAL NOT NULL,                   -- Welford sum of squared deviations
+    PRIMARY KEY (pickup_zone, dropoff_zone, hour_of_week)
+) WITHOUT ROWID;
+
+-- Surge pricing counters per geohash zone; see surge.py
+CREATE TABLE IF NOT EXISTS surge_counters (
+    zone TEXT NOT NULL,
+    kind TEXT NOT NULL CHECK (kind IN ('demand', 'waiting', 'idle')),
+    bucket INTEGER NOT NULL,            -- minute index for 'demand', -1 for gauges
+    value INTEGER NOT NULL,
+    PRIMARY KEY (zone, kind, bucket)
+) WITHOUT ROWID;
+
+-- GPS trace of a trip, one polyline-encoded (lat, lng, t) string per ride; see traces.py
+CREATE TABLE IF NOT EXISTS ride_traces (
+    ride_id INTEGER PRIMARY KEY,
+    encoded TEXT NOT NULL DEFAULT '',
+    points INTEGER NOT NULL DEFAULT 0,
+    last_lat INTEGER,                   -- last point, 1e-5 degrees (encoding base for appends)
+    last_lng INTEGER,
+    last_t INTEGER,                     -- unix seconds
+    distance_km REAL NOT NULL DEFAULT 0 -- running total, maintained on append
+);
+
+-- Driver earnings settlement; see settlement.py
+CREATE TABLE IF NOT EXISTS settlement_checkpoint (
+    job TEXT PRIMARY KEY,
+    completed_at TEXT NOT NULL,         -- (completed_at, ride_id) of the last settled ride
+    ride_id INTEGER NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS driver_ledger (
+    driver_id INTEGER NOT NULL,
+    period_start TEXT NOT NULL,         -- Monday of the settlement week (YYYY-MM-DD)
+    rides INTEGER NOT NULL,
+    gross_cents INTEGER NOT NULL,       -- fares charged, in piastres
+    commission_cents INTEGER NOT NULL,
+    net_cents INTEGER NOT NULL,         -- owed to the driver
+    PRIMARY KEY (driver_id, period_start)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS driver_payouts (
+    period_start TEXT PRIMARY KEY,
+    file TEXT NOT NULL,
+    drivers INTEGER NOT NULL,
+    net_cents INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Ride notifications, written in the same transaction as the status change; see notifications.py
+CREATE TABLE IF NOT EXISTS notification_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ride_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,           -- recipient
+    event TEXT NOT NULL,
+    created_at INTEGER NOT NULL,        -- unix seconds
+    next_attempt_at INTEGER NOT NULL,   -- unix seconds; delivery time once sent
+    attempts INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sent', 'dead')),
+    delivered TEXT NOT NULL DEFAULT '', -- comma-separated channels that have delivered this row
+    claim TEXT,                         -- dispatcher batch currently delivering this row
+    claimed_until INTEGER,
+    last_error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_due ON notification_outbox(status, next_attempt_at);
+
+-- Global writes made by ride transactions in a region file, applied later; see shards.py.
+-- Only region files hold entries; rides in this file write the global tables directly.
+CREATE TABLE IF NOT EXISTS core_write_journal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    args TEXT NOT NULL,                 -- JSON list
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Last journal entry applied per region file
+CREATE TABLE IF NOT EXISTS core_write_cursors (
+    region TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- Journal entries that failed to apply, kept for inspection
+CREATE TABLE IF NOT EXISTS core_write_failures (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    region TEXT NOT NULL,
+    entry_id INTEGER NOT NULL,
+    op TEXT NOT NULL,
+    args TEXT NOT NULL,
+    error TEXT,
+    failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Change counters for cached template fragments; see fragments.py
+CREATE TABLE IF NOT EXISTS data_versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS drivers_version_insert AFTER INSERT ON drivers
+BEGIN
+    INSERT INTO data_versions (name, version) VALUES ('drivers', 1)
+    ON CONFLICT(name) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS drivers_version_update AFTER UPDATE ON drivers
+BEGIN
+    INSERT INTO data_versions (name, version) VALUES ('drivers', 1)
+    ON CONFLICT(name) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS drivers_version_delete AFTER DELETE ON drivers
+BEGIN
+    INSERT INTO data_versions (name, version) VALUES ('drivers', 1)
+    ON CONFLICT(name) DO UPDATE SET version = version + 1;
+END;
+
+-- Driver cards show the driver's user row
+CREATE TRIGGER IF NOT EXISTS users_version_update AFTER UPDATE ON users
+BEGIN
+    INSERT INTO data_versions (name, version) VALUES ('drivers', 1)
+    ON CONFLICT(name) DO UPDATE SET version = version + 1;
+END;
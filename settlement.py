@@ -0,0 +1,326 @@
+"""
+Driver earnings settlement.
+
+Completed rides are settled into driver_ledger (one row per driver per
+week) in chunks, in (completed_at, id) order. Each chunk's ledger upserts
+and the settlement_checkpoint row are committed together, so an
+interrupted run resumes where it stopped and no ride is counted twice.
+Memory is bounded by the chunk size, not by the history length.
+
+Once a week is fully settled, its payout file is written to the payments
+sink (a local directory standing in for the bank/wallet transfer API):
+
+    payouts/2026-10-12.csv      driver_id, driver_name, rides, gross, commission, net
+
+Rides that complete inside an already paid week (late commits) are
+booked into the week currently open, so they are paid out next time.
+With region shards (see shards.py) each shard has its own checkpoint and
+is walked in turn; the ledger lives in the global file.
+
+    python settlement.py                          # settle database.db, write due payout files
+    python settlement.py --chunk 20000 --sink /srv/payouts
+    python settlement.py --benchmark 2000000      # synthetic history in a temp database
+"""
+import argparse
+import csv
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from pricing import driver_earnings
+from shards import ShardMap
+
+JOB = "driver_earnings"
+CHUNK_SIZE = 5000
+LAG_MINUTES = 5             # leave rides this recent for the next run (commits still in flight)
+DEFAULT_SINK = "payouts"
+EPOCH = ("", 0)             # checkpoint before the first ride
+
+# Week start (Monday) of a timestamp, in SQL
+PERIOD_SQL = "date({}, '-6 days', 'weekday 1')"
+
+
+def ensure_index(conn):
+    """
+    Settlement walks completed rides by (completed_at, id). Called from the
+    rides migration, since completed_at is itself a migrated column.
+    """
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_rides_settlement
+        ON rides(completed_at, id) WHERE status = 'completed'
+        """
+    )
+
+
+def backfill_completed_at(conn, job=JOB, fallback=None):
+    """
+    Give completed rides from before completed_at was recorded a settlement
+    time, or the checkpoint walk would never reach them: their request time,
+    or `fallback` (default now) when that is already behind the checkpoint.
+    Returns the number of rides updated.
+    """
+    with conn:
+        return conn.execute(
+            """
+            UPDATE rides SET completed_at = CASE
+                WHEN created_at > COALESCE((SELECT completed_at FROM settlement_checkpoint WHERE job = ?), '')
+                THEN created_at
+                ELSE COALESCE(?, CURRENT_TIMESTAMP)
+            END
+            WHERE status = 'completed' AND completed_at IS NULL
+            """,
+            (job, fallback),
+        ).rowcount
+
+
+def job_name(region):
+    return JOB if region.index == 0 else f"{JOB}:{region.name}"
+
+
+def read_checkpoint(conn, job=JOB):
+    row = conn.execute(
+        "SELECT completed_at, ride_id FROM settlement_checkpoint WHERE job = ?", (job,)
+    ).fetchone()
+    return (row[0], row[1]) if row else EPOCH
+
+
+def settle_chunk(conn, job, after, cutoff, open_period, paid_periods, chunk_size):
+    """
+    Settle up to chunk_size of this shard's rides after the `after` checkpoint and commit.
+    Returns (rides_read, unpriced, new_checkpoint).
+    """
+    rows = conn.execute(
+        f"""
+        SELECT id, driver_id, completed_at, final_fare, {PERIOD_SQL.format('completed_at')}
+        FROM rides
+        WHERE status = 'completed'
+          AND (completed_at, id) > (?, ?)
+          AND completed_at <= ?
+        ORDER BY completed_at, id
+        LIMIT ?
+        """,
+        (after[0], after[1], cutoff, chunk_size),
+    ).fetchall()
+    if not rows:
+        return 0, 0, after
+
+    totals = {}     # (driver_id, period_start) -> [rides, gross, commission, net] in piastres
+    unpriced = 0
+    for ride_id, driver_id, completed_at, final_fare, period in rows:
+        if driver_id is None or final_fare is None:
+            unpriced += 1
+            continue
+        if period in paid_periods:
+            period = open_period
+        net, commission = driver_earnings(final_fare)
+        entry = totals.setdefault((driver_id, period), [0, 0, 0, 0])
+        entry[0] += 1
+        entry[1] += round(final_fare * 100)
+        entry[2] += round(commission * 100)
+        entry[3] += round(net * 100)
+
+    last = (rows[-1][2], rows[-1][0])
+    with conn:
+        conn.executemany(
+            """
+            INSERT INTO driver_ledger (driver_id, period_start, rides, gross_cents, commission_cents, net_cents)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(driver_id, period_start) DO UPDATE SET
+                rides = rides + excluded.rides,
+                gross_cents = gross_cents + excluded.gross_cents,
+                commission_cents = commission_cents + excluded.commission_cents,
+                net_cents = net_cents + excluded.net_cents
+            """,
+            [(d, p, *v) for (d, p), v in totals.items()],
+        )
+        conn.execute(
+            """
+            INSERT INTO settlement_checkpoint (job, completed_at, ride_id, updated_at)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(job) DO UPDATE SET
+                completed_at = excluded.completed_at,
+                ride_id = excluded.ride_id,
+                updated_at = excluded.updated_at
+            """,
+            (job, last[0], last[1]),
+        )
+    return len(rows), unpriced, last
+
+
+def write_payout_file(conn, period, sink_dir):
+    """
+    Stream one week's ledger rows into <sink_dir>/<period>.csv (written to a
+    temp file and renamed, so the sink never sees a partial file) and
+    record the payout. Returns (drivers, net_cents).
+    """
+    os.makedirs(sink_dir, exist_ok=True)
+    path = os.path.join(sink_dir, f"{period}.csv")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    drivers = 0
+    net_cents = 0
+    cursor = conn.execute(
+        """
+        SELECT l.driver_id, u.name, l.rides, l.gross_cents, l.commission_cents, l.net_cents
+        FROM driver_ledger l
+        LEFT JOIN drivers d ON d.id = l.driver_id
+        LEFT JOIN users u ON u.id = d.user_id
+        WHERE l.period_start = ?
+        ORDER BY l.driver_id
+        """,
+        (period,),
+    )
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["driver_id", "driver_name", "rides", "gross", "commission", "net"])
+        for driver_id, name, rides, gross, commission, net in cursor:
+            writer.writerow([driver_id, name or "", rides, f"{gross / 100:.2f}", f"{commission / 100:.2f}", f"{net / 100:.2f}"])
+            drivers += 1
+            net_cents += net
+    os.replace(tmp_path, path)
+
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO driver_payouts (period_start, file, drivers, net_cents) VALUES (?, ?, ?, ?)",
+            (period, path, drivers, net_cents),
+        )
+    return drivers, net_cents
+
+
+def run(shard_map, chunk_size=CHUNK_SIZE, lag_minutes=LAG_MINUTES, sink_dir=DEFAULT_SINK, max_chunks=None, log=print):
+    """
+    Settle everything completed before now - lag_minutes, then write payout
+    files for every week that has ended since. Safe to re-run at any time.
+    max_chunks (per shard) simulates an interrupted run.
+    """
+    conn = shard_map.connect(shard_map.default)
+    try:
+        return _run(conn, shard_map, chunk_size, lag_minutes, sink_dir, max_chunks, log)
+    finally:
+        conn.close()
+
+
+def _run(conn, shard_map, chunk_size, lag_minutes, sink_dir, max_chunks, log):
+    cutoff = conn.execute("SELECT datetime('now', ?)", (f"-{int(lag_minutes)} minutes",)).fetchone()[0]
+    open_period = conn.execute(f"SELECT {PERIOD_SQL.format('?')}", (cutoff,)).fetchone()[0]
+    paid_periods = {row[0] for row in conn.execute("SELECT period_start FROM driver_payouts")}
+
+    settled = unpriced = chunks = 0
+    settled_until = cutoff      # everything completed before this is in the ledger
+    started = time.perf_counter()
+    for region in shard_map.regions:
+        job = job_name(region)
+        shard = conn if region is shard_map.default else shard_map.connect(region)
+        try:
+            backfilled = backfill_completed_at(shard, job, cutoff)
+            if backfilled:
+                log(f"[settlement] {region.name}: {backfilled} completed rides had no completed_at; settling them now")
+            checkpoint = read_checkpoint(shard, job)
+            region_chunks = 0
+            while True:
+                if max_chunks is not None and region_chunks >= max_chunks:
+                    settled_until = min(settled_until, checkpoint[0])
+                    break
+                count, skipped, checkpoint = settle_chunk(shard, job, checkpoint, cutoff, open_period, paid_periods, chunk_size)
+                if not count:
+                    break
+                settled += count
+                unpriced += skipped
+                chunks += 1
+                region_chunks += 1
+                if chunks % 20 == 0:
+                    log(f"[settlement] {settled} rides settled, {region.name} up to {checkpoint[0]} (ride {checkpoint[1]})")
+        finally:
+            if shard is not conn:
+                shard.close()
+    log(f"[settlement] {settled} rides in {chunks} chunks ({unpriced} without a fare) in {time.perf_counter() - started:.2f}s")
+
+    # A week can be paid once it has ended and nothing before it is left unsettled
+    due = conn.execute(
+        """
+        SELECT DISTINCT period_start FROM driver_ledger
+        WHERE date(period_start, '+7 days') <= date(?)
+          AND period_start NOT IN (SELECT period_start FROM driver_payouts)
+        ORDER BY period_start
+        """,
+        (settled_until,),
+    ).fetchall()
+    for (period,) in due:
+        drivers, net_cents = write_payout_file(conn, period, sink_dir)
+        log(f"[settlement] payout {period}: {drivers} drivers, EGP {net_cents / 100:.2f}")
+    return settled
+
+
+def benchmark(count, chunk_size=CHUNK_SIZE):
+    """
+    Settle `count` synthetic completed rides spread over the last year.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        conn = sqlite3.connect(db_path)
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql"), "r") as f:
+            conn.executescript(f.read())
+        for column in ("driver_id INTEGER", "completed_at TIMESTAMP", "final_fare REAL"):
+            conn.execute(f"ALTER TABLE rides ADD COLUMN {column}")
+        ensure_index(conn)
+
+        rng = random.Random(1)
+        now = time.time()
+        started = time.perf_counter()
+
+        def rows():
+            for _ in range(count):
+                ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now - rng.random() * 365 * 86400))
+                yield (1, "a", "b", "completed", rng.randint(1, 2000), ts, round(20 + rng.random() * 150, 2))
+
+        with conn:
+            conn.executemany(
+                """
+                INSERT INTO rides (passenger_id, pickup_address, dropoff_address, status, driver_id, completed_at, final_fare)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                rows(),
+            )
+        print(f"[settlement] generated {count} rides in {time.perf_counter() - started:.1f}s")
+
+        # Interrupt after a few chunks, then resume from the checkpoint
+        shard_map = ShardMap(db_path)
+        run(shard_map, chunk_size, sink_dir=os.path.join(tmp, "payouts"), max_chunks=3)
+        run(shard_map, chunk_size, sink_dir=os.path.join(tmp, "payouts"))
+
+        rides, gross = conn.execute("SELECT SUM(rides), SUM(gross_cents) FROM driver_ledger").fetchone()
+        expected = conn.execute("SELECT COUNT(*), SUM(CAST(ROUND(final_fare * 100) AS INTEGER)) FROM rides").fetchone()
+        print(f"[settlement] ledger rides {rides} / {expected[0]}, gross {gross} / {expected[1]} piastres")
+        print(f"[settlement] payout files: {len(os.listdir(os.path.join(tmp, 'payouts')))}")
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Settle driver earnings and write payout files")
+    parser.add_argument("--db", default="database.db")
+    parser.add_argument("--chunk", type=int, default=CHUNK_SIZE, help="rides per transaction")
+    parser.add_argument("--lag-minutes", type=int, default=LAG_MINUTES)
+    parser.add_argument("--sink", default=DEFAULT_SINK, help="directory that receives payout files")
+    parser.add_argument("--regions", default=os.path.join("data", "regions.csv"), help="region shards file (see shards.py)")
+    parser.add_argument("--benchmark", type=int, metavar="RIDES", help="run against a synthetic database instead")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.chunk)
+        return
+
+    conn = sqlite3.connect(args.db)
+    try:
+        ensure_index(conn)
+    finally:
+        conn.close()
+    shard_map = ShardMap(args.db, args.regions)
+    shard_map.sync_schema()
+    run(shard_map, args.chunk, args.lag_minutes, args.sink)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+"""
+Region-sharded ride storage.
+
+Rides (and their GPS traces) live in one SQLite file per region, chosen by
+pickup coordinates, so each region has its own writer lock. So do the
+rows a ride transaction writes next to the ride: the driver feed change
+log (ride_feed), the notification outbox and the journal of global
+writes (core_write_journal). Users, drivers, the Idempotency-Key replay
+cache and every other table stay in the global database file.
+
+Regions are read from a CSV file (REGIONS_PATH, default data/regions.csv):
+
+    name,min_lat,min_lng,max_lat,max_lng
+    giza,29.85,30.85,30.10,31.215
+
+Rides outside every box, and all rides created before sharding was turned
+on, stay in the global file (the "default" region). Without a regions
+file, everything stays there and nothing changes. Append new regions at
+the end: the line number is part of every ride id in that region.
+
+Ride ids are globally unique. Region k allocates ids from k * ID_STRIDE,
+so the id alone tells which file holds a ride. Because the ranges are
+ordered, chaining shards in region order yields rides in id order.
+
+A shard is opened as the main database with the global file ATTACHed.
+Unqualified table names resolve in main first, then in the attached file,
+so existing per-ride SQL (including joins to users and drivers) runs
+unchanged. Ride transactions only write main, so they never take the
+global writer lock; the global writes they make (surge gauges, ETA
+statistics, driver positions) go to a CoreWriteBatch, which journals
+them in the region file, and a CoreWriteJournal applies the journal to
+the global file shortly after the shard commits.
+Cross-ride views (dashboards, admin lists, exports) use fanout(), which
+runs the same query on every shard and merges the results.
+"""
+import csv
+import json
+import os
+import sqlite3
+import threading
+
+ID_STRIDE = 10 ** 12
+DEFAULT_REGION = "default"
+SHARDED_TABLES = ("rides", "ride_traces", "ride_feed", "notification_outbox", "core_write_journal")
+AUTOINCREMENT_TABLES = ("rides", "ride_feed", "notification_outbox")
+CORE_ALIAS = "core"
+JOURNAL_BATCH_SIZE = 200
+JOURNAL_POLL_SECONDS = 5
+
+
+class Region:
+    __slots__ = ("name", "index", "bbox", "path")
+
+    def __init__(self, name, index, bbox, path):
+        self.name = name
+        self.index = index
+        self.bbox = bbox            # (min_lat, min_lng, max_lat, max_lng) or None for default
+        self.path = path
+
+    def contains(self, lat, lng):
+        min_lat, min_lng, max_lat, max_lng = self.bbox
+        return min_lat <= lat <= max_lat and min_lng <= lng <= max_lng
+
+
+class ShardMap:
+    def __init__(self, db_path, regions_path=None):
+        self.db_path = db_path
+        self.default = Region(DEFAULT_REGION, 0, None, db_path)
+        self.regions = [self.default]
+        self.lock = threading.Lock()
+
+        if regions_path and os.path.exists(regions_path):
+            base, ext = os.path.splitext(db_path)
+            with open(regions_path, "r", encoding="utf-8", newline="") as f:
+                for row in csv.DictReader(f):
+                    name = row["name"].strip()
+                    bbox = tuple(float(row[k]) for k in ("min_lat", "min_lng", "max_lat", "max_lng"))
+                    self.regions.append(Region(name, len(self.regions), bbox, f"{base}.{name}{ext or '.db'}"))
+
+    @property
+    def sharded(self):
+        return len(self.regions) > 1
+
+    # ---------------- routing ----------------
+
+    def region_for_point(self, lat, lng):
+        if lat is not None and lng is not None:
+            for region in self.regions[1:]:
+                if region.contains(lat, lng):
+                    return region
+        return self.default
+
+    def region_for_ride(self, ride_id):
+        index = int(ride_id) // ID_STRIDE
+        return self.regions[index] if 0 <= index < len(self.regions) else self.default
+
+    def connect(self, region):
+        conn = sqlite3.connect(region.path)
+        conn.row_factory = sqlite3.Row
+        if region is not self.default:
+            conn.execute(f"ATTACH DATABASE ? AS {CORE_ALIAS}", (self.db_path,))
+        return conn
+
+    # ---------------- fan-out ----------------
+
+    def fanout(self, sql, params=(), key=None, reverse=False, limit=None):
+        """
+        Run `sql` on every shard and merge the rows. Pass the same ordering as
+        the query's ORDER BY as `key` (and its LIMIT as `limit`) to get a
+        correctly ordered, truncated result.
+        """
+        rows = []
+        for region in self.regions:
+            conn = self.connect(region)
+            try:
+                rows.extend(conn.execute(sql, params).fetchall())
+            finally:
+                conn.close()
+        if key is not None and len(self.regions) > 1:
+            rows.sort(key=key, reverse=reverse)
+        return rows[:limit] if limit is not None else rows
+
+    def by_ids(self, sql, ids, params=()):
+        """
+        Run `sql`, whose "{ids}" placeholder becomes a list of ? markers, once
+        per shard that holds some of `ids`. Extra params come first.
+        """
+        groups = {}
+        for ride_id in ids:
+            groups.setdefault(self.region_for_ride(ride_id), []).append(ride_id)
+        rows = []
+        for region, group in groups.items():
+            conn = self.connect(region)
+            try:
+                query = sql.format(ids=", ".join("?" for _ in group))
+                rows.extend(conn.execute(query, (*params, *group)).fetchall())
+            finally:
+                conn.close()
+        return rows
+
+    # ---------------- schema ----------------
+
+    def sync_schema(self):
+        """
+        Create missing shard files and bring their ride tables in line with
+        the global file: same DDL, any migrated columns, same indexes and
+        triggers. Call after the global migrations have run.
+        """
+        if not self.sharded:
+            return
+        core = sqlite3.connect(self.db_path)
+        try:
+            tables = {}
+            for table in SHARDED_TABLES:
+                row = core.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+                if row:
+                    tables[table] = (row[0], core.execute(f"PRAGMA table_info({table})").fetchall())
+            objects = [
+                r[0] for r in core.execute(
+                    f"""
+                    SELECT sql FROM sqlite_master
+                    WHERE type IN ('index', 'trigger') AND sql IS NOT NULL
+                      AND tbl_name IN ({', '.join('?' for _ in SHARDED_TABLES)})
+                    """,
+                    SHARDED_TABLES,
+                )
+            ]
+        finally:
+            core.close()
+
+        with self.lock:
+            for region in self.regions[1:]:
+                conn = sqlite3.connect(region.path)
+                try:
+                    for table, (ddl, columns) in tables.items():
+                        existing = [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+                        if not existing:
+                            conn.execute(ddl)
+                            continue
+                        for _, name, col_type, notnull, default, _ in columns:
+                            if name not in existing:
+                                extra = f" NOT NULL DEFAULT {default}" if notnull and default is not None else ""
+                                conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {col_type}{extra}")
+                    for ddl in objects:
+                        for kind in ("CREATE INDEX", "CREATE TRIGGER"):
+                            if ddl.startswith(kind):
+                                ddl = ddl.replace(kind, f"{kind} IF NOT EXISTS", 1)
+                        conn.execute(ddl)
+
+                    # Start this region's id ranges (ride, feed and outbox ids stay globally unique)
+                    for table in AUTOINCREMENT_TABLES:
+                        if not conn.execute("SELECT 1 FROM sqlite_sequence WHERE name = ?", (table,)).fetchone():
+                            conn.execute(
+                                "INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)",
+                                (table, region.index * ID_STRIDE),
+                            )
+                    conn.commit()
+                finally:
+                    conn.close()
+
+
+class CoreWriteBatch:
+    """
+    Global writes made by one ride transaction. Quacks like a cursor
+    (execute), so surge_engine.record() and friends write here unchanged;
+    call(op, *args) runs a registered journal op (see CoreWriteJournal).
+
+    Rides in the global file write straight through the ride cursor, in
+    the ride transaction. Rides in a region file append the writes to that
+    file's core_write_journal instead, in the same transaction, so they
+    commit (or roll back) together with the ride. Call submit() once the
+    ride transaction has committed.
+    """
+
+    def __init__(self, journal, cursor, direct):
+        self.journal = journal
+        self.cursor = cursor
+        self.direct = direct
+        self.callbacks = []
+        self.written = False
+
+    def execute(self, sql, params=()):
+        self.call("execute", sql, list(params))
+
+    def call(self, op, *args):
+        self.written = True
+        if self.direct:
+            callback = self.journal.ops[op](self.cursor, *args)
+            if callable(callback):
+                self.callbacks.append(callback)
+            return
+        self.cursor.execute(
+            "INSERT INTO core_write_journal (op, args) VALUES (?, ?)",
+            (op, json.dumps(args)),
+        )
+
+    def submit(self):
+        if not self.written:
+            return
+        if not self.direct:
+            self.journal.wake()
+            return
+        for callback in self.callbacks:
+            callback()
+        if self.journal.on_apply:
+            self.journal.on_apply()
+
+
+class CoreWriteJournal:
+    """
+    Applies the core_write_journal of every region file to the global file.
+
+    Each pass takes the global writer lock once per region, skips entries
+    at or below the region's row in core_write_cursors (already applied),
+    runs the rest in order and advances the cursor in the same global
+    transaction; only then are the entries deleted from the region file.
+    A crash at any point therefore neither loses nor repeats a write. An
+    entry that fails is rolled back on its own (a savepoint each) and kept
+    in core_write_failures; the rest of the batch still applies.
+
+    ops maps an op name to fn(cursor, *args); a callable it returns runs
+    after the global transaction commits. "execute" is always available.
+    """
+
+    def __init__(self, shard_map, ops=None, on_apply=None, batch_size=JOURNAL_BATCH_SIZE,
+                 poll_seconds=JOURNAL_POLL_SECONDS):
+        self.shard_map = shard_map
+        self.ops = {"execute": lambda cursor, sql, params: cursor.execute(sql, params)}
+        self.ops.update(ops or {})
+        self.on_apply = on_apply
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.stats = {"applied": 0, "failed": 0}
+
+    def batch(self, cursor, ride_id):
+        region = self.shard_map.region_for_ride(ride_id)
+        return CoreWriteBatch(self, cursor, direct=region is self.shard_map.default)
+
+    def wake(self):
+        if self.pid != os.getpid():
+            self.start()
+        self.wakeup.set()
+
+    def start(self):
+        if not self.shard_map.sharded:
+            return
+        with self.lock:
+            # Threads do not survive fork(), so each worker starts its own
+            if self.pid == os.getpid() and self.thread and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.loop, name="core-write-journal", daemon=True)
+            self.thread.start()
+
+    def loop(self):
+        while True:
+            self.wakeup.wait(self.poll_seconds)
+            self.wakeup.clear()
+            try:
+                self.run_once()
+            except Exception as e:  # keep the thread alive through DB hiccups
+                print(f"[journal] Core write pass failed: {e}")
+
+    def run_once(self):
+        applied = 0
+        for region in self.shard_map.regions[1:]:
+            while True:
+                count = self.apply_region(region)
+                applied += count
+                if count < self.batch_size:
+                    break
+        return applied
+
+    def apply_region(self, region):
+        shard = sqlite3.connect(region.path)
+        try:
+            entries = shard.execute(
+                "SELECT id, op, args FROM core_write_journal ORDER BY id LIMIT ?",
+                (self.batch_size,),
+            ).fetchall()
+            if not entries:
+                return 0
+
+            callbacks = []
+            failed = 0
+            core = sqlite3.connect(self.shard_map.db_path, isolation_level=None)
+            core.row_factory = sqlite3.Row
+            try:
+                cursor = core.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    row = cursor.execute(
+                        "SELECT last_id FROM core_write_cursors WHERE region = ?", (region.name,)
+                    ).fetchone()
+                    last_id = row[0] if row else 0
+                    for entry_id, op, args in entries:
+                        if entry_id <= last_id:
+                            continue    # applied before a crash, not yet deleted here
+                        cursor.execute("SAVEPOINT entry")
+                        try:
+                            callback = self.ops[op](cursor, *json.loads(args))
+                        except Exception as e:
+                            cursor.execute("ROLLBACK TO entry")
+                            cursor.execute(
+                                """
+                                INSERT INTO core_write_failures (region, entry_id, op, args, error)
+                                VALUES (?, ?, ?, ?, ?)
+                                """,
+                                (region.name, entry_id, op, args, str(e)),
+                            )
+                            failed += 1
+                        else:
+                            if callable(callback):
+                                callbacks.append(callback)
+                        cursor.execute("RELEASE entry")
+                    last_id = max(last_id, entries[-1][0])
+                    cursor.execute(
+                        """
+                        INSERT INTO core_write_cursors (region, last_id) VALUES (?, ?)
+                        ON CONFLICT(region) DO UPDATE SET last_id = excluded.last_id
+                        """,
+                        (region.name, last_id),
+                    )
+                    cursor.execute("COMMIT")
+                except BaseException:
+                    cursor.execute("ROLLBACK")
+                    raise
+            finally:
+                core.close()
+
+            with shard:
+                shard.execute("DELETE FROM core_write_journal WHERE id <= ?", (last_id,))
+        finally:
+            shard.close()
+
+        with self.lock:
+            self.stats["applied"] += len(entries) - failed
+            self.stats["failed"] += failed
+        if failed:
+            print(f"[journal] {failed} core writes from {region.name} failed; see core_write_failures")
+        for callback in callbacks:
+            callback()
+        if self.on_apply:
+            self.on_apply()
+        return len(entries)
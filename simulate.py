@@ -0,0 +1,401 @@
+"""
+Discrete-event dispatch simulator for capacity planning.
+
+Replays a demand stream against a fleet in virtual time, using the same
+rules as the app:
+
+    trip distance / duration   routing.straight_line_trip (or a road graph via --graph),
+                               with durations from eta.eta_model once it has enough
+                               trips for the zone pair (loaded from --eta-db)
+    pickup time                eta.eta_model for the driver -> pickup zone pair,
+                               else PICKUP_MIN_PER_KM
+    fare                       pricing.fare_breakdown, with surge.multiplier_for per zone
+    matching                   candidates.CandidateStore nearest-idle lookups
+    lifecycle                  waiting -> accepted -> picked_up -> completed,
+                               or cancelled when the passenger gives up waiting
+
+Events sit in a heap keyed by virtual minute. No wall-clock time passes
+between events, so thousands of simulated hours run in about a minute.
+
+    python simulate.py --drivers 200 --rate 600 --hours 1000
+    python simulate.py --drivers 200 --rate 600 --policy random
+    python simulate.py --replay rides.ndjson --drivers 40     # /admin/export/rides.ndjson output
+    python simulate.py --eta-db prod-copy.db --start 2024-05-06T08:00
+
+The ETA model is keyed by hour of week; virtual minute 0 is --start (or
+the first replayed request).
+"""
+import argparse
+import heapq
+import json
+import os
+import random
+import sqlite3
+import time
+from collections import deque
+from datetime import datetime
+
+from candidates import CandidateStore
+from eta import eta_model
+from pricing import fare_breakdown
+from routing import get_road_graph, straight_line_trip
+from surge import WINDOW_MINUTES as SURGE_WINDOW_MINUTES, multiplier_for, surge_zone
+from zones import hour_of_week, zone_of
+
+PICKUP_MIN_PER_KM = 3.0     # same speed assumption as the quote fallback, without a learned ETA
+MATCH_RADIUS_KM = 5.0
+PATIENCE_MIN = 10.0         # passengers cancel if nobody accepts within this
+CITY_CENTER = (30.0444, 31.2357)
+CITY_SPREAD_DEG = 0.05
+
+REQUEST, ARRIVED, COMPLETED, GIVE_UP = range(4)
+
+
+class Ride:
+    __slots__ = ("ride_id", "t_request", "pickup", "dropoff", "status", "driver",
+                 "t_pickup", "fare", "surge", "distance_km", "duration_min", "zone")
+
+    def __init__(self, ride_id, t_request, pickup, dropoff):
+        self.ride_id = ride_id
+        self.t_request = t_request
+        self.pickup = pickup
+        self.dropoff = dropoff
+        self.status = "requested"
+        self.driver = None
+        self.t_pickup = None
+        self.fare = 0.0
+        self.surge = 1.0
+        self.distance_km = 0.0
+        self.duration_min = 0
+        self.zone = surge_zone(*pickup)
+
+
+def synthetic_demand(rng, rate_per_hour, hours):
+    """
+    Poisson arrivals with pickups and dropoffs scattered around the city center.
+    """
+    t = 0.0
+    horizon = hours * 60
+    rate_per_min = rate_per_hour / 60.0
+    ride_id = 0
+    while True:
+        t += rng.expovariate(rate_per_min)
+        if t >= horizon:
+            return
+        ride_id += 1
+        pickup = (rng.gauss(CITY_CENTER[0], CITY_SPREAD_DEG), rng.gauss(CITY_CENTER[1], CITY_SPREAD_DEG))
+        dropoff = (rng.gauss(CITY_CENTER[0], CITY_SPREAD_DEG), rng.gauss(CITY_CENTER[1], CITY_SPREAD_DEG))
+        yield Ride(ride_id, t, pickup, dropoff)
+
+
+def recorded_start(path):
+    """
+    Unix time of the earliest request in an NDJSON export, or None.
+    """
+    starts = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            created = json.loads(line).get("created_at")
+            if created:
+                starts.append(datetime.fromisoformat(created).timestamp())
+    return min(starts, default=None)
+
+
+def recorded_demand(path):
+    """
+    Rides from an NDJSON export, shifted so the first request is at t=0.
+    Rows without coordinates are skipped.
+    """
+    rows = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            row = json.loads(line)
+            if None in (row.get("pickup_lat"), row.get("pickup_lng"), row.get("dropoff_lat"), row.get("dropoff_lng")):
+                continue
+            created = datetime.fromisoformat(row["created_at"]).timestamp() / 60.0
+            rows.append((created, row))
+    rows.sort(key=lambda r: r[0])
+    if not rows:
+        return
+    t0 = rows[0][0]
+    for created, row in rows:
+        yield Ride(
+            row["id"], created - t0,
+            (row["pickup_lat"], row["pickup_lng"]),
+            (row["dropoff_lat"], row["dropoff_lng"]),
+        )
+
+
+class Simulator:
+    def __init__(self, drivers, policy="nearest", graph=None, seed=1, eta=None, start=0.0):
+        self.rng = random.Random(seed)
+        self.policy = policy
+        self.graph = graph
+        self.eta = eta                  # an eta.EtaModel, or None for the fixed speeds only
+        self.start = start              # unix time of virtual minute 0
+
+        self.events = []
+        self.seq = 0
+        self.now = 0.0
+
+        # Fleet: everyone starts online and idle somewhere in the city
+        self.store = CandidateStore()
+        self.positions = {}
+        self.busy_since = {}
+        self.busy_minutes = 0.0
+        self.driver_count = drivers
+        self.idle_by_zone = {}
+        for driver_id in range(1, drivers + 1):
+            pos = (self.rng.gauss(CITY_CENTER[0], CITY_SPREAD_DEG), self.rng.gauss(CITY_CENTER[1], CITY_SPREAD_DEG))
+            self.positions[driver_id] = pos
+            self.store.upsert(driver_id, pos[0], pos[1], last_seen=0)
+            self.bump(self.idle_by_zone, surge_zone(*pos), 1)
+
+        self.waiting = {}
+        self.waiting_by_zone = {}
+        self.arrivals = deque()          # (t, zone) for the surge demand window
+        self.arrivals_by_zone = {}
+
+        self.rides = []
+        self.match_calls = 0
+        self.match_seconds = 0.0
+        self.events_processed = 0
+
+    # ---------------- helpers ----------------
+
+    @staticmethod
+    def bump(counter, key, delta):
+        counter[key] = counter.get(key, 0) + delta
+
+    def schedule(self, t, kind, payload):
+        self.seq += 1
+        heapq.heappush(self.events, (t, self.seq, kind, payload))
+
+    def learned_minutes(self, a, b):
+        """
+        The ETA model's mean duration for this zone pair at the virtual hour,
+        or None while it has too few trips.
+        """
+        if self.eta is None:
+            return None
+        learned = self.eta.estimate(zone_of(*a), zone_of(*b), hour_of_week(self.start + self.now * 60))
+        return learned[0] if learned else None
+
+    def trip(self, a, b):
+        # Same precedence as app.estimate_trip
+        learned = self.learned_minutes(a, b)
+        if self.graph is not None:
+            route = self.graph.route_between(a[0], a[1], b[0], b[1])
+            if route is not None:
+                duration = learned if learned is not None else route["duration_min"]
+                return round(max(1.0, route["distance_km"]), 1), max(1, round(duration))
+        distance_km, duration_min = straight_line_trip(a[0], a[1], b[0], b[1])
+        if learned is not None:
+            return distance_km, max(1, round(learned))
+        return distance_km, duration_min
+
+    def surge_multiplier(self, zone):
+        while self.arrivals and self.arrivals[0][0] < self.now - SURGE_WINDOW_MINUTES:
+            _, old_zone = self.arrivals.popleft()
+            self.bump(self.arrivals_by_zone, old_zone, -1)
+        demand = self.waiting_by_zone.get(zone, 0) + self.arrivals_by_zone.get(zone, 0)
+        return multiplier_for(demand, self.idle_by_zone.get(zone, 0))
+
+    # ---------------- matching ----------------
+
+    def find_driver(self, ride):
+        started = time.perf_counter()
+        limit = 1 if self.policy == "nearest" else 20
+        found = self.store.nearby(ride.pickup[0], ride.pickup[1], radius_km=MATCH_RADIUS_KM, limit=limit)
+        self.match_calls += 1
+        self.match_seconds += time.perf_counter() - started
+        if not found:
+            return None
+        return found[0][0] if self.policy == "nearest" else self.rng.choice(found)[0]
+
+    def find_ride(self, driver_id):
+        """
+        Oldest-first scan of the queue for the nearest ride in range of a
+        driver who just became free.
+        """
+        started = time.perf_counter()
+        pos = self.positions[driver_id]
+        best, best_km = None, MATCH_RADIUS_KM
+        for ride in self.waiting.values():
+            km = straight_line_trip(pos[0], pos[1], ride.pickup[0], ride.pickup[1])[0]
+            if km <= best_km:
+                best, best_km = ride, km
+                if self.policy != "nearest":
+                    break
+        self.match_calls += 1
+        self.match_seconds += time.perf_counter() - started
+        return best
+
+    def assign(self, driver_id, ride):
+        ride.status = "accepted"
+        ride.driver = driver_id
+        del self.waiting[ride.ride_id]
+        self.bump(self.waiting_by_zone, ride.zone, -1)
+
+        pos = self.positions[driver_id]
+        self.store.set_busy(driver_id, True)
+        self.bump(self.idle_by_zone, surge_zone(*pos), -1)
+        self.busy_since[driver_id] = self.now
+
+        pickup_min = self.learned_minutes(pos, ride.pickup)
+        if pickup_min is None:
+            pickup_min = self.trip(pos, ride.pickup)[0] * PICKUP_MIN_PER_KM
+        self.schedule(self.now + pickup_min, ARRIVED, ride)
+
+    # ---------------- event handlers ----------------
+
+    def on_request(self, ride):
+        self.rides.append(ride)
+        ride.status = "waiting"
+        self.waiting[ride.ride_id] = ride
+        self.bump(self.waiting_by_zone, ride.zone, 1)
+        self.arrivals.append((self.now, ride.zone))
+        self.bump(self.arrivals_by_zone, ride.zone, 1)
+
+        ride.distance_km, ride.duration_min = self.trip(ride.pickup, ride.dropoff)
+        ride.surge = self.surge_multiplier(ride.zone)
+        ride.fare = fare_breakdown(ride.distance_km, ride.duration_min, ride.surge)["total_fare"]
+
+        driver_id = self.find_driver(ride)
+        if driver_id is not None:
+            self.assign(driver_id, ride)
+        else:
+            self.schedule(self.now + PATIENCE_MIN, GIVE_UP, ride)
+
+    def on_arrived(self, ride):
+        ride.status = "picked_up"
+        ride.t_pickup = self.now
+        self.schedule(self.now + ride.duration_min, COMPLETED, ride)
+
+    def on_completed(self, ride):
+        ride.status = "completed"
+        driver_id = ride.driver
+        self.busy_minutes += self.now - self.busy_since.pop(driver_id)
+
+        self.positions[driver_id] = ride.dropoff
+        self.store.set_busy(driver_id, False, ride.dropoff[0], ride.dropoff[1])
+        self.bump(self.idle_by_zone, surge_zone(*ride.dropoff), 1)
+
+        next_ride = self.find_ride(driver_id)
+        if next_ride is not None:
+            self.assign(driver_id, next_ride)
+
+    def on_give_up(self, ride):
+        if ride.status == "waiting":
+            ride.status = "cancelled"
+            del self.waiting[ride.ride_id]
+            self.bump(self.waiting_by_zone, ride.zone, -1)
+
+    # ---------------- main loop ----------------
+
+    def run(self, demand, horizon_min=None):
+        handlers = {ARRIVED: self.on_arrived, COMPLETED: self.on_completed, GIVE_UP: self.on_give_up}
+        demand = iter(demand)
+        next_ride = next(demand, None)
+
+        while True:
+            # Merge the (already time-ordered) demand stream with the event heap
+            if next_ride is not None and (not self.events or next_ride.t_request <= self.events[0][0]):
+                self.now = next_ride.t_request
+                if horizon_min is not None and self.now > horizon_min:
+                    break
+                self.on_request(next_ride)
+                next_ride = next(demand, None)
+            elif self.events:
+                t, _, kind, ride = heapq.heappop(self.events)
+                if horizon_min is not None and t > horizon_min:
+                    break
+                self.now = t
+                handlers[kind](ride)
+            else:
+                break
+            self.events_processed += 1
+
+        # Close the books on drivers still busy at the end of the run
+        for started in self.busy_since.values():
+            self.busy_minutes += self.now - started
+
+    def report(self, wall_seconds):
+        def pct(values, q):
+            if not values:
+                return float("nan")
+            values = sorted(values)
+            return values[min(len(values) - 1, int(q * len(values)))]
+
+        completed = [r for r in self.rides if r.status == "completed"]
+        cancelled = [r for r in self.rides if r.status == "cancelled"]
+        waits = [r.t_pickup - r.t_request for r in self.rides if r.t_pickup is not None]
+        sim_hours = self.now / 60.0
+        utilization = self.busy_minutes / (self.driver_count * self.now) if self.now else 0.0
+
+        print(f"policy:                 {self.policy}")
+        print(f"simulated hours:        {sim_hours:.1f}")
+        print(f"requests:               {len(self.rides)}")
+        print(f"completed:              {len(completed)}")
+        print(f"cancelled (no driver):  {len(cancelled)} ({len(cancelled) / max(1, len(self.rides)):.1%})")
+        print(f"wait to pickup (min):   p50 {pct(waits, 0.5):.1f}  p90 {pct(waits, 0.9):.1f}  p99 {pct(waits, 0.99):.1f}")
+        print(f"driver utilization:     {utilization:.1%}")
+        if completed:
+            print(f"avg fare (EGP):         {sum(r.fare for r in completed) / len(completed):.2f}")
+            print(f"surged rides:           {sum(1 for r in completed if r.surge > 1) / len(completed):.1%}")
+        print(f"matcher calls:          {self.match_calls} ({self.match_seconds / max(1, self.match_calls) * 1e6:.1f} us/call,"
+              f" {self.match_seconds / max(wall_seconds, 1e-9):.0%} of wall time)")
+        print(f"events:                 {self.events_processed}")
+        print(f"wall time:              {wall_seconds:.1f}s ({sim_hours / max(wall_seconds / 60.0, 1e-9):.0f} simulated hours / wall minute)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Discrete-event dispatch simulator")
+    parser.add_argument("--drivers", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=300, help="synthetic requests per hour")
+    parser.add_argument("--hours", type=float, default=100, help="simulated hours (synthetic demand)")
+    parser.add_argument("--policy", choices=("nearest", "random"), default="nearest")
+    parser.add_argument("--replay", help="NDJSON rides export to replay instead of synthetic demand")
+    parser.add_argument("--graph", help="road graph file for trip and pickup times")
+    parser.add_argument("--eta-db", default="database.db",
+                        help="database whose eta_stats drive trip and pickup times (skipped if missing)")
+    parser.add_argument("--start", help="ISO time of the first simulated minute (default: now, or the first replayed request)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    graph = get_road_graph(args.graph) if args.graph else None
+
+    eta = None
+    if args.eta_db and os.path.exists(args.eta_db):
+        conn = sqlite3.connect(args.eta_db)
+        try:
+            eta_model.load(conn)
+            eta = eta_model
+        except sqlite3.Error as e:
+            print(f"[simulate] No ETA model in {args.eta_db} ({e}); using fixed speeds")
+        finally:
+            conn.close()
+
+    if args.start:
+        start = datetime.fromisoformat(args.start).timestamp()
+    elif args.replay:
+        start = recorded_start(args.replay) or time.time()
+    else:
+        start = time.time()
+
+    if args.replay:
+        demand = recorded_demand(args.replay)
+        horizon = None
+    else:
+        demand = synthetic_demand(random.Random(args.seed), args.rate, args.hours)
+        horizon = args.hours * 60
+
+    sim = Simulator(args.drivers, policy=args.policy, graph=graph, seed=args.seed, eta=eta, start=start)
+
+    started = time.perf_counter()
+    sim.run(demand, horizon)
+    sim.report(time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    main()
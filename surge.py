@@ -0,0 +1,154 @@
+"""
+Surge pricing from per-zone supply and demand.
+
+Counters live in the surge_counters table and are updated incrementally
+from ride and driver events. Ride events live in the region files, so
+their counter writes follow in a global transaction just after the ride
+commits (see shards.CoreWriteBuffer); driver events write directly:
+
+    demand   rides entering the waiting queue, one bucket per minute (sliding window)
+    waiting  rides currently waiting in the zone (gauge, bucket = -1)
+    idle     online drivers without an active ride in the zone (gauge, bucket = -1)
+
+Each worker turns the rows into a zone -> multiplier dict every
+REFRESH_SECONDS, so the quote path only does a dict lookup.
+"""
+import threading
+import time
+
+from zones import zone_of
+
+SURGE_PRECISION = 5         # ~4.9 km cells; finer cells are too sparse to price on
+WINDOW_MINUTES = 10
+REFRESH_SECONDS = 5
+MIN_DEMAND = 3              # never surge on one or two requests
+SENSITIVITY = 0.5           # multiplier added per unit of demand/supply above 1
+MAX_MULTIPLIER = 3.0
+GAUGE = -1
+
+
+def surge_zone(lat, lng):
+    return zone_of(lat, lng, SURGE_PRECISION)
+
+
+def current_minute(now=None):
+    return int((now if now is not None else time.time()) // 60)
+
+
+def multiplier_for(demand, supply):
+    if demand < MIN_DEMAND:
+        return 1.0
+    ratio = demand / max(supply, 1)
+    if ratio <= 1:
+        return 1.0
+    return round(min(MAX_MULTIPLIER, 1.0 + SENSITIVITY * (ratio - 1)), 1)
+
+
+class SurgeEngine:
+    def __init__(self):
+        self.multipliers = {}
+        self.loaded_at = None
+        self.last_pruned_minute = None
+        self.lock = threading.Lock()
+
+    # ---------------- writes (caller's transaction or CoreWriteBatch) ----------------
+
+    def record(self, cursor, zone, kind, delta, bucket=GAUGE):
+        if not zone:
+            return
+        cursor.execute(
+            """
+            INSERT INTO surge_counters (zone, kind, bucket, value)
+            VALUES (?, ?, ?, MAX(0, ?))
+            ON CONFLICT (zone, kind, bucket) DO UPDATE SET value = MAX(0, value + ?)
+            """,
+            (zone, kind, bucket, delta, delta),
+        )
+
+    def ride_queued(self, cursor, lat, lng):
+        zone = surge_zone(lat, lng)
+        minute = current_minute()
+        self.record(cursor, zone, "demand", 1, bucket=minute)
+        self.record(cursor, zone, "waiting", 1)
+
+        if self.last_pruned_minute != minute:
+            cursor.execute(
+                "DELETE FROM surge_counters WHERE kind = 'demand' AND bucket <= ?",
+                (minute - WINDOW_MINUTES,),
+            )
+            self.last_pruned_minute = minute
+
+    def ride_dequeued(self, cursor, lat, lng):
+        self.record(cursor, surge_zone(lat, lng), "waiting", -1)
+
+    def driver_idle(self, cursor, lat, lng, delta):
+        """
+        delta=+1 when a driver becomes available in the zone, -1 when they
+        go offline or take a ride.
+        """
+        self.record(cursor, surge_zone(lat, lng), "idle", delta)
+
+    def rebuild_gauges(self, conn, fanout=None):
+        """
+        Recount the waiting / idle gauges from scratch. Only used at startup
+        to correct drift (e.g. rides created before counters existed).
+        `fanout(sql)` runs a rides query on every ride shard; by default the
+        query runs on conn.
+        """
+        def query(sql):
+            return fanout(sql) if fanout else conn.execute(sql).fetchall()
+
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM surge_counters WHERE bucket = ?", (GAUGE,))
+
+        for row in query("SELECT pickup_lat, pickup_lng FROM rides WHERE status = 'waiting'"):
+            self.record(conn.cursor(), surge_zone(row[0], row[1]), "waiting", 1)
+
+        busy = {row[0] for row in query("SELECT driver_id FROM rides WHERE status IN ('accepted', 'picked_up')")}
+        cursor.execute("SELECT driver_id, lat, lng FROM driver_status WHERE is_online = 1")
+        for row in cursor.fetchall():
+            if row[0] not in busy:
+                self.record(conn.cursor(), surge_zone(row[1], row[2]), "idle", 1)
+        self.invalidate()
+
+    # ---------------- reads ----------------
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    def refresh_if_stale(self, get_conn):
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < REFRESH_SECONDS:
+            return
+
+        conn = get_conn()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT zone, kind, value FROM surge_counters WHERE bucket = ? OR bucket > ?",
+                (GAUGE, current_minute() - WINDOW_MINUTES),
+            )
+            demand, supply = {}, {}
+            for zone, kind, value in cursor.fetchall():
+                if kind == "idle":
+                    supply[zone] = supply.get(zone, 0) + value
+                else:
+                    # Waiting gauge plus recent arrivals
+                    demand[zone] = demand.get(zone, 0) + value
+        finally:
+            conn.close()
+
+        multipliers = {}
+        for zone, d in demand.items():
+            m = multiplier_for(d, supply.get(zone, 0))
+            if m > 1.0:
+                multipliers[zone] = m
+
+        with self.lock:
+            self.multipliers = multipliers
+            self.loaded_at = time.monotonic()
+
+    def multiplier(self, lat, lng):
+        return self.multipliers.get(surge_zone(lat, lng), 1.0)
+
+
+surge_engine = SurgeEngine()
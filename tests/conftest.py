@@ -0,0 +1,94 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def web(tmp_path_factory):
+    """
+    The app module, imported in a scratch directory: the database, caches
+    and region files are all relative to the working directory.
+    """
+    workdir = tmp_path_factory.mktemp("app")
+    shutil.copy(os.path.join(ROOT, "schema.sql"), workdir)
+    os.symlink(os.path.join(ROOT, "data"), workdir / "data")
+    os.environ.setdefault("REGIONS_PATH", str(workdir / "regions.csv"))     # one region
+    previous = os.getcwd()
+    os.chdir(workdir)
+    # Read at import; tests run the dispatcher by hand
+    os.environ.setdefault("NOTIFY_DISPATCHER", "0")
+    os.environ.setdefault("ADMISSION_CONTROL", "0")
+    try:
+        import app
+        yield app
+    finally:
+        os.chdir(previous)
+
+
+@pytest.fixture(scope="session")
+def flask_app(web):
+    return web.create_app({"TESTING": True})
+
+
+@pytest.fixture
+def client(flask_app):
+    return flask_app.test_client()
+
+
+@pytest.fixture
+def app_ctx(flask_app):
+    """
+    An application context, for calling the app's functions directly.
+    """
+    with flask_app.app_context():
+        yield flask_app
+
+
+@pytest.fixture
+def make_user(web, app_ctx):
+    """
+    Insert a user (and, for role="driver", an approved driver); returns the user id.
+    """
+    from werkzeug.security import generate_password_hash
+
+    def make(role="passenger", name=None):
+        conn = web.get_db()
+        with conn:
+            n = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM users").fetchone()[0]
+            name = name or f"{role}{n}"
+            user_id = conn.execute(
+                "INSERT INTO users (name, email, phone, password_hash, role) VALUES (?, ?, ?, ?, ?)",
+                (name, f"{role}{n}@example.com", f"+2010{n:08d}", generate_password_hash("Pass123!"), role),
+            ).lastrowid
+            if role == "driver":
+                conn.execute(
+                    "INSERT INTO drivers (user_id, license_number, vehicle_info, verification_status) "
+                    "VALUES (?, ?, 'Grey sedan', 'approved')",
+                    (user_id, f"L{n}"),
+                )
+        conn.close()
+        return user_id
+
+    return make
+
+
+@pytest.fixture
+def waiting_ride(web, app_ctx):
+    """
+    Create, quote and confirm a ride (central Cairo by default); returns its id.
+    """
+    def book(passenger_id, pickup=(30.0444, 31.2357), dropoff=(30.0626, 31.2497), allow_pool=False):
+        ride_id = web.create_ride(
+            passenger_id, "Tahrir Square", "Ramses Station",
+            pickup[0], pickup[1], dropoff[0], dropoff[1], allow_pool=allow_pool,
+        )
+        web.quote_ride(ride_id, passenger_id)
+        web.queue_ride(ride_id, passenger_id)
+        return ride_id
+
+    return book
@@ -0,0 +1,51 @@
+import pytest
+
+
+@pytest.fixture
+def driver_client(client, make_user):
+    user_id = make_user("driver")
+    with client.session_transaction() as s:
+        s["user_id"] = user_id
+        s["role"] = "driver"
+    return client
+
+
+def poll(client, since=None, etag=None):
+    headers = {"If-None-Match": etag} if etag else {}
+    return client.get("/driver/requests/feed", query_string={"since": since} if since else {}, headers=headers)
+
+
+def test_delta_lists_additions_and_removals(web, driver_client, make_user, waiting_ride):
+    cursor = poll(driver_client).get_json()["cursor"]
+
+    ride_id = waiting_ride(make_user("passenger"))
+    delta = poll(driver_client, cursor).get_json()
+    assert not delta["reset"]
+    assert [r["id"] for r in delta["added"]] == [ride_id]
+    assert delta["removed"] == []
+
+    web.reject_ride(ride_id)
+    delta = poll(driver_client, delta["cursor"]).get_json()
+    assert delta["added"] == [] and delta["removed"] == [ride_id]
+
+
+def test_unchanged_poll_is_a_304(driver_client, make_user, waiting_ride):
+    waiting_ride(make_user("passenger"))
+    first = poll(driver_client)
+    assert first.status_code == 200 and first.headers["ETag"]
+
+    again = poll(driver_client, first.get_json()["cursor"], first.headers["ETag"])
+    assert again.status_code == 304
+
+    waiting_ride(make_user("passenger"))
+    assert poll(driver_client, first.get_json()["cursor"], first.headers["ETag"]).status_code == 200
+
+
+def test_pool_partner_is_sent_again_with_its_pool(driver_client, make_user, waiting_ride):
+    first = waiting_ride(make_user("passenger"), allow_pool=True)
+    cursor = poll(driver_client).get_json()["cursor"]
+
+    second = waiting_ride(make_user("passenger"), pickup=(30.0450, 31.2360), allow_pool=True)
+    delta = poll(driver_client, cursor).get_json()
+    pools = {r["id"]: r["pool_id"] for r in delta["added"]}
+    assert pools == {first: first, second: first}
@@ -0,0 +1,70 @@
+import pytest
+from flask import session
+
+
+def ride_form(**extra):
+    return {
+        "pickup_address": "Tahrir Square", "dropoff_address": "Ramses Station",
+        "pickup_lat": "30.0444", "pickup_lng": "31.2357",
+        "dropoff_lat": "30.0626", "dropoff_lng": "31.2497",
+        **extra,
+    }
+
+
+def login(client, user_id, role="passenger"):
+    with client.session_transaction() as s:
+        s["user_id"] = user_id
+        s["role"] = role
+
+
+def ride_count(web, passenger_id):
+    conn = web.get_db()
+    count = conn.execute("SELECT COUNT(*) FROM rides WHERE passenger_id = ?", (passenger_id,)).fetchone()[0]
+    conn.close()
+    return count
+
+
+@pytest.fixture
+def passenger(client, make_user):
+    user_id = make_user("passenger")
+    login(client, user_id)
+    return user_id
+
+
+def test_retry_replays_the_first_response(web, client, passenger):
+    first = client.post("/passenger/request-ride", data=ride_form(), headers={"Idempotency-Key": "k-1"})
+    retry = client.post("/passenger/request-ride", data=ride_form(), headers={"Idempotency-Key": "k-1"})
+
+    assert first.status_code == retry.status_code == 302
+    assert retry.headers["Location"] == first.headers["Location"]
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert ride_count(web, passenger) == 1
+
+
+def test_form_field_key_is_honoured(web, client, passenger):
+    first = client.post("/passenger/request-ride", data=ride_form(idempotency_key="form-1"))
+    retry = client.post("/passenger/request-ride", data=ride_form(idempotency_key="form-1"))
+    assert retry.headers["Location"] == first.headers["Location"]
+    assert "Idempotent-Replayed" in retry.headers
+    assert ride_count(web, passenger) == 1
+
+
+def test_keys_are_scoped_to_the_caller(web, client, passenger, make_user):
+    client.post("/passenger/request-ride", data=ride_form(), headers={"Idempotency-Key": "shared"})
+
+    other = make_user("passenger")
+    login(client, other)
+    response = client.post("/passenger/request-ride", data=ride_form(), headers={"Idempotency-Key": "shared"})
+    assert "Idempotent-Replayed" not in response.headers
+    assert ride_count(web, other) == 1
+
+
+def test_request_still_running_gets_a_409(web, flask_app, client, passenger):
+    with flask_app.test_request_context("/passenger/request-ride", method="POST"):
+        session["user_id"] = passenger
+        web.reserve_idempotency_key(web.idempotency_key_hash("busy"))
+
+    response = client.post("/passenger/request-ride", data=ride_form(), headers={"Idempotency-Key": "busy"})
+    assert response.status_code == 409
+    assert response.headers["Retry-After"] == "1"
+    assert ride_count(web, passenger) == 0
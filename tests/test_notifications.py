@@ -0,0 +1,111 @@
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from notifications import Dispatcher, LogChannel, WebhookChannel, WebhookSinkHandler, mask_email
+from test_tiles import closed_port
+
+
+@pytest.fixture
+def sink():
+    """
+    A webhook receiver with its own inbox; yields (url, handler).
+    """
+    handler = type("Sink", (WebhookSinkHandler,), {"received": [], "quiet": True})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/hook", handler
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def drained(web, app_ctx):
+    """
+    An empty outbox, so each test only sees its own notifications.
+    """
+    conn = web.get_db()
+    with conn:
+        conn.execute("DELETE FROM notification_outbox")
+    conn.close()
+
+
+def outbox(web, ride_id):
+    conn = web.get_ride_db(ride_id)
+    rows = conn.execute(
+        "SELECT event, status, attempts, delivered FROM notification_outbox WHERE ride_id = ? ORDER BY id",
+        (ride_id,),
+    ).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+def accepted_ride(web, make_user, waiting_ride):
+    passenger_id = make_user("passenger")
+    driver = web.load_driver(make_user("driver", name="Mona"))
+    ride_id = waiting_ride(passenger_id)
+    web.accept_ride(driver, ride_id)
+    return driver, ride_id
+
+
+def test_driver_arrived_is_sent_once(web, drained, make_user, waiting_ride, sink):
+    url, handler = sink
+    driver, ride_id = accepted_ride(web, make_user, waiting_ride)
+
+    web.mark_arrived(driver, ride_id)
+    with pytest.raises(web.RideActionError):
+        web.mark_arrived(driver, ride_id)
+
+    Dispatcher([web.get_db], [WebhookChannel(url)]).run_once()
+    events = [m["event"] for m in handler.received if m["ride_id"] == ride_id]
+    assert events == ["driver_accepted", "driver_arrived"]
+    arrived = handler.received[-1]
+    assert arrived["subject"] == "Your driver has arrived"
+    assert "Mona (Grey sedan) is waiting for you at Tahrir Square" in arrived["text"]
+
+    # Picking up after arriving still works
+    web.mark_picked_up(driver, ride_id)
+    assert [row["event"] for row in outbox(web, ride_id)] == ["driver_accepted", "driver_arrived", "picked_up"]
+
+
+def test_failed_channel_is_retried_alone(web, drained, make_user, waiting_ride, sink, capsys):
+    url, handler = sink
+    _, ride_id = accepted_ride(web, make_user, waiting_ride)
+
+    down = WebhookChannel(f"http://127.0.0.1:{closed_port()}/hook", timeout=1)
+    Dispatcher([web.get_db], [LogChannel(), down]).run_once()
+    [row] = outbox(web, ride_id)
+    assert row["status"] == "pending" and row["attempts"] == 1
+    assert row["delivered"] == "log"
+
+    # Back up: only the webhook is delivered, the log line is not repeated
+    capsys.readouterr()
+    conn = web.get_db()
+    with conn:
+        conn.execute("UPDATE notification_outbox SET next_attempt_at = 0")
+    conn.close()
+    Dispatcher([web.get_db], [LogChannel(), WebhookChannel(url)]).run_once()
+    assert outbox(web, ride_id)[0]["status"] == "sent"
+    assert [m["ride_id"] for m in handler.received] == [ride_id]
+    assert "[notify]" not in capsys.readouterr().out
+
+
+def test_log_channel_hides_addresses_and_text_by_default(capsys):
+    message = {
+        "id": 7, "event": "accepted", "ride_id": 3, "to_email": "layla@example.com",
+        "to_name": "Layla", "subject": "Driver on the way", "text": "Mona accepted your ride from Home",
+    }
+    LogChannel().send([message])
+    out = capsys.readouterr().out
+    assert "layla@example.com" not in out and "from Home" not in out
+    assert "l***@example.com" in out
+
+    LogChannel(show_content=True).send([message])
+    out = capsys.readouterr().out
+    assert "layla@example.com" in out and "from Home" in out
+
+
+def test_mask_email():
+    assert mask_email("layla@example.com") == "l***@example.com"
+    assert mask_email("") == "***"
@@ -0,0 +1,84 @@
+import os
+import sqlite3
+
+import pytest
+
+import settlement
+from shards import ShardMap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """
+    An empty database with the settlement columns migrated, as in benchmark().
+    """
+    path = str(tmp_path / "settle.db")
+    conn = sqlite3.connect(path)
+    with open(os.path.join(ROOT, "schema.sql"), "r") as f:
+        conn.executescript(f.read())
+    for column in ("driver_id INTEGER", "completed_at TIMESTAMP", "final_fare REAL"):
+        conn.execute(f"ALTER TABLE rides ADD COLUMN {column}")
+    settlement.ensure_index(conn)
+    conn.commit()
+    conn.close()
+    return path
+
+
+def add_rides(path, rows):
+    """
+    rows: (driver_id, created_at, completed_at, final_fare)
+    """
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            """
+            INSERT INTO rides (passenger_id, pickup_address, dropoff_address, status, driver_id, created_at, completed_at, final_fare)
+            VALUES (1, 'a', 'b', 'completed', ?, ?, ?, ?)
+            """,
+            rows,
+        )
+    conn.close()
+
+
+def ledger(path):
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT driver_id, SUM(rides), SUM(gross_cents) FROM driver_ledger GROUP BY driver_id").fetchall()
+    conn.close()
+    return {driver_id: (rides, gross) for driver_id, rides, gross in rows}
+
+
+def settle(path, tmp_path, **kw):
+    return settlement.run(ShardMap(path), sink_dir=str(tmp_path / "payouts"), log=lambda *a: None, **kw)
+
+
+def test_rides_without_completed_at_are_settled(db_path, tmp_path):
+    add_rides(db_path, [
+        (1, "2024-01-02 10:00:00", "2024-01-02 10:30:00", 50.0),
+        (1, "2024-01-03 09:00:00", None, 20.0),         # completed before completed_at was recorded
+    ])
+    assert settle(db_path, tmp_path) == 2
+    assert ledger(db_path) == {1: (2, 7000)}
+
+
+def test_backfill_behind_the_checkpoint_is_not_skipped(db_path, tmp_path):
+    add_rides(db_path, [(1, "2024-03-01 10:00:00", "2024-03-01 10:30:00", 50.0)])
+    settle(db_path, tmp_path)
+
+    # An older legacy row turns up after the checkpoint has moved past its request time
+    add_rides(db_path, [(2, "2024-01-05 08:00:00", None, 30.0)])
+    assert settle(db_path, tmp_path) == 1
+    assert ledger(db_path) == {1: (1, 5000), 2: (1, 3000)}
+    assert settle(db_path, tmp_path) == 0
+
+
+def test_interrupted_run_resumes_without_double_counting(db_path, tmp_path):
+    add_rides(db_path, [(d % 3, f"2024-02-{d:02d} 10:00:00", f"2024-02-{d:02d} 10:30:00", 10.0) for d in range(1, 29)])
+    settle(db_path, tmp_path, chunk_size=5, max_chunks=2)
+    settle(db_path, tmp_path, chunk_size=5)
+    totals = ledger(db_path)
+    assert sum(rides for rides, _ in totals.values()) == 28
+    assert sum(gross for _, gross in totals.values()) == 28 * 1000
+    # Every week that has ended is paid out
+    assert sorted(os.listdir(tmp_path / "payouts")) == ["2024-01-29.csv", "2024-02-05.csv", "2024-02-12.csv", "2024-02-19.csv", "2024-02-26.csv"]
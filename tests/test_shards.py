@@ -0,0 +1,194 @@
+import os
+import sqlite3
+
+import pytest
+
+from shards import ID_STRIDE, CoreWriteJournal, ShardMap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CAIRO = (30.0444, 31.2357)
+ALEXANDRIA = (31.2001, 29.9187)       # outside every region: the global file
+
+BUMP = "UPDATE tally SET n = n + 1 WHERE name = 'rides'"
+
+
+@pytest.fixture
+def shard_map(tmp_path):
+    """
+    A global file plus one region file (Cairo), with a counter table in the
+    global file standing in for the surge gauges.
+    """
+    db_path = str(tmp_path / "core.db")
+    conn = sqlite3.connect(db_path)
+    with open(os.path.join(ROOT, "schema.sql"), "r") as f:
+        conn.executescript(f.read())
+    conn.execute("CREATE TABLE tally (name TEXT PRIMARY KEY, n INTEGER NOT NULL)")
+    conn.execute("INSERT INTO tally VALUES ('rides', 0)")
+    conn.commit()
+    conn.close()
+
+    regions = tmp_path / "regions.csv"
+    regions.write_text("name,min_lat,min_lng,max_lat,max_lng\ncairo,29.9,31.1,30.2,31.4\n")
+    shards = ShardMap(db_path, str(regions))
+    shards.sync_schema()
+    return shards
+
+
+def tally(shard_map):
+    conn = sqlite3.connect(shard_map.db_path)
+    n = conn.execute("SELECT n FROM tally").fetchone()[0]
+    conn.close()
+    return n
+
+
+def book(shard_map, journal, point, *writes, commit=True):
+    """
+    Insert a ride in the region of `point` and journal `writes` in the same transaction.
+    """
+    conn = shard_map.connect(shard_map.region_for_point(*point))
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO rides (passenger_id, pickup_address, dropoff_address, pickup_lat, pickup_lng) VALUES (1, 'a', 'b', ?, ?)",
+        point,
+    )
+    ride_id = cursor.lastrowid
+    batch = journal.batch(cursor, ride_id)
+    for sql in writes:
+        batch.execute(sql)
+    if commit:
+        conn.commit()
+    else:
+        conn.rollback()
+    conn.close()
+    batch.submit()
+    return ride_id
+
+
+def journal_rows(shard_map):
+    conn = sqlite3.connect(shard_map.regions[1].path)
+    rows = conn.execute("SELECT id, op, args FROM core_write_journal ORDER BY id").fetchall()
+    conn.close()
+    return rows
+
+
+def test_rides_are_routed_by_pickup_and_found_by_id(shard_map):
+    journal = CoreWriteJournal(shard_map)
+    cairo = book(shard_map, journal, CAIRO)
+    alexandria = book(shard_map, journal, ALEXANDRIA)
+
+    assert cairo > ID_STRIDE and alexandria < ID_STRIDE
+    assert shard_map.region_for_ride(cairo).name == "cairo"
+    assert shard_map.region_for_ride(alexandria) is shard_map.default
+
+    rows = shard_map.fanout("SELECT id FROM rides ORDER BY id", key=lambda r: r["id"])
+    assert [r["id"] for r in rows] == [alexandria, cairo]
+
+
+def test_global_file_rides_write_through(shard_map):
+    journal = CoreWriteJournal(shard_map)
+    book(shard_map, journal, ALEXANDRIA, BUMP)
+    assert tally(shard_map) == 1
+    assert journal_rows(shard_map) == []
+
+
+def test_region_writes_apply_once_after_commit(shard_map):
+    journal = CoreWriteJournal(shard_map)
+    journal.start = lambda: None        # no background thread; applied by hand
+    book(shard_map, journal, CAIRO, BUMP, BUMP)
+    book(shard_map, journal, CAIRO, BUMP, commit=False)     # rolled back with its ride
+
+    assert tally(shard_map) == 0
+    assert journal.run_once() == 2
+    assert tally(shard_map) == 2
+    assert journal.run_once() == 0
+    assert journal_rows(shard_map) == []
+
+
+def test_entries_applied_before_a_crash_are_not_repeated(shard_map):
+    journal = CoreWriteJournal(shard_map)
+    journal.start = lambda: None
+    book(shard_map, journal, CAIRO, BUMP)
+    pending = journal_rows(shard_map)
+    journal.run_once()
+
+    # Crash after the global commit but before the region file was cleaned up
+    conn = sqlite3.connect(shard_map.regions[1].path)
+    with conn:
+        conn.executemany("INSERT INTO core_write_journal (id, op, args) VALUES (?, ?, ?)", pending)
+    conn.close()
+
+    journal.run_once()
+    assert tally(shard_map) == 1
+    assert journal_rows(shard_map) == []
+
+
+def test_a_failing_entry_does_not_drop_the_rest(shard_map):
+    journal = CoreWriteJournal(shard_map)
+    journal.start = lambda: None
+    book(shard_map, journal, CAIRO, BUMP, "UPDATE no_such_table SET n = 1", BUMP)
+
+    journal.run_once()
+    assert tally(shard_map) == 2
+    assert journal.stats == {"applied": 2, "failed": 1}
+    conn = sqlite3.connect(shard_map.db_path)
+    failures = conn.execute("SELECT region, args, error FROM core_write_failures").fetchall()
+    conn.close()
+    assert len(failures) == 1
+    assert failures[0][0] == "cairo" and "no_such_table" in failures[0][1]
+
+
+def test_registered_ops_and_callbacks(shard_map):
+    seen = []
+
+    def add(cursor, amount):
+        cursor.execute("UPDATE tally SET n = n + ?", (amount,))
+        return lambda: seen.append(amount)
+
+    journal = CoreWriteJournal(shard_map, ops={"add": add}, on_apply=lambda: seen.append("applied"))
+    journal.start = lambda: None
+    conn = shard_map.connect(shard_map.regions[1])
+    cursor = conn.cursor()
+    batch = journal.batch(cursor, ID_STRIDE + 1)
+    batch.call("add", 5)
+    conn.commit()
+    conn.close()
+    batch.submit()
+
+    assert seen == []
+    journal.run_once()
+    assert tally(shard_map) == 5
+    assert seen == [5, "applied"]
+
+
+def test_driver_claim_blocks_a_second_ride(web, make_user, waiting_ride):
+    driver = web.load_driver(make_user("driver"))
+    first = waiting_ride(make_user("passenger"))
+    second = waiting_ride(make_user("passenger"))
+
+    web.accept_ride(driver, first)
+    assert not web.claim_driver(driver["driver_id"], second)
+
+    # Completing the ride releases the claim
+    web.mark_picked_up(driver, first)
+    web.complete_ride(driver, first)
+    assert web.claim_driver(driver["driver_id"], second)
+    web.release_claim(driver["driver_id"], second)
+
+
+def test_stale_claim_is_taken_over(web, make_user, waiting_ride):
+    driver = web.load_driver(make_user("driver"))
+    ride_id = waiting_ride(make_user("passenger"))
+    web.reject_ride(ride_id)
+
+    # Left behind by an accept that never finished; the ride is gone from the queue
+    conn = web.get_db()
+    with conn:
+        conn.execute(
+            "INSERT INTO driver_status (driver_id, is_online, active_ride_id) VALUES (?, 0, ?)",
+            (driver["driver_id"], ride_id),
+        )
+    conn.close()
+
+    other = waiting_ride(make_user("passenger"))
+    web.accept_ride(driver, other)
+    assert web.find_driver_active_rides(driver["driver_id"])[0]["id"] == other
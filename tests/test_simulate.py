@@ -0,0 +1,39 @@
+from eta import ANY_HOUR, EtaModel
+from simulate import Ride, Simulator
+from zones import zone_of
+
+PICKUP = (30.0444, 31.2357)
+DROPOFF = (30.0626, 31.2497)
+
+
+def learned(minutes, *pairs):
+    model = EtaModel()
+    for a, b in pairs:
+        model.stats[(zone_of(*a), zone_of(*b), ANY_HOUR)] = (10, float(minutes), 9.0)
+    return model
+
+
+def test_trip_times_come_from_the_eta_model():
+    ride = Ride(1, 0.0, PICKUP, DROPOFF)
+    sim = Simulator(1, eta=learned(42, (PICKUP, DROPOFF)))
+    sim.positions[1] = PICKUP
+    sim.store.upsert(1, PICKUP[0], PICKUP[1], last_seen=0)
+    sim.run([ride])
+
+    assert ride.status == "completed"
+    assert ride.duration_min == 42
+    assert sim.now - ride.t_pickup == 42
+
+
+def test_pickup_time_falls_back_to_fixed_speed_without_samples():
+    without = Simulator(1)
+    with_model = Simulator(1, eta=learned(7, (PICKUP, PICKUP)))
+    for sim in (without, with_model):
+        sim.positions[1] = PICKUP
+        sim.store.upsert(1, PICKUP[0], PICKUP[1], last_seen=0)
+    rides = [Ride(1, 0.0, PICKUP, DROPOFF), Ride(1, 0.0, PICKUP, DROPOFF)]
+    without.run([rides[0]])
+    with_model.run([rides[1]])
+
+    assert rides[0].t_pickup == 3.0      # 1 km minimum at PICKUP_MIN_PER_KM
+    assert rides[1].t_pickup == 7.0
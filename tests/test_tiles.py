@@ -0,0 +1,131 @@
+import os
+import socket
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from tiles import TileCache, TileError, UpstreamStubHandler
+
+
+@pytest.fixture
+def upstream():
+    """
+    A stand-in tile server with its own request counter; yields (url, handler).
+    """
+    handler = type("Stub", (UpstreamStubHandler,), {"delay": 0, "requests": 0})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/{{z}}/{{x}}/{{y}}.png", handler
+    server.shutdown()
+    server.server_close()
+
+
+def closed_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_eviction_keeps_the_cache_under_its_byte_budget(tmp_path, upstream):
+    url, _ = upstream
+    cache = TileCache(str(tmp_path), upstream=url)
+    cache.get(14, 0, 0)
+    tile_bytes = os.path.getsize(cache.path(14, 0, 0))
+    cache.max_bytes = int(tile_bytes * 4.5)
+
+    for x in range(1, 4):
+        cache.get(14, x, 0)
+    # Oldest first, then a hit makes tile 0 the most recently used
+    for x in range(4):
+        os.utime(cache.path(14, x, 0), (1000 + x, 1000 + x))
+    cache.get(14, 0, 0)
+
+    cache.get(14, 4, 0)     # fifth tile: over budget
+
+    assert cache.scan_size() <= cache.max_bytes
+    assert cache.stats["evicted"] == 1
+    assert not os.path.exists(cache.path(14, 1, 0))
+    for x in (0, 2, 3, 4):
+        assert os.path.exists(cache.path(14, x, 0))
+
+
+def test_upstream_etag_is_kept_and_revalidated(tmp_path, upstream):
+    url, _ = upstream
+    cache = TileCache(str(tmp_path), upstream=url)
+    meta, body = cache.get(14, 1, 2)
+    status, upstream_meta, _ = cache.fetch(14, 1, 2)
+    assert status == 200 and meta["etag"] == upstream_meta["etag"]
+
+    # A stale copy is revalidated with If-None-Match; the 304 keeps the body
+    cache.fresh_seconds = 0
+    fetched = cache.stats["bytes_fetched"]
+    revalidated_meta, revalidated_body = cache.get(14, 1, 2)
+    assert revalidated_meta["etag"] == meta["etag"] and revalidated_body == body
+    assert cache.stats["revalidated"] == 1
+    assert cache.stats["bytes_fetched"] == fetched
+
+
+def test_tile_route_passes_the_etag_through(web, client, tmp_path, upstream, monkeypatch):
+    url, _ = upstream
+    monkeypatch.setattr(web, "tile_cache", TileCache(str(tmp_path), upstream=url))
+
+    response = client.get("/tiles/14/3/4.png")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert etag == web.tile_cache.read(14, 3, 4)[0]["etag"]
+
+    response = client.get("/tiles/14/3/4.png", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+    assert client.get("/tiles/1/5/0.png").status_code == 404
+
+
+def test_concurrent_misses_share_one_upstream_fetch(tmp_path, upstream):
+    url, handler = upstream
+    handler.delay = 0.3
+    cache = TileCache(str(tmp_path), upstream=url)
+    start = threading.Barrier(8)
+    results = []
+
+    def get():
+        start.wait()
+        results.append(cache.get(14, 5, 6))
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert handler.requests == 1
+    assert cache.stats["misses"] == 1 and cache.stats["coalesced"] == 7
+    assert len({body for _, body in results}) == 1
+
+
+def test_upstream_failure_without_a_copy_is_an_error(tmp_path, web, client, monkeypatch):
+    cache = TileCache(str(tmp_path), upstream=f"http://127.0.0.1:{closed_port()}/{{z}}/{{x}}/{{y}}.png")
+    with pytest.raises(TileError):
+        cache.get(14, 1, 1)
+    assert cache.stats["upstream_errors"] == 1
+
+    monkeypatch.setattr(web, "tile_cache", cache)
+    assert client.get("/tiles/14/1/1.png").status_code == 502
+
+
+def test_upstream_http_error_is_an_error(tmp_path, upstream):
+    url, _ = upstream
+    cache = TileCache(str(tmp_path), upstream=url.replace("{z}/", "missing/{z}/"))
+    with pytest.raises(TileError, match="HTTP 404"):
+        cache.get(14, 1, 1)
+
+
+def test_stale_copy_is_served_when_upstream_is_down(tmp_path, upstream):
+    url, _ = upstream
+    cache = TileCache(str(tmp_path), upstream=url)
+    meta, body = cache.get(14, 7, 8)
+
+    cache.upstream = f"http://127.0.0.1:{closed_port()}/{{z}}/{{x}}/{{y}}.png"
+    cache.fresh_seconds = 0
+    assert cache.get(14, 7, 8) == (meta, body)
+    assert cache.stats["stale_served"] == 1 and cache.stats["upstream_errors"] == 1
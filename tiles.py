@@ -0,0 +1,337 @@
+"""
+Caching proxy for OpenStreetMap tiles.
+
+Every map on the dashboards loads its tiles from /tiles/<z>/<x>/<y>.png
+instead of tile.openstreetmap.org. Tiles are kept in an on-disk cache
+shared by all workers:
+
+    tile_cache/14/9584/6843.png     JSON header line (etag, content type, fetched_at) + tile bytes
+
+Each file is written to a temp file and renamed into place, so readers
+never see a partial tile. A cache hit bumps the file's mtime, and when the
+cache grows past max_bytes the least recently used files are deleted until
+it is back under LOW_WATER of the limit.
+
+Tiles older than FRESH_SECONDS are revalidated upstream with the stored
+ETag; an upstream 304 only refreshes the timestamp. If upstream is down, a
+stale copy is served rather than an error. Concurrent misses for the same
+tile in one worker share a single upstream fetch.
+
+    python tiles.py upstream-stub 8030    # local stand-in tile server
+    python tiles.py bench                 # stand-in + cache under concurrent load
+"""
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_UPSTREAM = "https://tile.openstreetmap.org/{z}/{x}/{y}.png"
+USER_AGENT = "U-Ride tile proxy (ride-hailing-app-team6)"
+MAX_ZOOM = 19
+MAX_BYTES = 256 * 1024 * 1024
+LOW_WATER = 0.9
+FRESH_SECONDS = 7 * 86400       # OSM tiles are re-rendered at most about weekly
+TIMEOUT_SECONDS = 10
+
+
+class TileError(Exception):
+    pass
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+class TileCache:
+    def __init__(self, cache_dir, max_bytes=MAX_BYTES, upstream=DEFAULT_UPSTREAM, fresh_seconds=FRESH_SECONDS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.upstream = upstream
+        self.fresh_seconds = fresh_seconds
+        self.lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+        self.inflight = {}          # (z, x, y) -> Event set when the fetch finishes
+        self.size = None            # estimate of cache bytes on disk, rescanned on eviction
+        self.stats = {
+            "hits": 0, "misses": 0, "revalidated": 0, "coalesced": 0,
+            "stale_served": 0, "upstream_errors": 0, "evicted": 0,
+            "bytes_served": 0, "bytes_fetched": 0,
+        }
+
+    # ---------------- disk ----------------
+
+    def path(self, z, x, y):
+        return os.path.join(self.cache_dir, str(z), str(x), f"{y}.png")
+
+    def read(self, z, x, y):
+        """
+        (meta, body) or None.
+        """
+        try:
+            with open(self.path(z, x, y), "rb") as f:
+                header, _, body = f.read().partition(b"\n")
+            return json.loads(header), body
+        except (OSError, ValueError):
+            return None
+
+    def write(self, z, x, y, meta, body):
+        path = self.path(z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(meta).encode("utf-8") + b"\n" + body
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self.lock:
+            if self.size is None:
+                self.size = self.scan_size()
+            self.size += len(data) - replaced
+            over = self.size > self.max_bytes
+        if over:
+            self.evict()
+
+    def touch(self, z, x, y):
+        try:
+            os.utime(self.path(z, x, y))
+        except OSError:
+            pass
+
+    def entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue    # being written
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue    # evicted by another worker
+                yield path, st.st_size, st.st_mtime
+
+    def scan_size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Delete least recently used tiles until the cache is under LOW_WATER
+        of max_bytes. Rescans the directory, since other workers write too.
+        """
+        with self.evict_lock:
+            entries = sorted(self.entries(), key=lambda e: e[2])
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * LOW_WATER
+            evicted = 0
+            for path, size, _ in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+                evicted += 1
+            with self.lock:
+                self.size = total
+                self.stats["evicted"] += evicted
+
+    # ---------------- upstream ----------------
+
+    def fetch(self, z, x, y, etag=None):
+        """
+        (status, meta, body) from upstream; status is 200 or 304.
+        """
+        req = urllib.request.Request(self.upstream.format(z=z, x=x, y=y), headers={"User-Agent": USER_AGENT})
+        if etag:
+            req.add_header("If-None-Match", etag)
+        try:
+            with urllib.request.urlopen(req, timeout=TIMEOUT_SECONDS) as resp:
+                body = resp.read()
+                meta = {
+                    "etag": resp.headers.get("ETag") or '"' + hashlib.sha1(body).hexdigest() + '"',
+                    "content_type": resp.headers.get("Content-Type", "image/png"),
+                    "fetched_at": int(time.time()),
+                }
+                return 200, meta, body
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return 304, None, None
+            raise TileError(f"upstream returned HTTP {e.code}")
+        except OSError as e:
+            raise TileError(f"upstream unreachable: {e}")
+
+    # ---------------- lookups ----------------
+
+    def get(self, z, x, y):
+        """
+        (meta, body) for a tile, from disk when fresh. Raises TileError when
+        there is neither an upstream copy nor a cached one.
+        """
+        cached = self.read(z, x, y)
+        if cached and time.time() - cached[0]["fetched_at"] < self.fresh_seconds:
+            self.touch(z, x, y)
+            self.count("hits", cached[1])
+            return cached
+
+        key = (z, x, y)
+        with self.lock:
+            event = self.inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self.inflight[key] = threading.Event()
+        if not leader:
+            # Another request is already fetching this tile
+            event.wait(TIMEOUT_SECONDS * 2)
+            result = self.read(z, x, y)
+            if result is None:
+                raise TileError("coalesced fetch failed")
+            self.count("coalesced", result[1])
+            return result
+
+        try:
+            return self.refresh(z, x, y, cached)
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            event.set()
+
+    def refresh(self, z, x, y, cached):
+        try:
+            status, meta, body = self.fetch(z, x, y, cached[0]["etag"] if cached else None)
+        except TileError:
+            with self.lock:
+                self.stats["upstream_errors"] += 1
+            if cached:
+                self.count("stale_served", cached[1])
+                return cached
+            raise
+
+        if status == 304 and cached:
+            meta, body = cached
+            meta = dict(meta, fetched_at=int(time.time()))
+            self.write(z, x, y, meta, body)
+            self.count("revalidated", body)
+            return meta, body
+
+        self.write(z, x, y, meta, body)
+        with self.lock:
+            self.stats["bytes_fetched"] += len(body)
+        self.count("misses", body)
+        return meta, body
+
+    def count(self, outcome, body):
+        with self.lock:
+            self.stats[outcome] += 1
+            self.stats["bytes_served"] += len(body)
+
+    def report(self):
+        with self.lock:
+            stats = dict(self.stats)
+            size = self.size
+        requests = stats["hits"] + stats["misses"] + stats["revalidated"] + stats["coalesced"] + stats["stale_served"]
+        # Anything answered without downloading a tile body counts as a hit
+        stats["hit_rate"] = round((requests - stats["misses"]) / requests, 4) if requests else None
+        stats["cache_bytes"] = size
+        stats["max_bytes"] = self.max_bytes
+        return stats
+
+
+# ---------------- local stand-ins ----------------
+
+class UpstreamStubHandler(BaseHTTPRequestHandler):
+    """
+    Serves deterministic fake tiles with ETags, like the real tile server.
+    """
+    delay = 0.05
+    requests = 0
+
+    def do_GET(self):
+        type(self).requests += 1
+        parts = self.path.strip("/").removesuffix(".png").split("/")
+        if len(parts) != 3 or not all(p.isdigit() for p in parts):
+            self.send_error(404)
+            return
+        body = hashlib.sha256(self.path.encode()).digest() * 512     # 16 KB, about a real tile
+        etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+        time.sleep(self.delay)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench(requests=4000, concurrency=32, max_bytes=8 * 1024 * 1024):
+    """
+    Zipf-like load over a city's worth of tiles (popular areas are hit far
+    more often), against a stand-in upstream and a cache too small to hold
+    everything.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), UpstreamStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    upstream = f"http://127.0.0.1:{server.server_port}/{{z}}/{{x}}/{{y}}.png"
+
+    rng = random.Random(1)
+    tiles = [(14, 9584 + dx, 6843 + dy) for dx in range(-15, 15) for dy in range(-15, 15)]
+    weights = [1 / (i + 1) for i in range(len(tiles))]
+    load = rng.choices(tiles, weights, k=requests)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = TileCache(tmp, max_bytes=max_bytes, upstream=upstream)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            for _ in pool.map(lambda t: cache.get(*t), load):
+                pass
+        elapsed = time.perf_counter() - started
+        on_disk = cache.scan_size()
+        stats = cache.report()
+
+    server.shutdown()
+    print(f"[tiles] {requests} requests ({len(tiles)} distinct tiles, {concurrency} threads) in {elapsed:.2f}s")
+    print(f"[tiles] upstream requests: {UpstreamStubHandler.requests}")
+    print(f"[tiles] hit rate {stats['hit_rate']:.1%}; {stats['hits']} hits, {stats['misses']} misses, "
+          f"{stats['coalesced']} coalesced, {stats['evicted']} evicted")
+    print(f"[tiles] {stats['bytes_served'] / 1e6:.1f} MB served, {stats['bytes_fetched'] / 1e6:.1f} MB fetched")
+    print(f"[tiles] cache on disk {on_disk / 1e6:.1f} MB (limit {max_bytes / 1e6:.1f} MB)")
+
+
+def main():
+    if len(sys.argv) >= 2 and sys.argv[1] == "upstream-stub":
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 8030
+        print(f"[tiles] Stand-in tile server on http://127.0.0.1:{port}/{{z}}/{{x}}/{{y}}.png")
+        ThreadingHTTPServer(("127.0.0.1", port), UpstreamStubHandler).serve_forever()
+    elif len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        bench()
+    else:
+        print("usage: python tiles.py upstream-stub [port] | bench")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Compact GPS trip traces.
+
+A trace is stored as one polyline-encoded string per ride instead of one
+row per point. Each point is a (lat, lng, t) triple, with lat/lng at 1e-5
+degree precision (~1 m) and t in whole seconds. Values are delta-encoded
+against the previous point using Google's polyline varint scheme, so a
+point usually costs 6-9 bytes.
+
+Because the encoding is relative to the previous point, new points can be
+appended by encoding against the last stored point and concatenating.
+Nothing is decoded on the write path. The running distance is maintained
+at append time, so pricing a finished trip is O(1).
+"""
+from routing import haversine_km
+
+PRECISION = 1e5
+MIN_STEP_M = 5.0            # ignore GPS jitter below this
+MAX_SPEED_KMH = 200.0       # ignore jumps faster than this (bad fixes)
+
+
+def _encode_value(value, out):
+    value = ~(value << 1) if value < 0 else (value << 1)
+    while value >= 0x20:
+        out.append(chr((0x20 | (value & 0x1F)) + 63))
+        value >>= 5
+    out.append(chr(value + 63))
+
+
+def encode(points, previous=None):
+    """
+    Encode (lat, lng, t) points relative to `previous` (the last point
+    already stored as integer (lat_e5, lng_e5, t) or None for a new trace).
+    Returns (encoded_str, last_point_as_integers).
+    """
+    out = []
+    p_lat, p_lng, p_t = previous if previous else (0, 0, 0)
+    for lat, lng, t in points:
+        i_lat, i_lng, i_t = round(lat * PRECISION), round(lng * PRECISION), int(t)
+        _encode_value(i_lat - p_lat, out)
+        _encode_value(i_lng - p_lng, out)
+        _encode_value(i_t - p_t, out)
+        p_lat, p_lng, p_t = i_lat, i_lng, i_t
+    return "".join(out), (p_lat, p_lng, p_t)
+
+
+def decode(encoded):
+    """
+    Decode a whole trace back into (lat, lng, t) points.
+    """
+    points = []
+    values = []
+    current = 0
+    shift = 0
+    for ch in encoded:
+        b = ord(ch) - 63
+        current |= (b & 0x1F) << shift
+        shift += 5
+        if b < 0x20:
+            values.append(~(current >> 1) if current & 1 else current >> 1)
+            current = 0
+            shift = 0
+
+    lat = lng = t = 0
+    for i in range(0, len(values) - 2, 3):
+        lat += values[i]
+        lng += values[i + 1]
+        t += values[i + 2]
+        points.append((lat / PRECISION, lng / PRECISION, t))
+    return points
+
+
+def filter_points(points, last=None):
+    """
+    Drop out-of-order timestamps, sub-MIN_STEP_M jitter and impossible jumps.
+    `last` is the previously accepted (lat, lng, t), if any.
+    Returns (kept_points, added_distance_km).
+    """
+    kept = []
+    added_km = 0.0
+    for lat, lng, t in sorted(points, key=lambda p: p[2]):
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            continue
+        if last is not None:
+            if t <= last[2]:
+                continue
+            step_km = haversine_km(last[0], last[1], lat, lng)
+            if step_km * 1000 < MIN_STEP_M:
+                continue
+            if step_km / ((t - last[2]) / 3600.0) > MAX_SPEED_KMH:
+                continue
+            added_km += step_km
+        kept.append((lat, lng, t))
+        last = (lat, lng, t)
+    return kept, added_km
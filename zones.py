@@ -0,0 +1,60 @@
+"""
+Geohash zones shared by the ETA model and surge pricing.
+
+Precision 5 cells are roughly 4.9 km x 4.9 km, and precision 6 cells
+are roughly 1.2 km x 0.6 km.
+"""
+import time
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash(lat, lng, precision=5):
+    lat_lo, lat_hi = -90.0, 90.0
+    lng_lo, lng_hi = -180.0, 180.0
+    chars = []
+    bits = 0
+    value = 0
+    even = True  # geohash interleaves bits starting with longitude
+
+    while len(chars) < precision:
+        if even:
+            mid = (lng_lo + lng_hi) / 2
+            if lng >= mid:
+                value = (value << 1) | 1
+                lng_lo = mid
+            else:
+                value <<= 1
+                lng_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                value = (value << 1) | 1
+                lat_lo = mid
+            else:
+                value <<= 1
+                lat_hi = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = 0
+            value = 0
+    return "".join(chars)
+
+
+def zone_of(lat, lng, precision=5):
+    """
+    Geohash cell for a coordinate pair, or None when coordinates are missing.
+    """
+    if lat is None or lng is None:
+        return None
+    return geohash(float(lat), float(lng), precision)
+
+
+def hour_of_week(timestamp=None):
+    """
+    0..167, Monday 00:00 UTC = 0.
+    """
+    t = time.gmtime(timestamp)
+    return t.tm_wday * 24 + t.tm_hour